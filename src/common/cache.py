@@ -0,0 +1,88 @@
+'''
+common.cache
+'''
+import os
+import errno
+import json
+import shutil
+import hashlib
+import gettext
+import logging
+
+class ResultCacheError(Exception):
+  pass
+
+class ResultCache:
+
+  def __init__(self, cache_dir, logger=None):
+    # parameters
+    self.cache_dir = cache_dir
+    self.logger = logger or logging.getLogger(__name__)
+    # internal
+    self._ = gettext.gettext
+    # check dirs
+    try:
+      os.makedirs(self.cache_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise ResultCacheError(self._('Cannot create cache dir'))
+
+  def key(self, *parts):
+    return hashlib.sha1(
+      json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+  def _entry_dir(self, key):
+    return os.path.join(self.cache_dir, key[:2], key)
+
+  def _meta_path(self, key):
+    return os.path.join(self._entry_dir(key), 'meta.json')
+
+  def get(self, key):
+    path = self._meta_path(key)
+    if not os.path.isfile(path):
+      return None
+    try:
+      with open(path, encoding='utf-8') as meta:
+        return json.load(meta)
+    except (OSError, ValueError):
+      self.logger.warning(
+        '{} {}'.format(self._('Ignoring unreadable cache entry'), key),
+        exc_info=True
+      )
+      return None
+
+  def put(self, key, base_dir, files, data=None):
+    entry_dir = self._entry_dir(key)
+    try:
+      os.makedirs(entry_dir, exist_ok=True)
+      for f in files:
+        dst = os.path.join(entry_dir, 'files', f)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(os.path.join(base_dir, f), dst)
+      # the entry only becomes visible once its meta file is complete
+      tmp = '{}.tmp'.format(self._meta_path(key))
+      with open(tmp, 'w', encoding='utf-8') as meta:
+        json.dump({'files': files, 'data': data}, meta)
+      os.replace(tmp, self._meta_path(key))
+    except OSError:
+      msg = '{} {}'.format(self._('Cannot write cache entry'), key)
+      self.logger.error(msg, exc_info=True)
+      raise ResultCacheError(msg)
+
+  def restore(self, key, base_dir):
+    meta = self.get(key)
+    if meta is None:
+      return None
+    try:
+      for f in meta['files']:
+        dst = os.path.join(base_dir, f)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(os.path.join(self._entry_dir(key), 'files', f), dst)
+    except OSError:
+      self.logger.warning(
+        '{} {}'.format(self._('Ignoring incomplete cache entry'), key),
+        exc_info=True
+      )
+      return None
+    return meta
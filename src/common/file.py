@@ -11,14 +11,56 @@ import json
 class FileManagerError(Exception):
   pass
 
+class CsvFileWriter:
+
+  def __init__(self, file_path, hrow=None, mode='w', encoding='utf-8', flush_rows=0):
+    # parameters
+    self.file_path = file_path
+    # rows written before the buffer is flushed to disk, 0 to flush on close
+    self.flush_rows = flush_rows
+    # internal
+    self.rows = 0
+    self._file = open(file_path, mode, newline = '', encoding=encoding)
+    self._writer = csv.writer(self._file)
+    if hrow:
+      self._writer.writerow(hrow)
+
+  def writerow(self, row):
+    self._writer.writerow(row)
+    self.rows += 1
+    if self.flush_rows and self.rows % self.flush_rows == 0:
+      self._file.flush()
+
+  def writerows(self, rows):
+    for r in rows:
+      self.writerow(r)
+
+  def flush(self):
+    if not self._file.closed:
+      self._file.flush()
+
+  def close(self):
+    if not self._file.closed:
+      self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
 class FileManager:
 
-  def __init__(self, output_dir, logger=None):
+  def __init__(self, output_dir, logger=None, flush_rows=1000):
     # parameters
     self.output_dir = output_dir
     self.logger = logger or logging.getLogger(__name__)
+    # rows appended to a file before they are flushed, 0 to flush on close,
+    # 1 to write every row at once
+    self.flush_rows = flush_rows
     # internal
     self._ = gettext.gettext
+    self._writers = {}
     # check dirs
     try:
         os.makedirs(self.output_dir)
@@ -44,31 +86,87 @@ class FileManager:
     else:
       return os.path.join(self.output_dir, file_name)
 
+  def _appender(self, file_path, mode='a', hrow=None):
+    writer = self._writers.get(file_path)
+    if writer is None or mode == 'w':
+      if writer is not None:
+        writer.close()
+      # appended files keep the platform encoding they always had
+      writer = CsvFileWriter(file_path, hrow, mode, None, self.flush_rows)
+      self._writers[file_path] = writer
+    return writer
+
   def start_csv_file(self, file_name, hrow):
-    with open(self._output_file_path(None, file_name), 'w', newline = '') as csvfile:
-      writer = csv.writer(csvfile)
-      if hrow:
-        writer.writerow(hrow)
+    writer = self._appender(self._output_file_path(None, file_name), 'w', hrow)
+    writer.flush()
 
   def append_csv_file(self, file_name, row):
-    with open(self._output_file_path(None, file_name), 'a', newline = '') as csvfile:
-      writer = csv.writer(csvfile)
-      if row:
-        writer.writerow(row)
+    writer = self._appender(self._output_file_path(None, file_name))
+    if row:
+      writer.writerow(row)
+
+  def close_csv_file(self, file_name):
+    writer = self._writers.pop(self._output_file_path(None, file_name), None)
+    if writer is not None:
+      writer.close()
+
+  def flush(self):
+    for writer in self._writers.values():
+      writer.flush()
+
+  def close(self):
+    errors = []
+    for file_path, writer in self._writers.items():
+      try:
+        writer.close()
+      except OSError:
+        self.logger.error(
+          '{} {}'.format(self._('Cannot close file'), file_path), exc_info=True
+        )
+        errors.append(file_path)
+    self._writers = {}
+    if errors:
+      raise FileManagerError('{} {}'.format(self._('Cannot close files'), ', '.join(errors)))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def open_csv_file(self, dir_name, file_name, hrow):
+    return CsvFileWriter(self._output_file_path(dir_name, file_name), hrow)
 
   def write_csv_file(self, dir_name, file_name, hrow, rows):
-    with open(
-      self._output_file_path(dir_name, file_name),
-      'w',
-      newline = '',
-      encoding='utf-8'
-      ) as csvfile:
-      writer = csv.writer(csvfile)
-      if hrow:
-        writer.writerow(hrow)
+    with self.open_csv_file(dir_name, file_name, hrow) as writer:
       if rows:
-        for r in rows:
-          writer.writerow(r)
+        writer.writerows(rows)
+    return writer.rows
+
+  def read_csv_file(self, dir_name, file_name):
+    file_path = self._output_file_path(dir_name, file_name)
+    if not os.path.isfile(file_path):
+      return []
+    with open(file_path, newline = '', encoding='utf-8') as csvfile:
+      rows = list(csv.reader(csvfile))
+    return rows[1:]
+
+  def copy_csv_file(self, dir_name, file_name, hrow, copy):
+    # copy writes the rows to the open file, files left without rows are
+    # removed, returns if there are rows
+    file_path = self._output_file_path(dir_name, file_name)
+    written = False
+    try:
+      with open(file_path, 'w', newline = '', encoding='utf-8') as csvfile:
+        if hrow:
+          csv.writer(csvfile, lineterminator='\n').writerow(hrow)
+        start = csvfile.tell()
+        copy(csvfile)
+        written = csvfile.tell() > start
+    finally:
+      if not written and os.path.isfile(file_path):
+        os.remove(file_path)
+    return written
 
   def write_txt_file (self, file_name, data):
     with open(self._output_file_path(None, file_name), 'w', encoding='utf-8') as txtfile:
@@ -84,3 +182,7 @@ class FileManager:
       with open(file_name) as json_data:
         data = json.load(json_data)
     return data
+
+  def write_json_file(self, file_name, data):
+    with open(self._output_file_path(None, file_name), 'w', encoding='utf-8') as json_data:
+      json.dump(data, json_data)
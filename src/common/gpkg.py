@@ -0,0 +1,550 @@
+'''
+common.gpkg
+'''
+import os
+import re
+import csv
+import struct
+import sqlite3
+import tempfile
+import threading
+
+from .file import FileManager, FileManagerError
+
+# 'GPKG', version 1.2
+GPKG_APPLICATION_ID = 0x47504B47
+GPKG_USER_VERSION = 10200
+
+WKB_CODES = {
+  'POINT': 1,
+  'LINESTRING': 2,
+  'POLYGON': 3,
+  'MULTIPOINT': 4,
+  'MULTILINESTRING': 5,
+  'MULTIPOLYGON': 6,
+  'GEOMETRYCOLLECTION': 7
+}
+
+WGS84_DEFINITION = (
+  'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,'
+  'AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,'
+  'AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,'
+  'AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+)
+
+GPKG_SETUP = [
+  'PRAGMA application_id = {}'.format(GPKG_APPLICATION_ID),
+  'PRAGMA user_version = {}'.format(GPKG_USER_VERSION),
+  'CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys ('
+  'srs_name TEXT NOT NULL, '
+  'srs_id INTEGER PRIMARY KEY, '
+  'organization TEXT NOT NULL, '
+  'organization_coordsys_id INTEGER NOT NULL, '
+  'definition TEXT NOT NULL, '
+  'description TEXT'
+  ')',
+  'CREATE TABLE IF NOT EXISTS gpkg_contents ('
+  'table_name TEXT NOT NULL PRIMARY KEY, '
+  'data_type TEXT NOT NULL, '
+  'identifier TEXT UNIQUE, '
+  "description TEXT DEFAULT '', "
+  "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+  'min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, '
+  'srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id)'
+  ')',
+  'CREATE TABLE IF NOT EXISTS gpkg_geometry_columns ('
+  'table_name TEXT NOT NULL REFERENCES gpkg_contents(table_name), '
+  'column_name TEXT NOT NULL, '
+  'geometry_type_name TEXT NOT NULL, '
+  'srs_id INTEGER NOT NULL REFERENCES gpkg_spatial_ref_sys(srs_id), '
+  'z TINYINT NOT NULL, '
+  'm TINYINT NOT NULL, '
+  'PRIMARY KEY (table_name, column_name)'
+  ')',
+  'CREATE TABLE IF NOT EXISTS gpkg_extensions ('
+  'table_name TEXT, '
+  'column_name TEXT, '
+  'extension_name TEXT NOT NULL, '
+  'definition TEXT NOT NULL, '
+  'scope TEXT NOT NULL, '
+  'UNIQUE (table_name, column_name, extension_name)'
+  ')',
+  'INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES '
+  "('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', NULL), "
+  "('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL), "
+  "('WGS 84', 4326, 'EPSG', 4326, '{}', NULL)".format(WGS84_DEFINITION)
+]
+
+# spatial index of a geometry column, kept up to date by the triggers of the
+# rtree extension, which call the functions registered by gpkg_functions
+RTREE_DEFINITION = 'http://www.geopackage.org/spec120/#extension_rtree'
+
+RTREE_VALUES = (
+  '(NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom))'
+)
+
+RTREE_TRIGGERS = [
+  (
+    'insert',
+    'AFTER INSERT ON "{0}" WHEN (NEW.geom NOT NULL AND NOT ST_IsEmpty(NEW.geom)) '
+    'BEGIN INSERT OR REPLACE INTO "rtree_{0}_geom" VALUES {1}; END'
+  ),
+  (
+    'update1',
+    'AFTER UPDATE OF geom ON "{0}" WHEN OLD.fid = NEW.fid AND '
+    '(NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom)) '
+    'BEGIN INSERT OR REPLACE INTO "rtree_{0}_geom" VALUES {1}; END'
+  ),
+  (
+    'update2',
+    'AFTER UPDATE OF geom ON "{0}" WHEN OLD.fid = NEW.fid AND '
+    '(NEW.geom ISNULL OR ST_IsEmpty(NEW.geom)) '
+    'BEGIN DELETE FROM "rtree_{0}_geom" WHERE id = OLD.fid; END'
+  ),
+  (
+    'update3',
+    'AFTER UPDATE ON "{0}" WHEN OLD.fid != NEW.fid AND '
+    '(NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom)) '
+    'BEGIN DELETE FROM "rtree_{0}_geom" WHERE id = OLD.fid; '
+    'INSERT OR REPLACE INTO "rtree_{0}_geom" VALUES {1}; END'
+  ),
+  (
+    'update4',
+    'AFTER UPDATE ON "{0}" WHEN OLD.fid != NEW.fid AND '
+    '(NEW.geom ISNULL OR ST_IsEmpty(NEW.geom)) '
+    'BEGIN DELETE FROM "rtree_{0}_geom" WHERE id IN (OLD.fid, NEW.fid); END'
+  ),
+  (
+    'delete',
+    'AFTER DELETE ON "{0}" WHEN OLD.geom NOT NULL '
+    'BEGIN DELETE FROM "rtree_{0}_geom" WHERE id = OLD.fid; END'
+  )
+]
+
+WKT_TOKENS = re.compile(r'[A-Za-z]+|\(|\)|,|[-+0-9.eE]+')
+
+class WKTError(Exception):
+  pass
+
+def _wkt_list(tokens, i, item):
+  # parenthesized and comma separated items
+  if tokens[i] != '(':
+    raise WKTError('Expected ( at token {}'.format(i))
+  items = []
+  i += 1
+  while True:
+    value, i = item(tokens, i)
+    items.append(value)
+    if tokens[i] == ')':
+      return items, i + 1
+    if tokens[i] != ',':
+      raise WKTError('Expected , or ) at token {}'.format(i))
+    i += 1
+
+def _wkt_coord(tokens, i):
+  coord = []
+  while tokens[i] not in [',', ')']:
+    coord.append(float(tokens[i]))
+    i += 1
+  return coord, i
+
+def _wkt_point(tokens, i):
+  # points of a multipoint may be parenthesized or not
+  if tokens[i] == '(':
+    coords, i = _wkt_list(tokens, i, _wkt_coord)
+    return coords[0], i
+  return _wkt_coord(tokens, i)
+
+def _wkt_ring(tokens, i):
+  return _wkt_list(tokens, i, _wkt_coord)
+
+def _wkt_polygon(tokens, i):
+  return _wkt_list(tokens, i, _wkt_ring)
+
+def _wkt_geometry(tokens, i):
+  name = tokens[i].upper()
+  if name not in WKB_CODES:
+    raise WKTError('Unknown geometry type: {}'.format(tokens[i]))
+  i += 1
+  if tokens[i].upper() in ['Z', 'M', 'ZM']:
+    i += 1
+  if tokens[i].upper() == 'EMPTY':
+    return (name, []), i + 1
+  if name in ['POINT', 'LINESTRING']:
+    value, i = _wkt_list(tokens, i, _wkt_coord)
+  elif name == 'MULTIPOINT':
+    value, i = _wkt_list(tokens, i, _wkt_point)
+  elif name in ['POLYGON', 'MULTILINESTRING']:
+    value, i = _wkt_list(tokens, i, _wkt_ring)
+  elif name == 'MULTIPOLYGON':
+    value, i = _wkt_list(tokens, i, _wkt_polygon)
+  else:
+    value, i = _wkt_list(tokens, i, _wkt_geometry)
+  return (name, value), i
+
+def _wkb_coords(coords, dims):
+  return struct.pack('<I', len(coords)) + b''.join(
+    struct.pack('<{}d'.format(dims), *c[:dims]) for c in coords
+  )
+
+def _wkb_geometry(geom, dims, envelope):
+  name, value = geom
+  code = WKB_CODES[name] + {2: 0, 3: 1000, 4: 3000}[dims]
+  wkb = struct.pack('<BI', 1, code)
+  if name == 'POINT':
+    if not value:
+      return wkb + struct.pack('<{}d'.format(dims), *([float('nan')] * dims))
+    envelope.append(value[0])
+    return wkb + struct.pack('<{}d'.format(dims), *value[0][:dims])
+  if name == 'LINESTRING':
+    envelope.extend(value)
+    return wkb + _wkb_coords(value, dims)
+  if name == 'POLYGON':
+    for ring in value:
+      envelope.extend(ring)
+    return wkb + struct.pack('<I', len(value)) + b''.join(
+      _wkb_coords(ring, dims) for ring in value
+    )
+  member = {
+    'MULTIPOINT': lambda v: ('POINT', [v]),
+    'MULTILINESTRING': lambda v: ('LINESTRING', v),
+    'MULTIPOLYGON': lambda v: ('POLYGON', v),
+    'GEOMETRYCOLLECTION': lambda v: v
+  }[name]
+  return wkb + struct.pack('<I', len(value)) + b''.join(
+    _wkb_geometry(member(v), dims, envelope) for v in value
+  )
+
+def _wkt_dims(geom):
+  name, value = geom
+  while value and isinstance(value, list):
+    if isinstance(value[0], tuple):
+      return _wkt_dims(value[0])
+    if isinstance(value[0], float):
+      return min(max(len(value), 2), 4)
+    value = value[0]
+  return 2
+
+def wkt_to_wkb(wkt):
+  # returns the vertices too, for the envelope
+  tokens = WKT_TOKENS.findall(wkt)
+  try:
+    geom, i = _wkt_geometry(tokens, 0)
+  except (IndexError, ValueError) as err:
+    raise WKTError('Invalid WKT: {}'.format(wkt)) from err
+  if i != len(tokens):
+    raise WKTError('Invalid WKT: {}'.format(wkt))
+  envelope = []
+  return _wkb_geometry(geom, _wkt_dims(geom), envelope), envelope
+
+def gpkg_geometry(wkt, srs_id=0):
+  if not wkt:
+    return None
+  wkb, coords = wkt_to_wkb(wkt)
+  if not coords:
+    # little endian, no envelope, empty
+    return struct.pack('<2sBBi', b'GP', 0, 0x11, srs_id) + wkb
+  xs = [c[0] for c in coords]
+  ys = [c[1] for c in coords]
+  # little endian, xy envelope
+  return struct.pack(
+    '<2sBBi4d', b'GP', 0, 0x03, srs_id, min(xs), max(xs), min(ys), max(ys)
+  ) + wkb
+
+def gpkg_envelope(blob):
+  # (min x, max x, min y, max y) from the header of a GeoPackage geometry
+  if blob is None or len(blob) < 8:
+    return None
+  flags = blob[3]
+  if flags & 0x10 or not (flags >> 1) & 0x07:
+    return None
+  return struct.unpack_from('<4d' if flags & 0x01 else '>4d', blob, 8)
+
+def gpkg_is_empty(blob):
+  return blob is None or len(blob) < 8 or bool(blob[3] & 0x10)
+
+def gpkg_functions(conn):
+  # the sql functions the rtree triggers need, which sqlite does not have
+  for i, name in enumerate(['ST_MinX', 'ST_MaxX', 'ST_MinY', 'ST_MaxY']):
+    conn.create_function(
+      name, 1, lambda blob, i=i: (gpkg_envelope(blob) or [None] * 4)[i]
+    )
+  conn.create_function('ST_IsEmpty', 1, lambda blob: int(gpkg_is_empty(blob)))
+
+def point_wkt(x, y):
+  if x is None or y is None or x == '' or y == '':
+    return None
+  return 'POINT({} {})'.format(x, y)
+
+def gpkg_name(name):
+  return re.sub(r'\W', '_', name).strip('_').lower() or 'field'
+
+class GeoPackageTableWriter:
+
+  def __init__(self, sink, table, source, columns, geometry):
+    # parameters
+    self.sink = sink
+    self.table = table
+    self.source = source
+    self.columns = columns
+    # function that returns the geometry of a row, None if the table has none
+    self.geometry = geometry
+    # internal
+    self.rows = 0
+    self._batch = []
+
+  def writerow(self, row):
+    if len(row) > len(self.columns):
+      # rows already batched have fewer values
+      self.flush()
+      self.columns = self.sink.add_columns(self.table, len(row))
+    values = [self.source] + list(row) + [None] * (len(self.columns) - len(row))
+    if self.geometry:
+      values.append(self.geometry(row))
+    self._batch.append(values)
+    self.rows += 1
+    if self.sink.batch_size and len(self._batch) >= self.sink.batch_size:
+      self.flush()
+
+  def writerows(self, rows):
+    for r in rows:
+      self.writerow(r)
+
+  def flush(self):
+    if self._batch:
+      self.sink.insert(self.table, self.columns, self.geometry is not None, self._batch)
+      self._batch = []
+
+  def close(self):
+    self.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+class GeoPackageFileManager(FileManager):
+  # detail results go to one table per rule of a GeoPackage in the output
+  # folder, text and json files are still written as files
+
+  def __init__(
+    self,
+    output_dir,
+    file_name='results.gpkg',
+    logger=None,
+    batch_size=1000,
+    geometry_columns=None,
+    point_columns=None,
+    srs_id=0
+    ):
+    super().__init__(output_dir, logger)
+    # parameters
+    self.file_name = file_name
+    # rows inserted per transaction, 0 to insert them when a writer is closed
+    self.batch_size = batch_size
+    # header names of the columns that hold WKT geometries
+    self.geometry_columns = geometry_columns or []
+    # header names of the x and y columns of point locations
+    self.point_columns = point_columns
+    self.srs_id = srs_id
+    # internal
+    self._lock = threading.Lock()
+    self._tables = {}
+    try:
+      self._conn = sqlite3.connect(
+        os.path.join(self.output_dir, self.file_name),
+        isolation_level=None,
+        check_same_thread=False
+      )
+      gpkg_functions(self._conn)
+      for query in GPKG_SETUP:
+        self._conn.execute(query)
+      self._conn.execute(
+        'INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, NULL)',
+        ['EPSG:{}'.format(srs_id), srs_id, 'EPSG', srs_id, 'undefined']
+      )
+    except sqlite3.Error:
+      msg = '{} {}'.format(self._('Cannot open GeoPackage'), self.file_name)
+      self.logger.error(msg, exc_info=True)
+      raise FileManagerError(msg)
+
+  def add_dir(self, dir_name):
+    # rules are tables, not folders
+    return self.get_dir(dir_name)
+
+  def _geometry(self, hrow):
+    names = list(hrow or [])
+    for column in self.geometry_columns:
+      if column in names:
+        i = names.index(column)
+        return lambda row: gpkg_geometry(row[i] if i < len(row) else None, self.srs_id)
+    if self.point_columns and all([c in names for c in self.point_columns]):
+      ix = names.index(self.point_columns[0])
+      iy = names.index(self.point_columns[1])
+      return lambda row: gpkg_geometry(
+        point_wkt(row[ix], row[iy]) if max(ix, iy) < len(row) else None, self.srs_id
+      )
+    return None
+
+  def _table(self, dir_name, file_name, hrow):
+    # one table per rule, each file of the rule is a source of the table
+    table = gpkg_name(dir_name or os.path.splitext(file_name)[0])
+    geometry = self._geometry(hrow)
+    with self._lock:
+      if table not in self._tables:
+        columns = []
+        for name in hrow or []:
+          column = gpkg_name(name)
+          while column in columns or column in ['fid', 'source', 'geom']:
+            column = '{}_{}'.format(column, len(columns) + 1)
+          columns.append(column)
+        self._create_table(table, columns, geometry is not None)
+        self._tables[table] = columns
+      columns = self._tables[table]
+    if len(columns) < len(hrow or []):
+      columns = self.add_columns(table, len(hrow))
+    return table, columns, geometry
+
+  def _create_table(self, table, columns, geometry):
+    try:
+      self._conn.execute('BEGIN')
+      self._conn.execute(
+        'CREATE TABLE IF NOT EXISTS "{}" ('
+        'fid INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'source TEXT NOT NULL{}{}'
+        ')'.format(
+          table,
+          ''.join([', "{}"'.format(c) for c in columns]),
+          ', geom GEOMETRY' if geometry else ''
+        )
+      )
+      self._conn.execute(
+        'CREATE INDEX IF NOT EXISTS "{0}_source" ON "{0}" (source)'.format(table)
+      )
+      self._conn.execute(
+        'INSERT OR REPLACE INTO gpkg_contents (table_name, data_type, identifier, srs_id) '
+        'VALUES (?, ?, ?, ?)',
+        [table, 'features' if geometry else 'attributes', table, self.srs_id]
+      )
+      if geometry:
+        self._conn.execute(
+          'INSERT OR REPLACE INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, 0, 0)',
+          [table, 'geom', 'GEOMETRY', self.srs_id]
+        )
+        self._create_rtree(table)
+      self._conn.execute('COMMIT')
+    except sqlite3.Error:
+      self._conn.execute('ROLLBACK')
+      msg = '{} {}'.format(self._('Cannot create GeoPackage table'), table)
+      self.logger.error(msg, exc_info=True)
+      raise FileManagerError(msg)
+
+  def _create_rtree(self, table):
+    self._conn.execute(
+      'CREATE VIRTUAL TABLE IF NOT EXISTS "rtree_{}_geom" '
+      'USING rtree(id, minx, maxx, miny, maxy)'.format(table)
+    )
+    for name, trigger in RTREE_TRIGGERS:
+      self._conn.execute(
+        'CREATE TRIGGER IF NOT EXISTS "rtree_{}_geom_{}" {}'.format(
+          table, name, trigger.format(table, RTREE_VALUES)
+        )
+      )
+    # rows of a GeoPackage written before the index existed
+    self._conn.execute(
+      'INSERT OR REPLACE INTO "rtree_{0}_geom" '
+      'SELECT fid, ST_MinX(geom), ST_MaxX(geom), ST_MinY(geom), ST_MaxY(geom) '
+      'FROM "{0}" WHERE geom NOT NULL AND NOT ST_IsEmpty(geom)'.format(table)
+    )
+    self._conn.execute(
+      'INSERT OR IGNORE INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+      [table, 'geom', 'gpkg_rtree_index', RTREE_DEFINITION, 'write-only']
+    )
+
+  def add_columns(self, table, count):
+    with self._lock:
+      columns = self._tables[table]
+      while len(columns) < count:
+        column = 'field_{}'.format(len(columns) + 1)
+        self._conn.execute('ALTER TABLE "{}" ADD COLUMN "{}"'.format(table, column))
+        columns.append(column)
+      return list(columns)
+
+  def insert(self, table, columns, geometry, rows):
+    names = ['source'] + columns + (['geom'] if geometry else [])
+    query = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+      table,
+      ', '.join(['"{}"'.format(n) for n in names]),
+      ', '.join(['?'] * len(names))
+    )
+    with self._lock:
+      try:
+        self._conn.execute('BEGIN')
+        self._conn.executemany(query, rows)
+        self._conn.execute('COMMIT')
+      except sqlite3.Error:
+        self._conn.execute('ROLLBACK')
+        msg = '{} {}'.format(self._('Cannot write to GeoPackage table'), table)
+        self.logger.error(msg, exc_info=True)
+        raise FileManagerError(msg)
+
+  def _delete_source(self, table, source):
+    with self._lock:
+      self._conn.execute('DELETE FROM "{}" WHERE source = ?'.format(table), [source])
+
+  def open_csv_file(self, dir_name, file_name, hrow):
+    table, columns, geometry = self._table(dir_name, file_name, hrow)
+    source = os.path.splitext(file_name)[0]
+    # the results of a source are written again, as files are
+    self._delete_source(table, source)
+    return GeoPackageTableWriter(self, table, source, columns, geometry)
+
+  def _appender(self, file_path, mode='a', hrow=None):
+    writer = self._writers.get(file_path)
+    if writer is None or mode == 'w':
+      if writer is not None:
+        writer.close()
+      if mode == 'w':
+        writer = self.open_csv_file(None, os.path.basename(file_path), hrow)
+      else:
+        table, columns, geometry = self._table(None, os.path.basename(file_path), hrow)
+        writer = GeoPackageTableWriter(
+          self, table, os.path.splitext(os.path.basename(file_path))[0], columns, geometry
+        )
+      self._writers[file_path] = writer
+    return writer
+
+  def copy_csv_file(self, dir_name, file_name, hrow, copy):
+    # the copied csv is spooled to a temporary file, then inserted in batches
+    with tempfile.TemporaryFile('w+', newline='', encoding='utf-8') as csvfile:
+      copy(csvfile)
+      csvfile.seek(0)
+      with self.open_csv_file(dir_name, file_name, hrow) as writer:
+        for row in csv.reader(csvfile):
+          writer.writerow([
+            int(v) if v.lstrip('-').isdigit() else (v if v != '' else None) for v in row
+          ])
+    return writer.rows > 0
+
+  def read_csv_file(self, dir_name, file_name):
+    table = gpkg_name(dir_name or os.path.splitext(file_name)[0])
+    if table not in self._tables:
+      return []
+    with self._lock:
+      return [
+        list(row) for row in self._conn.execute(
+          'SELECT {} FROM "{}" WHERE source = ? ORDER BY fid'.format(
+            ', '.join(['"{}"'.format(c) for c in self._tables[table]]),
+            table
+          ),
+          [os.path.splitext(file_name)[0]]
+        )
+      ]
+
+  def close(self):
+    try:
+      super().close()
+    finally:
+      with self._lock:
+        self._conn.close()
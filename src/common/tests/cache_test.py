@@ -0,0 +1,44 @@
+import unittest
+import gettext
+import os
+import shutil
+from src.common.cache import ResultCache
+
+_ = gettext.gettext
+
+class TestResultCache(unittest.TestCase):
+  def setUp(self):
+    self.cache = ResultCache('_common-tests-cache-test-dir_')
+    self.base_dir = '_common-tests-cache-test-output-dir_'
+    os.makedirs(os.path.join(self.base_dir, 'invalid'), exist_ok=True)
+    with open(os.path.join(self.base_dir, 'invalid', 'points.csv'), 'w') as f:
+      f.write('id\n1\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.cache.cache_dir, ignore_errors=True)
+    shutil.rmtree(self.base_dir, ignore_errors=True)
+
+  def test_key(self):
+    self.assertEqual(
+      self.cache.key('schema', 'points', {'a': 1, 'b': 2}),
+      self.cache.key('schema', 'points', {'b': 2, 'a': 1}),
+      _('key depends on dict order')
+    )
+    self.assertNotEqual(
+      self.cache.key('schema', 'points', '1:1'),
+      self.cache.key('schema', 'points', '1:2'),
+      _('key does not depend on fingerprint')
+    )
+
+  def test_get_missing(self):
+    self.assertIsNone(self.cache.get(self.cache.key('missing')))
+
+  def test_put_restore(self):
+    key = self.cache.key('schema', 'points')
+    f = os.path.join('invalid', 'points.csv')
+    self.cache.put(key, self.base_dir, [f], ['invalid'])
+    os.remove(os.path.join(self.base_dir, f))
+    meta = self.cache.restore(key, self.base_dir)
+    self.assertEqual(meta['data'], ['invalid'])
+    with open(os.path.join(self.base_dir, f)) as restored:
+      self.assertEqual(restored.read(), 'id\n1\n', _('restored file differs'))
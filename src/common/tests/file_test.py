@@ -55,20 +55,54 @@ class TestFileManager(unittest.TestCase):
   def test_append_csv_file(self):
     file_name = 'file_name.csv'
     hrow = ['Header A', 'Header B', 'Header C']
-    self.fman.start_csv_file(file_name, hrow)
-    file_path = os.path.join(self.fman.output_dir, file_name)
+    # every row is written at once
+    fman = FileManager(self.fman.output_dir, flush_rows=1)
+    fman.start_csv_file(file_name, hrow)
+    file_path = os.path.join(fman.output_dir, file_name)
     row = ['1', '1', '1']
-    self.fman.append_csv_file(file_name, row)
+    fman.append_csv_file(file_name, row)
     with open(file_path, 'r', newline = '') as csvfile:
       reader = csv.reader(csvfile)
       next(reader)
       arow = next(reader)
+    fman.close()
     self.assertEqual(
       row,
       arow,
       _('incorrect csv row')
     )
   
+  def test_append_csv_file_buffered(self):
+    file_name = 'buffered.csv'
+    file_path = os.path.join(self.fman.output_dir, file_name)
+    fman = FileManager(self.fman.output_dir, flush_rows=0)
+    fman.start_csv_file(file_name, ['Header A'])
+    for i in range(3):
+      fman.append_csv_file(file_name, [str(i)])
+    with open(file_path, 'r', newline = '') as csvfile:
+      self.assertEqual(len(list(csv.reader(csvfile))), 1)
+    fman.close()
+    with open(file_path, 'r', newline = '') as csvfile:
+      self.assertEqual(
+        list(csv.reader(csvfile)),
+        [['Header A'], ['0'], ['1'], ['2']]
+      )
+    # rows are flushed when the controls fail
+    with self.assertRaises(ValueError):
+      with FileManager(self.fman.output_dir, flush_rows=0) as fman:
+        fman.append_csv_file(file_name, ['3'])
+        raise ValueError()
+    with open(file_path, 'r', newline = '') as csvfile:
+      self.assertEqual(list(csv.reader(csvfile))[-1], ['3'])
+    # rows are buffered by default
+    self.fman.start_csv_file(file_name, ['Header A'])
+    self.fman.append_csv_file(file_name, ['4'])
+    with open(file_path, 'r', newline = '') as csvfile:
+      self.assertEqual(len(list(csv.reader(csvfile))), 1)
+    self.fman.close()
+    with open(file_path, 'r', newline = '') as csvfile:
+      self.assertEqual(list(csv.reader(csvfile)), [['Header A'], ['4']])
+
   def test_write_csv_file(self):
     file_name = 'file_name.csv'
     hrow = ['Header A', 'Header B', 'Header C']
@@ -90,6 +124,23 @@ class TestFileManager(unittest.TestCase):
       _('incorrect csv rows')
     )
 
+  def test_open_csv_file(self):
+    file_name = 'file_name.csv'
+    hrow = ['Header A', 'Header B']
+    rows = (['{}'.format(i), '{}'.format(i * 2)] for i in range(3))
+    with self.fman.open_csv_file(None, file_name, hrow) as writer:
+      for r in rows:
+        writer.writerow(r)
+    self.assertEqual(writer.rows, 3)
+    file_path = os.path.join(self.fman.output_dir, file_name)
+    with open(file_path, 'r', newline = '') as csvfile:
+      arows = list(csv.reader(csvfile))
+    self.assertEqual(
+      [hrow, ['0', '0'], ['1', '2'], ['2', '4']],
+      arows,
+      _('incorrect csv rows')
+    )
+
   def test_write_txt_file(self):
     file_name = 'file_name.txt'
     data = {
@@ -123,4 +174,47 @@ class TestFileManager(unittest.TestCase):
       adata,
       _('incorrect json')
     )
-  
\ No newline at end of file
+  
+  def test_read_csv_file(self):
+    file_name = 'file_name.csv'
+    hrow = ['Header A', 'Header B']
+    rows = [['1', 'a'], ['2', 'b']]
+    self.fman.write_csv_file(None, file_name, hrow, rows)
+    self.assertEqual(
+      self.fman.read_csv_file(None, file_name),
+      rows,
+      _('incorrect csv rows')
+    )
+    self.assertEqual(
+      self.fman.read_csv_file(None, 'missing.csv'),
+      [],
+      _('missing csv file has rows')
+    )
+
+  def test_write_json_file(self):
+    file_name = 'file_name.json'
+    data = {'prop 1': '1', 'prop 2': ['2', '3']}
+    self.fman.write_json_file(file_name, data)
+    file_path = os.path.join(self.fman.output_dir, file_name)
+    self.assertEqual(
+      self.fman.read_json_file(file_path),
+      data,
+      _('incorrect json')
+    )
+
+  def test_copy_csv_file(self):
+    file_name = 'file_name.csv'
+    hrow = ['Header A', 'Header B']
+    self.assertTrue(
+      self.fman.copy_csv_file(None, file_name, hrow, lambda f: f.write('1,a\n2,b\n'))
+    )
+    self.assertEqual(
+      self.fman.read_csv_file(None, file_name),
+      [['1', 'a'], ['2', 'b']],
+      _('incorrect csv rows')
+    )
+    self.assertFalse(self.fman.copy_csv_file(None, file_name, hrow, lambda f: 0))
+    self.assertFalse(
+      os.path.isfile(os.path.join(self.fman.output_dir, file_name)),
+      _('csv file without rows was not removed')
+    )
@@ -0,0 +1,139 @@
+import os
+import shutil
+import struct
+import sqlite3
+import unittest
+
+from src.common.gpkg import (
+  GeoPackageFileManager, WKTError, wkt_to_wkb, gpkg_geometry, gpkg_name
+)
+
+class TestGeoPackageFileManager(unittest.TestCase):
+  def setUp(self):
+    self.output_dir = '_common-tests-gpkg-test-output-dir_'
+    self.fman = GeoPackageFileManager(
+      self.output_dir,
+      batch_size=2,
+      geometry_columns=['location'],
+      point_columns=('x', 'y')
+    )
+
+  def tearDown(self):
+    self.fman.close()
+    shutil.rmtree(self.output_dir, ignore_errors=True)
+
+  def _rows(self, query):
+    conn = sqlite3.connect(os.path.join(self.output_dir, 'results.gpkg'))
+    try:
+      return conn.execute(query).fetchall()
+    finally:
+      conn.close()
+
+  def test_write_csv_file(self):
+    hrow = ['id', 'reason', 'location']
+    rows = [[1, 'Self-intersection', 'POINT(1 2)'], [2, 'Too few points', None], [3, '', None]]
+    self.assertEqual(self.fman.write_csv_file('invalid', 'points.csv', hrow, rows), 3)
+    self.assertEqual(self.fman.write_csv_file('invalid', 'lines.csv', hrow, rows[:1]), 1)
+    self.assertEqual(self.fman.read_csv_file('invalid', 'points.csv'), rows)
+    # sources are written again
+    self.fman.write_csv_file('invalid', 'points.csv', hrow, rows[1:])
+    self.assertEqual(self.fman.read_csv_file('invalid', 'points.csv'), rows[1:])
+    self.assertEqual(
+      self._rows('SELECT source, id FROM invalid ORDER BY fid'),
+      [('lines', 1), ('points', 2), ('points', 3)]
+    )
+    self.assertEqual(
+      self._rows('SELECT data_type FROM gpkg_contents WHERE table_name = \'invalid\''),
+      [('features',)]
+    )
+    self.assertFalse(os.path.isdir(self.fman.add_dir('invalid')))
+
+  def test_copy_csv_file(self):
+    self.assertTrue(
+      self.fman.copy_csv_file('null', 'points.csv', ['id'], lambda f: f.write('1\n2\n'))
+    )
+    self.assertFalse(
+      self.fman.copy_csv_file('null', 'lines.csv', ['id'], lambda f: None)
+    )
+    self.assertEqual(self.fman.read_csv_file('null', 'points.csv'), [[1], [2]])
+    self.assertEqual(
+      self._rows('SELECT data_type FROM gpkg_contents WHERE table_name = \'null\''),
+      [('attributes',)]
+    )
+
+  def test_append_csv_file(self):
+    file_name = 'schema_Control_Height_layer.csv'
+    self.fman.start_csv_file(file_name, ['Layer', 'OBJECTID', 'OBJECTID', 'x', 'y'])
+    self.fman.append_csv_file(file_name, ['layer', 1, 2, 3.0, 4.0])
+    self.fman.append_csv_file(file_name, ['layer', 1, 2, '', '', 'extra'])
+    self.fman.close_csv_file(file_name)
+    self.assertEqual(
+      self._rows(
+        'SELECT objectid, objectid_3, field_6, geom IS NULL '
+        'FROM schema_control_height_layer ORDER BY fid'
+      ),
+      [(1, 2, None, 0), (1, 2, 'extra', 1)]
+    )
+
+  def test_rtree_index(self):
+    hrow = ['id', 'location']
+    rows = [[1, 'POINT(1 2)'], [2, 'LINESTRING(0 0, 3 4)'], [3, None], [4, 'POINT EMPTY']]
+    self.fman.write_csv_file('invalid', 'points.csv', hrow, rows)
+    self.fman.write_csv_file('invalid', 'lines.csv', hrow, rows[:1])
+    self.assertEqual(
+      self._rows('SELECT table_name, column_name, extension_name FROM gpkg_extensions'),
+      [('invalid', 'geom', 'gpkg_rtree_index')]
+    )
+    self.assertEqual(
+      self._rows('SELECT minx, maxx, miny, maxy FROM rtree_invalid_geom ORDER BY id'),
+      [(1.0, 1.0, 2.0, 2.0), (0.0, 3.0, 0.0, 4.0), (1.0, 1.0, 2.0, 2.0)]
+    )
+    # rewritten sources leave no stale entries
+    self.fman.write_csv_file('invalid', 'points.csv', hrow, rows[2:])
+    self.assertEqual(
+      self._rows(
+        'SELECT r.id, i.source FROM rtree_invalid_geom AS r JOIN invalid AS i ON i.fid = r.id'
+      ),
+      [(5, 'lines')]
+    )
+
+class TestGeoPackageFunctions(unittest.TestCase):
+
+  def test_wkt_to_wkb(self):
+    wkb, coords = wkt_to_wkb('POINT(1 2)')
+    self.assertEqual(wkb, struct.pack('<BI2d', 1, 1, 1, 2))
+    self.assertEqual(coords, [[1, 2]])
+    wkb, coords = wkt_to_wkb('POINT Z (1 2 3)')
+    self.assertEqual(wkb, struct.pack('<BI3d', 1, 1001, 1, 2, 3))
+    self.assertEqual(
+      wkt_to_wkb('MULTIPOINT(1 2,3 4)'),
+      wkt_to_wkb('MULTIPOINT((1 2),(3 4))')
+    )
+    wkb, coords = wkt_to_wkb('MULTIPOLYGON(((0 0,1 0,1 1,0 0)),((2 2,3 2,3 3,2 2)))')
+    self.assertEqual(wkb[:9], struct.pack('<BII', 1, 6, 2))
+    self.assertEqual(len(coords), 8)
+    wkb, coords = wkt_to_wkb('GEOMETRYCOLLECTION(POINT(1 2),LINESTRING(0 0,1 1))')
+    self.assertEqual(
+      wkb,
+      struct.pack('<BII', 1, 7, 2) + struct.pack('<BI2d', 1, 1, 1, 2)
+      + struct.pack('<BII4d', 1, 2, 2, 0, 0, 1, 1)
+    )
+    for wkt in ['POINT(1 2', 'CIRCLE(1 2)', 'POINT(1 2))']:
+      with self.assertRaises(WKTError):
+        wkt_to_wkb(wkt)
+
+  def test_gpkg_geometry(self):
+    self.assertIsNone(gpkg_geometry(None))
+    self.assertEqual(
+      gpkg_geometry('LINESTRING(0 1,2 3)', 4326)[:40],
+      struct.pack('<2sBBi4d', b'GP', 0, 3, 4326, 0, 2, 1, 3)
+    )
+    self.assertEqual(
+      gpkg_geometry('GEOMETRYCOLLECTION EMPTY'),
+      struct.pack('<2sBBiBII', b'GP', 0, 0x11, 0, 1, 7, 0)
+    )
+
+  def test_gpkg_name(self):
+    self.assertEqual(gpkg_name('table-1-id'), 'table_1_id')
+    self.assertEqual(gpkg_name('Height_difference'), 'height_difference')
+    self.assertEqual(gpkg_name('-'), 'field')
@@ -0,0 +1,339 @@
+'''
+postgis_controls.main_postgis_benchmark
+'''
+import os
+import sys
+import time
+import shlex
+import shutil
+import argparse
+import gettext
+import logging
+import subprocess
+
+from postgis_controls.enums import Rule
+from postgis_controls.pgdb import PGDBManager, PGDBManagerError, NotAllowedIntersectionsResult
+from postgis_controls.synthetic import (
+  SYNTHETIC_SCHEMA_COMMENT, DEFAULT_RATIOS, synthetic_table_names, synthetic_table_query,
+  synthetic_schema_query, schema_comment_query
+)
+from common.file import FileManager, FileManagerError
+
+_ = gettext.gettext
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TABLE_RULES = [
+  Rule.invalid.value,
+  Rule.duplicate.value,
+  Rule.multipart.value,
+  Rule.null.value
+]
+
+INTERSECT_GEOMETRIES = ['point', 'line', 'polygon', 'collection']
+
+# each benchmark runs once per table, or once per schema
+TABLE_BENCHMARKS = {
+  'invalid': lambda pgdb, schema, table, tables, args:
+    pgdb.get_invalid_geoms_from_table(schema, table),
+  'duplicate': lambda pgdb, schema, table, tables, args:
+    pgdb.get_duplicate_geoms_from_table(schema, table),
+  'duplicate-hash': lambda pgdb, schema, table, tables, args:
+    pgdb.get_duplicate_hash_geoms_from_table(schema, table, args.normalize),
+  'multipart': lambda pgdb, schema, table, tables, args:
+    pgdb.get_multipart_geoms_from_table(schema, table),
+  'null': lambda pgdb, schema, table, tables, args:
+    pgdb.get_null_geoms_from_table(schema, table),
+  'table-rules': lambda pgdb, schema, table, tables, args:
+    pgdb.get_table_rules_from_table(schema, table, TABLE_RULES, args.normalize),
+  'intersect': lambda pgdb, schema, table, tables, args:
+    pgdb.get_not_allowed_intersection(
+      schema,
+      table,
+      tables[tables.index(table) + 1:],
+      None,
+      args.server_admissibility,
+      args.binary
+    )
+}
+
+SCHEMA_BENCHMARKS = {
+  'schema-duplicates': lambda pgdb, schema, tables, args:
+    pgdb.get_duplicate_geoms_from_schema(schema, tables, args.normalize),
+  'schema-intersections': lambda pgdb, schema, tables, args:
+    pgdb.get_not_allowed_intersections_from_schema(
+      schema,
+      tables,
+      None,
+      args.server_admissibility,
+      args.binary
+    )
+}
+
+PIPELINE_BENCHMARKS = {
+  'pipeline-all': Rule.all.value,
+  'pipeline-intersect': Rule.intersect.value
+}
+
+def get_args():
+  ''' Get and return arguments from input. '''
+  parser = argparse.ArgumentParser(
+    description=_(
+      'measure the throughput of the controls over a synthetic schema'
+    )
+  )
+  parser.add_argument('dbname', help=_('database name'))
+  parser.add_argument('dbschema', help=_('synthetic database schema'))
+  parser.add_argument('user', help=_('database user'))
+  parser.add_argument('password', help=_('database password'))
+  parser.add_argument('output', help=_('output folder'))
+  parser.add_argument(
+    '--host',
+    default='localhost',
+    help=_('database host')
+  )
+  parser.add_argument(
+    '--port',
+    type=int,
+    default=5432,
+    help=_('database port')
+  )
+  parser.add_argument(
+    '--generate',
+    action='store_true',
+    help=_('create the synthetic schema again, only schemas it created are dropped'))
+  parser.add_argument(
+    '--tables',
+    type=int,
+    default=3,
+    help=_('number of tables, alternating points, linestrings and polygons'))
+  parser.add_argument(
+    '--features',
+    type=int,
+    default=100000,
+    help=_('number of features of each table'))
+  parser.add_argument(
+    '--vertices',
+    type=int,
+    default=16,
+    help=_('number of vertices of each linestring and polygon'))
+  for kind, ratio in DEFAULT_RATIOS.items():
+    parser.add_argument(
+      '--{}'.format(kind),
+      type=float,
+      default=ratio,
+      help='{} {}'.format(_('ratio of features of kind'), kind))
+  parser.add_argument(
+    '--benchmarks',
+    nargs='+',
+    choices=list(TABLE_BENCHMARKS) + list(SCHEMA_BENCHMARKS) + list(PIPELINE_BENCHMARKS),
+    help=_('benchmarks to run, all of them by default'))
+  parser.add_argument(
+    '--repeat',
+    type=int,
+    default=1,
+    help=_('runs of each benchmark, the fastest one is reported'))
+  parser.add_argument(
+    '--normalize',
+    action='store_true',
+    help=_('normalize geometries before looking for duplicates'))
+  parser.add_argument(
+    '--server-admissibility',
+    action='store_true',
+    help=_('decide if intersections are admissible in the database'))
+  parser.add_argument(
+    '--binary',
+    action='store_true',
+    help=_('fetch intersection geometries as WKB instead of GeoJSON'))
+  parser.add_argument(
+    '--pipeline-options',
+    default='',
+    help=_('options added to every run of the controls pipeline, e.g. "--jobs 4"'))
+  parser.add_argument(
+    '--report',
+    default='benchmark.json',
+    help=_('report file name'))
+  parser.add_argument(
+    '--baseline',
+    help=_('previous report, benchmarks slower than it fail the run'))
+  parser.add_argument(
+    '--tolerance',
+    type=float,
+    default=0.2,
+    help=_('throughput loss against the baseline that is still accepted'))
+  args = parser.parse_args()
+  return args
+
+def initFileManager(out_dir):
+  ''' Initialize and return the file manager. '''
+  fman = None
+  try:
+    fman = FileManager(out_dir)
+  except FileManagerError as err:
+    logger.error('{}: {}'.format(_('ERROR'), str(err)), exc_info=True)
+    fman = None
+  return fman
+
+def initPGDB(host, port, dbname, username, password):
+  ''' Initialize and return the postgis database manager. '''
+  pgdb = None
+  try:
+    pgdb = PGDBManager(host, port, dbname, username, password)
+    pgdb.connect()
+  except PGDBManagerError as err:
+    logger.error('{}: {}'.format(_('ERROR'), str(err)), exc_info=True)
+    pgdb = None
+  return pgdb
+
+def generate_schema(pgdb, dbschema, args):
+  ''' Create the synthetic schema and its tables, and return the table names. '''
+  rows = pgdb.get_query_result(schema_comment_query(dbschema))
+  if rows and rows[0][0] != SYNTHETIC_SCHEMA_COMMENT:
+    raise PGDBManagerError(
+      '{} {}'.format(_('Schema was not created by the benchmark, not dropping it'), dbschema)
+    )
+  ratios = {kind: getattr(args, kind) for kind in DEFAULT_RATIOS}
+  tables = synthetic_table_names(args.tables)
+  pgdb.execute_query(synthetic_schema_query(dbschema))
+  for i, table in enumerate(tables):
+    logger.info('{}: {}'.format(_('Generating'), table))
+    pgdb.execute_query(
+      synthetic_table_query(dbschema, table, i, len(tables), args.features, args.vertices, ratios)
+    )
+    pgdb.create_spatial_index(dbschema, table)
+    pgdb.commit()
+    pgdb.analyze_table(dbschema, table)
+    pgdb.commit()
+  return tables
+
+def result_count(result):
+  ''' Return the number of results of a control. '''
+  if isinstance(result, NotAllowedIntersectionsResult):
+    return sum([len(getattr(result, g)) for g in INTERSECT_GEOMETRIES])
+  if isinstance(result, dict):
+    return sum([result_count(r) for r in result.values()])
+  return len(result)
+
+def run_benchmark(name, features, run, repeat):
+  ''' Run a benchmark, and return the fastest of its runs. '''
+  best = None
+  for i in range(max(repeat, 1)):
+    start = time.perf_counter()
+    results = run()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best['time']:
+      best = {
+        'benchmark': name,
+        'features': features,
+        'results': results,
+        'time': elapsed,
+        'features_per_second': features / elapsed if elapsed > 0 else None
+      }
+  logger.info('{}: {} {:.0f} {}'.format(
+    name, _('throughput'), best['features_per_second'] or 0, _('features/s')
+  ))
+  return best
+
+def benchmark_table_rule(pgdb, name, dbschema, tables, args):
+  ''' Run a control over every table, and return the number of results. '''
+  return sum([
+    result_count(TABLE_BENCHMARKS[name](pgdb, dbschema, table, tables, args))
+    for table in tables
+  ])
+
+def benchmark_schema_rule(pgdb, name, dbschema, tables, args):
+  ''' Run a control over the whole schema, and return the number of results. '''
+  return result_count(SCHEMA_BENCHMARKS[name](pgdb, dbschema, tables, args))
+
+def benchmark_pipeline(fman, rule, dbschema, args):
+  ''' Run the controls pipeline, and return the number of result files. '''
+  output = os.path.join(fman.output_dir, 'pipeline_{}'.format(rule))
+  if os.path.isdir(output):
+    shutil.rmtree(output)
+  command = [
+    sys.executable,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main_postgis_controls.py'),
+    args.dbname,
+    dbschema,
+    args.user,
+    args.password,
+    output,
+    '--host',
+    args.host,
+    '--port',
+    str(args.port),
+    '--rule',
+    rule
+  ] + shlex.split(args.pipeline_options)
+  subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+  return sum([len(files) for path, dirs, files in os.walk(output)])
+
+def compare_baseline(report, baseline, tolerance):
+  ''' Return the benchmarks slower than the baseline. '''
+  previous = {b['benchmark']: b for b in baseline['benchmarks']}
+  regressions = []
+  for b in report['benchmarks']:
+    p = previous.get(b['benchmark'])
+    if not p or not p['features_per_second'] or not b['features_per_second']:
+      continue
+    if b['features_per_second'] < (1 - tolerance) * p['features_per_second']:
+      regressions.append({
+        'benchmark': b['benchmark'],
+        'features_per_second': b['features_per_second'],
+        'baseline': p['features_per_second']
+      })
+  return regressions
+
+if __name__ == '__main__':
+  args = get_args()
+  fman = initFileManager(args.output)
+  if not fman:
+    sys.exit(1)
+  pgdb = initPGDB(args.host, args.port, args.dbname, args.user, args.password)
+  if not pgdb:
+    sys.exit(1)
+  try:
+    if args.generate:
+      tables = generate_schema(pgdb, args.dbschema, args)
+    else:
+      tables = [t[0] for t in pgdb.get_schema_table_names(args.dbschema)]
+    features = sum([pgdb.get_table_count(args.dbschema, table) for table in tables])
+  except PGDBManagerError as err:
+    logger.error('{}: {}'.format(_('ERROR'), str(err)), exc_info=True)
+    pgdb.close()
+    sys.exit(1)
+  logger.info('{}: {} {}, {} {}'.format(
+    args.dbschema, len(tables), _('tables'), features, _('features')
+  ))
+  names = args.benchmarks or (
+    list(TABLE_BENCHMARKS) + list(SCHEMA_BENCHMARKS) + list(PIPELINE_BENCHMARKS)
+  )
+  benchmarks = []
+  for name in names:
+    if name in TABLE_BENCHMARKS:
+      run = lambda: benchmark_table_rule(pgdb, name, args.dbschema, tables, args)
+    elif name in SCHEMA_BENCHMARKS:
+      run = lambda: benchmark_schema_rule(pgdb, name, args.dbschema, tables, args)
+    else:
+      run = lambda: benchmark_pipeline(fman, PIPELINE_BENCHMARKS[name], args.dbschema, args)
+    benchmarks.append(run_benchmark(name, features, run, args.repeat))
+  pgdb.close()
+  report = {
+    'parameters': ' '.join(sys.argv),
+    'tables': len(tables),
+    'features': features,
+    'benchmarks': benchmarks
+  }
+  fman.write_json_file(args.report, report)
+  baseline = fman.read_json_file(args.baseline)
+  if baseline:
+    regressions = compare_baseline(report, baseline, args.tolerance)
+    for r in regressions:
+      logger.error('{}: {} {:.0f} < {:.0f} {}'.format(
+        r['benchmark'], _('throughput regression'), r['features_per_second'],
+        r['baseline'], _('features/s')
+      ))
+    if regressions:
+      sys.exit(1)
+  logger.info('{}.'.format(_('End')))
@@ -1,17 +1,23 @@
 '''
 postgis_controls.main_postgis_controls
 '''
+import os
 import sys
+import shutil
 import argparse
+import asyncio
 import gettext
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from postgis_controls.enums import Rule
+from postgis_controls.apgdb import AsyncPGDBManagerPool
 from postgis_controls.pgdb import (
-  PGDBManager, PGDBManagerError, InvalidGeomResult, DuplicateGeomResult,
-  MultipartGeomResult, NullGeomResult, InvalidGeomResult
+  PGDBManagerPool, PGDBManagerError, NotAllowedIntersectionsResult
 )
 from common.file import FileManager, FileManagerError
+from common.gpkg import GeoPackageFileManager
+from common.cache import ResultCache, ResultCacheError
 from common.time import TimeManager, TimeManagerError, TimeUnit
 
 _ = gettext.gettext
@@ -19,6 +25,30 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+TABLE_RULES = [
+  Rule.invalid.value,
+  Rule.duplicate.value,
+  Rule.multipart.value,
+  Rule.null.value
+]
+
+SCHEMA_DUPLICATES_HEADER = [_('id'), _('amount'), _('table-ref'), _('id-ref')]
+
+INTERSECT_HEADER = [
+  _('table-1'), _('table-1-id'), _('table-2'), _('table-2-id'), 'int', 'err'
+]
+
+INTERSECT_GEOMETRIES = ['point', 'line', 'polygon', 'collection']
+
+INCREMENTAL_STATE = 'state.json'
+
+TABLE_RULES_HEADERS = {
+  Rule.invalid.value: [_('id'), _('reason'), _('location')],
+  Rule.duplicate.value: [_('id'), _('amount')],
+  Rule.multipart.value: [_('id'), _('number')],
+  Rule.null.value: [_('id')]
+}
+
 def get_args():
   ''' Get and return arguments from input. '''
   parser = argparse.ArgumentParser(
@@ -27,10 +57,21 @@ def get_args():
     )
   )
   parser.add_argument('dbname', help=_('database name'))
-  parser.add_argument('dbschema', help=_('database schema'))
+  parser.add_argument(
+    'dbschema',
+    help=_('database schema, or a comma separated list of schemas controlled in batch'))
   parser.add_argument('user', help=_('database user'))
   parser.add_argument('password', help=_('database password'))
   parser.add_argument('output', help=_('output folder'))
+  parser.add_argument(
+    '--schema-pattern',
+    action='store_true',
+    help=_('control in batch all schemas whose name is like dbschema, e.g. "remesa%%"'))
+  parser.add_argument(
+    '--schema-jobs',
+    type=int,
+    default=1,
+    help=_('number of schemas controlled at once in batch, sharing the database connections'))
   parser.add_argument(
     '--host',
     default='localhost',
@@ -62,14 +103,121 @@ def get_args():
   parser.add_argument(
     '--admissibles',
     help=_('admissible intersections file name'))
+  parser.add_argument(
+    '--jobs',
+    type=int,
+    default=1,
+    help=_('number of tables controlled at once, one database connection each'))
+  parser.add_argument(
+    '--batch-size',
+    type=int,
+    default=1000,
+    help=_('number of rows fetched from the database at a time'))
+  parser.add_argument(
+    '--normalize',
+    action='store_true',
+    help=_('normalize geometries before looking for duplicates'))
+  parser.add_argument(
+    '--schema-duplicates',
+    action='store_true',
+    help=_('look for duplicate geometries across all tables of the schema'))
+  parser.add_argument(
+    '--schema-intersections',
+    action='store_true',
+    help=_(
+      'look for intersections between all tables of the schema in a single join, '
+      'their geometries are copied once to a temporary table and any error stops the schema'
+    ))
+  parser.add_argument(
+    '--server-admissibility',
+    action='store_true',
+    help=_('decide if intersections are admissible in the database'))
+  parser.add_argument(
+    '--binary',
+    action='store_true',
+    help=_('fetch intersection geometries as WKB instead of GeoJSON'))
+  parser.add_argument(
+    '--preflight',
+    choices=['check', 'fix'],
+    help=_('check spatial indexes and statistics of the tables, and fix them'))
+  parser.add_argument(
+    '--cache',
+    help=_('results cache folder, unchanged tables are not controlled again'))
+  parser.add_argument(
+    '--cache-fingerprint',
+    choices=['checksum', 'catalog'],
+    default='checksum',
+    help=_(
+      'how table changes are detected, checksum reads all rows, '
+      'catalog relies on the statistics counters of the database, which lag behind '
+      'the last writes, so it is only a best effort'
+    ))
+  parser.add_argument(
+    '--profile',
+    action='store_true',
+    help=_('write the time and rows of every database query next to the summary'))
+  parser.add_argument(
+    '--explain',
+    action='store_true',
+    help=_('also profile the query plans, running the queries twice'))
+  parser.add_argument(
+    '--read-only',
+    action='store_true',
+    help=_(
+      'run each query in its own read only transaction, without savepoints, '
+      'for runs that do not write to the database'
+    ))
+  parser.add_argument(
+    '--gpkg',
+    help=_('GeoPackage file in the output folder all results are written to, instead of csv files'))
+  parser.add_argument(
+    '--gpkg-srid',
+    type=int,
+    default=0,
+    help=_('spatial reference of the result locations in the GeoPackage'))
+  parser.add_argument(
+    '--copy',
+    action='store_true',
+    help=_('write invalid, duplicate, multipart and null results straight from the database'))
+  parser.add_argument(
+    '--async',
+    dest='asynchronous',
+    action='store_true',
+    help=_(
+      'control tables with asynchronous queries, as many at once as jobs, '
+      'the other connections only keep one per schema for the schema queries'
+    ))
+  parser.add_argument(
+    '--tiles',
+    type=int,
+    help=_('split each table in tiles controlled one at a time, tiles per side of the grid or id ranges'))
+  parser.add_argument(
+    '--tile-by',
+    choices=['grid', 'id'],
+    default='grid',
+    help=_('split tables by a grid over their extent or by id ranges'))
+  parser.add_argument(
+    '--incremental',
+    help=_(
+      'previous results folder, only features changed since the previous run '
+      'are controlled, tracked by triggers installed on the tables'
+    ))
   args = parser.parse_args()
   return args
 
-def initFileManager(out_dir, in_dir, rule):
+def initFileManager(out_dir, in_dir, rule, gpkg=None, srid=0):
   ''' Initialize and return the file manager, and create output folders. '''
   fman = None
   try:
-    fman = FileManager(out_dir, '.')
+    if gpkg:
+      fman = GeoPackageFileManager(
+        out_dir,
+        gpkg,
+        geometry_columns=[_('location'), 'int'],
+        srs_id=srid
+      )
+    else:
+      fman = FileManager(out_dir)
     if rule == Rule.invalid.value or rule == Rule.all.value:
       fman.add_dir(Rule.invalid.value)
     if rule == Rule.duplicate.value or rule == Rule.all.value:
@@ -85,22 +233,40 @@ def initFileManager(out_dir, in_dir, rule):
     fman = None
   return fman
 
-def initPGDB(host, port, dbname, username, password):
-  ''' Initialize and return the postgis database manager. '''
-  pgdb = None
+def initPGDB(
+  host, port, dbname, username, password, jobs=1, batch_size=1000, profile=False, explain=False,
+  read_only=False
+  ):
+  ''' Initialize and return the postgis database managers pool. '''
+  pgdbs = None
   try:
-    pgdb = PGDBManager(
+    pgdbs = PGDBManagerPool(
+      jobs,
       host,
       port,
       dbname,
       username,
-      password
+      password,
+      batch_size=batch_size,
+      profile=profile,
+      explain=explain,
+      read_only=read_only
     )
-    pgdb.connect()
+    pgdbs.connect()
   except PGDBManagerError as err:
     logger.error('{}: {}'.format(_('ERROR'), str(err)), exc_info=True)
-    pgdb = None
-  return pgdb
+    pgdbs = None
+  return pgdbs
+
+def initResultCache(cache_dir):
+  ''' Initialize and return the result cache, if a cache folder is given. '''
+  cache = None
+  if cache_dir:
+    try:
+      cache = ResultCache(cache_dir)
+    except ResultCacheError as err:
+      logger.warning('{}: {}'.format(_('WARNING'), str(err)), exc_info=True)
+  return cache
 
 def initSummaryData(in_params, num_tables, summary_data):
   ''' Initialize and return the summary data. ''' 
@@ -113,110 +279,738 @@ def initSummaryData(in_params, num_tables, summary_data):
   summary_data[Rule.intersect.value] = []
   return summary_data
 
+def initTableSummaryData():
+  ''' Initialize and return the summary data of a single table. '''
+  return {
+    Rule.invalid.value: [],
+    Rule.duplicate.value: [],
+    Rule.multipart.value: [],
+    Rule.null.value: [],
+    Rule.intersect.value: []
+  }
+
+def mergeSummaryData(tables_summary, summary_data):
+  ''' Merge the summary data of each table, in table order. '''
+  for table_summary in tables_summary:
+    for rule, table_names in table_summary.items():
+      summary_data[rule].extend(table_names)
+
 def endSummaryData(tman, summary_data):
   ''' Update the process start and end time of the summary data. '''
   summary_data[_('Start time')] = tman.dt_start
   summary_data[_('End time')] = tman.dt_end
 
+def writeProfileData(fman, summary_file, profiles):
+  ''' Write the profile of the database queries next to the summary. '''
+  totals = {}
+  for profile in profiles:
+    key = tuple([profile.get(tag) for tag in ['schema', 'table', 'rule']])
+    if key not in totals:
+      totals[key] = {
+        'schema': key[0],
+        'table': key[1],
+        'rule': key[2],
+        'queries': 0,
+        'rows': 0,
+        'time': 0.0,
+        'savepoint_time': 0.0
+      }
+    totals[key]['queries'] += 1
+    totals[key]['rows'] += max(profile['rows'] or 0, 0)
+    totals[key]['time'] += profile['time']
+    totals[key]['savepoint_time'] += profile['savepoint_time']
+  fman.write_json_file(
+    '{}.profile.json'.format(os.path.splitext(summary_file)[0]),
+    {
+      'totals': sorted(totals.values(), key=lambda total: -total['time']),
+      'queries': profiles
+    }
+  )
+
 def process_result(fman, rule, table, hrow, rows, ks=None):
   ''' Write control result to the detail output file. '''
   if ks:
     for g in ks:
-      if rows[g]:
+      if getattr(rows, g):
         fman.write_csv_file(
           rule,
           '{}_{}.csv'.format(table, g),
           hrow,
-          rows[g].to_list()
+          [row.to_list() for row in getattr(rows, g)]
         )
   else:
     fman.write_csv_file(rule, '{}.csv'.format(table), hrow, rows)
 
-def control_table(fman, pgdb, rule, dbschema, table, tables, admissibles, summary_data):
-  ''' Execute the control to a table. '''
-  if rule == Rule.invalid.value or rule == Rule.all.value:
-    invs = pgdb.get_invalid_geoms_from_table(dbschema, table)
-    if invs:
-      process_result(
-        fman,
-        Rule.invalid.value,
-        table,
-        [_('id'), _('reason'), _('location')],
-        [inv.to_list() for inv in invs]
-      )
-      summary_data[Rule.invalid.value].append(table)
-  if rule == Rule.duplicate.value or rule == Rule.all.value:
-    dups = pgdb.get_duplicate_geoms_from_table(dbschema, table)
-    if dups:
-      process_result(
-        fman,
-        Rule.duplicate.value,
-        table,
-        [_('id'), _('amount')],
-        [dup.to_list() for dup in dups]
-      )
-      summary_data[Rule.duplicate.value].append(table)
-  if rule == Rule.multipart.value or rule == Rule.all.value:
-    muls = pgdb.get_multipart_geoms_from_table(dbschema, table)
-    if muls:
+def preflight_tables(pgdb, dbschema, tables, fix, summary_data):
+  ''' Check spatial indexes and planner statistics, and fix them if asked. '''
+  report = []
+  for table in [t[0] for t in tables]:
+    status = pgdb.get_table_status(dbschema, table)
+    if not status:
+      continue
+    changes = []
+    if not status.spatial_index:
+      if fix:
+        pgdb.create_spatial_index(dbschema, table)
+        changes.append(_('spatial index created'))
+      else:
+        changes.append(_('missing spatial index'))
+    if fix and (not status.spatial_index or status.stale_statistics()):
+      pgdb.analyze_table(dbschema, table)
+      changes.append(_('statistics updated'))
+    elif status.stale_statistics():
+      changes.append(_('stale statistics'))
+    if changes:
+      logger.info('  {}: {}'.format(table, ', '.join(changes)))
+      report.append('{} ({})'.format(table, ', '.join(changes)))
+  if fix:
+    pgdb.commit()
+  summary_data[_('Preflight')] = report
+
+def control_schema_duplicates(fman, pgdb, dbschema, tables, summary_data, args):
+  ''' Execute the duplicate control to all tables of the schema at once. '''
+  table_names = [table[0] for table in tables]
+  writers = {}
+  try:
+    for dup in pgdb.get_duplicate_geoms_from_schema(
+      dbschema, table_names, args.normalize, True
+    ):
+      if dup.table not in writers:
+        writers[dup.table] = fman.open_csv_file(
+          Rule.duplicate.value,
+          '{}.csv'.format(dup.table),
+          SCHEMA_DUPLICATES_HEADER
+        )
+      writers[dup.table].writerow(dup.to_list()[1:])
+  finally:
+    for writer in writers.values():
+      writer.close()
+  summary_data[Rule.duplicate.value].extend(
+    [table for table in table_names if table in writers]
+  )
+
+def control_schema_intersections(fman, pgdb, dbschema, tables, admissibles, summary_data, args):
+  ''' Execute the intersection control to all tables of the schema at once. '''
+  table_names = [table[0] for table in tables]
+  ints = pgdb.get_not_allowed_intersections_from_schema(
+    dbschema,
+    table_names,
+    admissibles,
+    args.server_admissibility,
+    args.binary
+  )
+  for table in table_names:
+    if ints[table]:
       process_result(
         fman,
-        Rule.multipart.value,
+        Rule.intersect.value,
         table,
-        [_('id'), _('number')],
-        [mul.to_list() for mul in muls]
+        INTERSECT_HEADER,
+        ints[table],
+        INTERSECT_GEOMETRIES
       )
-      summary_data[Rule.multipart.value].append(table)
-  if rule == Rule.null.value or rule == Rule.all.value:
-    gmr = pgdb.get_null_geoms_from_table(dbschema, table)
-    if gmr:
-      process_result(fman, Rule.null.value, table, [_('id')], gmr)
-      summary_data[Rule.null.value].append(table)
-  if rule == Rule.intersect.value:
-    i = tables.index(table) + 1
-    if i < len(tables):
+      summary_data[Rule.intersect.value].append(table)
+
+def control_table(fman, pgdb, rule, dbschema, table, tables, admissibles, summary_data, args):
+  ''' Execute the control to a table. '''
+  rules = [r for r in TABLE_RULES if rule == r or rule == Rule.all.value]
+  if args.schema_duplicates and Rule.duplicate.value in rules:
+    rules.remove(Rule.duplicate.value)
+  if rules and args.copy:
+    for r in rules:
+      if fman.copy_csv_file(
+        r,
+        '{}.csv'.format(table),
+        TABLE_RULES_HEADERS[r],
+        lambda f: pgdb.copy_table_rule_from_table(dbschema, table, r, f, args.normalize)
+      ):
+        summary_data[r].append(table)
+  elif rules:
+    writers = {}
+    try:
+      for r, res in pgdb.iter_table_rules_from_table(dbschema, table, rules, args.normalize):
+        if r not in writers:
+          writers[r] = fman.open_csv_file(
+            r,
+            '{}.csv'.format(table),
+            TABLE_RULES_HEADERS[r]
+          )
+        writers[r].writerow(res.to_list())
+    finally:
+      for writer in writers.values():
+        writer.close()
+    for r in rules:
+      if r in writers:
+        summary_data[r].append(table)
+  if rule == Rule.intersect.value and not args.schema_intersections:
+    table_names = [t[0] for t in tables]
+    i = table_names.index(table) + 1
+    if i < len(table_names):
       ints = pgdb.get_not_allowed_intersection(
         dbschema,
         table,
-        tables[i:],
-        admissibles
+        table_names[i:],
+        admissibles,
+        args.server_admissibility,
+        args.binary
       )
       if ints:
         process_result(
           fman,
           Rule.intersect.value,
           table,
-          [_('table-1'), _('table-1-id'), _('table-2'), _('table-2-id'), 'int', 'err'],
+          INTERSECT_HEADER,
           ints,
-          ['point', 'line', 'polygon', 'collection']
+          INTERSECT_GEOMETRIES
         )
         summary_data[Rule.intersect.value].append(table)
 
-if __name__ == '__main__':
-  args = get_args()
-  fman = initFileManager(args.output, '.', args.rule)
-  if not fman:
-    sys.exit()
-  pgdb = initPGDB(
+def control_table_tile(pgdb, rule, dbschema, table, tables, admissibles, tile, args):
+  ''' Execute the control to a tile of a table, and return the results. '''
+  rules = [r for r in TABLE_RULES if rule == r or rule == Rule.all.value]
+  if args.schema_duplicates and Rule.duplicate.value in rules:
+    rules.remove(Rule.duplicate.value)
+  results = {r: [] for r in rules}
+  tile_rules = rules
+  if Rule.duplicate.value in rules and not tile.by_grid():
+    # duplicates share their bounding box, so only grid tiles keep them
+    # together, with id ranges the first tile looks for them in the whole table
+    tile_rules = [r for r in rules if r != Rule.duplicate.value]
+    if tile.index == 0:
+      for r, res in pgdb.iter_table_rules_from_table(
+        dbschema, table, [Rule.duplicate.value], args.normalize
+      ):
+        results[r].append(res)
+  if tile_rules:
+    for r, res in pgdb.iter_table_rules_from_table(
+      dbschema, table, tile_rules, args.normalize, tile=tile
+    ):
+      results[r].append(res)
+  if rule == Rule.intersect.value and not args.schema_intersections:
+    table_names = [t[0] for t in tables]
+    i = table_names.index(table) + 1
+    results[Rule.intersect.value] = NotAllowedIntersectionsResult()
+    if i < len(table_names):
+      results[Rule.intersect.value] = pgdb.get_not_allowed_intersection(
+        dbschema,
+        table,
+        table_names[i:],
+        admissibles,
+        args.server_admissibility,
+        args.binary,
+        tile=tile
+      )
+  return results
+
+def control_tiles(fman, pgdbs, rule, dbschema, tables, admissibles, summary_data, args):
+  ''' Execute the control to all tables split in tiles, as many at once as database managers. '''
+  def table_tiles(table):
+    with pgdbs.manager() as pgdb:
+      return pgdb.get_table_tiles(dbschema, table, args.tiles, args.tile_by == 'grid')
+  with ThreadPoolExecutor(max_workers=pgdbs.size) as executor:
+    tiles = list(executor.map(table_tiles, [t[0] for t in tables]))
+  tasks = [(i, tile) for i in range(len(tables)) for tile in tiles[i]]
+  def control(task):
+    i, tile = task
+    with pgdbs.manager() as pgdb, pgdb.tagged(
+      schema=dbschema, table=tables[i][0], rule=rule, tile=str(tile)
+    ):
+      results = control_table_tile(
+        pgdb, rule, dbschema, tables[i][0], tables, admissibles, tile, args
+      )
+    logger.info('  {} {} {}'.format(tables[i][0], _('tile'), tile))
+    return results
+  tables_summary = [initTableSummaryData() for table in tables]
+  def write_table(i, results):
+    table = tables[i][0]
+    for r in TABLE_RULES:
+      rows = sorted(
+        [row for res in results for row in res.get(r, [])],
+        key=lambda row: row.id
+      )
+      if rows:
+        fman.write_csv_file(
+          r, '{}.csv'.format(table), TABLE_RULES_HEADERS[r], [row.to_list() for row in rows]
+        )
+        tables_summary[i][r].append(table)
+    ints = NotAllowedIntersectionsResult()
+    for g in INTERSECT_GEOMETRIES:
+      # tiles finish in any order, so rows are sorted as the table rules
+      getattr(ints, g).extend(sorted(
+        [
+          row for res in results if Rule.intersect.value in res
+          for row in getattr(res[Rule.intersect.value], g)
+        ],
+        key=lambda row: (row.id1, row.id2, row.table2)
+      ))
+    if ints:
+      process_result(
+        fman, Rule.intersect.value, table, INTERSECT_HEADER, ints, INTERSECT_GEOMETRIES
+      )
+      tables_summary[i][Rule.intersect.value].append(table)
+  # the results of a table are written, and released, as soon as all its
+  # tiles are done
+  pending = [len(t) for t in tiles]
+  results = [[] for table in tables]
+  with ThreadPoolExecutor(max_workers=pgdbs.size) as executor:
+    futures = {executor.submit(control, task): task[0] for task in tasks}
+    for future in as_completed(futures):
+      i = futures.pop(future)
+      results[i].append(future.result())
+      pending[i] -= 1
+      if not pending[i]:
+        write_table(i, results[i])
+        results[i] = None
+  mergeSummaryData(tables_summary, summary_data)
+
+async def control_table_async(
+  fman, pgdbs, rule, dbschema, table, tables, admissibles, summary_data, args
+  ):
+  ''' Execute the control to a table, other tables go on while it waits. '''
+  rules = [r for r in TABLE_RULES if rule == r or rule == Rule.all.value]
+  if args.schema_duplicates and Rule.duplicate.value in rules:
+    rules.remove(Rule.duplicate.value)
+  async with pgdbs.manager() as pgdb:
+    with pgdb.tagged(schema=dbschema, table=table, rule=rule):
+      logger.info('  {}'.format(table))
+      if rules:
+        results = await pgdb.get_table_rules_from_table(dbschema, table, rules, args.normalize)
+        for r in rules:
+          if results[r]:
+            fman.write_csv_file(
+              r,
+              '{}.csv'.format(table),
+              TABLE_RULES_HEADERS[r],
+              [res.to_list() for res in results[r]]
+            )
+            summary_data[r].append(table)
+      if rule == Rule.intersect.value and not args.schema_intersections:
+        table_names = [t[0] for t in tables]
+        i = table_names.index(table) + 1
+        if i < len(table_names):
+          ints = await pgdb.get_not_allowed_intersection(
+            dbschema,
+            table,
+            table_names[i:],
+            admissibles,
+            args.server_admissibility,
+            args.binary
+          )
+          if ints:
+            process_result(
+              fman,
+              Rule.intersect.value,
+              table,
+              INTERSECT_HEADER,
+              ints,
+              INTERSECT_GEOMETRIES
+            )
+            summary_data[Rule.intersect.value].append(table)
+
+async def control_tables_async(
+  fman, rule, dbschema, tables, admissibles, summary_data, args, profiles=None
+  ):
+  ''' Execute the control to all tables with asynchronous queries, as many at once as jobs. '''
+  pgdbs = AsyncPGDBManagerPool(
+    args.jobs,
     args.host,
     args.port,
     args.dbname,
     args.user,
-    args.password
+    args.password,
+    batch_size=args.batch_size,
+    profiles=profiles,
+    read_only=args.read_only
   )
-  if not pgdb:
-    sys.exit()
-  admissibles = fman.read_json_file(args.admissibles)
-  tables = pgdb.get_schema_table_names(args.dbschema)
+  await pgdbs.connect()
+  tables_summary = [initTableSummaryData() for table in tables]
+  try:
+    await asyncio.gather(*[
+      control_table_async(
+        fman, pgdbs, rule, dbschema, tables[i][0], tables, admissibles, tables_summary[i], args
+      )
+      for i in range(len(tables))
+    ])
+  finally:
+    pgdbs.close()
+  mergeSummaryData(tables_summary, summary_data)
+
+def get_table_fingerprints(pgdbs, dbschema, tables, checksum):
+  ''' Return the content fingerprint of each table. '''
+  def fingerprint(table):
+    with pgdbs.manager() as pgdb:
+      return pgdb.get_table_fingerprint(dbschema, table, checksum)
+  table_names = [t[0] for t in tables]
+  with ThreadPoolExecutor(max_workers=pgdbs.size) as executor:
+    return dict(zip(table_names, executor.map(fingerprint, table_names)))
+
+def table_cache_key(cache, rule, dbschema, table, tables, admissibles, fingerprints, args):
+  ''' Return the cache key of the control of a table, or None if it cannot be cached. '''
+  table_names = [t[0] for t in tables]
+  deps = [table]
+  if rule == Rule.intersect.value and not args.schema_intersections:
+    # intersections of a table are looked up in the tables that follow it
+    deps = table_names[table_names.index(table):]
+  if any(fingerprints.get(t) is None for t in deps):
+    return None
+  return cache.key(
+    dbschema,
+    table,
+    rule,
+    {
+      'normalize': args.normalize,
+      'schema_duplicates': args.schema_duplicates,
+      'schema_intersections': args.schema_intersections,
+      'server_admissibility': args.server_admissibility,
+      'binary': args.binary,
+      'admissibles': admissibles if rule == Rule.intersect.value else None
+    },
+    [[t, fingerprints[t]] for t in deps]
+  )
+
+def table_output_files(fman, table, table_summary):
+  ''' Return the detail output files written for a table, relative to the output folder. '''
+  files = []
+  for rule, table_names in table_summary.items():
+    if table not in table_names:
+      continue
+    if rule == Rule.intersect.value:
+      names = ['{}_{}.csv'.format(table, g) for g in INTERSECT_GEOMETRIES]
+    else:
+      names = ['{}.csv'.format(table)]
+    files.extend([
+      os.path.join(rule, name) for name in names
+      if os.path.isfile(os.path.join(fman.output_dir, rule, name))
+    ])
+  return files
+
+def control_tables(fman, pgdbs, rule, dbschema, tables, admissibles, summary_data, args, cache=None):
+  ''' Execute the control to all tables, as many at once as database managers. '''
+  if args.schema_duplicates and rule in [Rule.duplicate.value, Rule.all.value]:
+    with pgdbs.manager() as pgdb, pgdb.tagged(schema=dbschema, rule=Rule.duplicate.value):
+      control_schema_duplicates(fman, pgdb, dbschema, tables, summary_data, args)
+  if args.schema_intersections and rule == Rule.intersect.value:
+    with pgdbs.manager() as pgdb, pgdb.tagged(schema=dbschema, rule=Rule.intersect.value):
+      control_schema_intersections(
+        fman, pgdb, dbschema, tables, admissibles, summary_data, args
+      )
+  if args.tiles:
+    control_tiles(fman, pgdbs, rule, dbschema, tables, admissibles, summary_data, args)
+    return
+  if args.asynchronous:
+    asyncio.run(
+      control_tables_async(
+        fman, rule, dbschema, tables, admissibles, summary_data, args, pgdbs.profiles
+      )
+    )
+    return
+  fingerprints = {}
+  if cache:
+    fingerprints = get_table_fingerprints(
+      pgdbs, dbschema, tables, args.cache_fingerprint == 'checksum'
+    )
+  tables_summary = [initTableSummaryData() for table in tables]
+  def control(i):
+    table = tables[i][0]
+    key = None
+    if cache:
+      key = table_cache_key(
+        cache, rule, dbschema, table, tables, admissibles, fingerprints, args
+      )
+    meta = cache.restore(key, fman.output_dir) if key else None
+    if meta is not None:
+      logger.info('  {} ({})'.format(table, _('cached')))
+      for r in meta['data']:
+        tables_summary[i][r].append(table)
+      return
+    with pgdbs.manager() as pgdb, pgdb.tagged(schema=dbschema, table=table, rule=rule):
+      logger.info('  {}'.format(table))
+      control_table(
+        fman, pgdb, rule, dbschema, table, tables, admissibles, tables_summary[i], args
+      )
+    if key:
+      try:
+        cache.put(
+          key,
+          fman.output_dir,
+          table_output_files(fman, table, tables_summary[i]),
+          [r for r, table_names in tables_summary[i].items() if table in table_names]
+        )
+      except ResultCacheError as err:
+        logger.warning('{}: {}'.format(_('WARNING'), str(err)))
+  with ThreadPoolExecutor(max_workers=pgdbs.size) as executor:
+    list(executor.map(control, range(len(tables))))
+  mergeSummaryData(tables_summary, summary_data)
+
+def incremental_options(rule, tables, admissibles, args):
+  ''' Return the options the previous results of an incremental run depend on. '''
+  return {
+    'rule': rule,
+    'tables': [t[0] for t in tables],
+    'normalize': args.normalize,
+    'server_admissibility': args.server_admissibility,
+    'binary': args.binary,
+    'admissibles': admissibles if rule == Rule.intersect.value else None
+  }
+
+def merge_rows(prev_rows, rows, removed):
+  ''' Return the previous result rows not removed, followed by the new ones. '''
+  return [row for row in prev_rows if not removed(row)] + rows
+
+def control_table_incremental(
+  fman, sman, pgdb, rule, dbschema, table, tables, admissibles, changes, summary_data, args
+  ):
+  ''' Execute the control to the changed features of a table, merged with previous results. '''
+  ids = [change[0] for change in changes.get(table, [])]
+  rules = [r for r in TABLE_RULES if rule == r or rule == Rule.all.value]
+  file_name = '{}.csv'.format(table)
+  prev = {r: sman.read_csv_file(r, file_name) for r in rules}
+  recheck = {r: ids for r in rules}
+  if Rule.duplicate.value in rules and ids:
+    # features reported before may have lost their duplicates
+    recheck[Rule.duplicate.value] = ids + [
+      int(row[0]) for row in prev[Rule.duplicate.value]
+    ]
+  results = {r: [] for r in rules}
+  if ids:
+    # the duplicate rule needs whole duplicate groups, so it gets its own query
+    for rules_ids in [
+      [r for r in rules if r != Rule.duplicate.value],
+      [r for r in rules if r == Rule.duplicate.value]
+    ]:
+      if rules_ids:
+        for r, res in pgdb.iter_table_rules_from_table(
+          dbschema, table, rules_ids, args.normalize, recheck[rules_ids[0]]
+        ):
+          results[r].append(res.to_list())
+  for r in rules:
+    removed = set([str(i) for i in recheck[r]] + [str(row[0]) for row in results[r]])
+    rows = merge_rows(prev[r], results[r], lambda row: str(row[0]) in removed)
+    rows.sort(key=lambda row: int(row[0]))
+    if rows:
+      fman.write_csv_file(r, file_name, TABLE_RULES_HEADERS[r], rows)
+      summary_data[r].append(table)
+  if rule == Rule.intersect.value:
+    table_names = [t[0] for t in tables]
+    later = table_names[table_names.index(table) + 1:]
+    ints_ids = {
+      t: [change[0] for change in changes.get(t, [])] for t in [table] + later
+    }
+    ints = NotAllowedIntersectionsResult()
+    if later and any(ints_ids.values()):
+      ints = pgdb.get_not_allowed_intersection(
+        dbschema,
+        table,
+        later,
+        admissibles,
+        args.server_admissibility,
+        args.binary,
+        ints_ids
+      )
+    changed = set([(t, str(i)) for t, t_ids in ints_ids.items() for i in t_ids])
+    for g in INTERSECT_GEOMETRIES:
+      file_name = '{}_{}.csv'.format(table, g)
+      rows = merge_rows(
+        sman.read_csv_file(Rule.intersect.value, file_name),
+        [row.to_list() for row in getattr(ints, g)],
+        lambda row: (row[0], row[1]) in changed or (row[2], row[3]) in changed
+      )
+      if rows:
+        fman.write_csv_file(Rule.intersect.value, file_name, INTERSECT_HEADER, rows)
+        if table not in summary_data[Rule.intersect.value]:
+          summary_data[Rule.intersect.value].append(table)
+
+def save_incremental_state(fman, sman, tables, options, summary_data):
+  ''' Keep the results of this run as the previous results of the next incremental run. '''
+  state_file = os.path.join(sman.output_dir, INCREMENTAL_STATE)
+  if os.path.isfile(state_file):
+    os.remove(state_file)
+  rules_summary = {r: summary_data[r] for r in TABLE_RULES + [Rule.intersect.value]}
+  for r in rules_summary:
+    shutil.rmtree(sman.get_dir(r), ignore_errors=True)
+    sman.add_dir(r)
+  for table in [t[0] for t in tables]:
+    for f in table_output_files(fman, table, rules_summary):
+      shutil.copyfile(
+        os.path.join(fman.output_dir, f),
+        os.path.join(sman.output_dir, f)
+      )
+  sman.write_json_file(INCREMENTAL_STATE, options)
+
+def control_tables_incremental(
+  fman, pgdbs, rule, dbschema, tables, admissibles, summary_data, args, cache=None
+  ):
+  ''' Execute the control to the features changed since the previous run, if any. '''
+  sman = FileManager(os.path.join(args.incremental, dbschema))
+  options = incremental_options(rule, tables, admissibles, args)
+  with pgdbs.manager() as pgdb:
+    pgdb.setup_changelog(dbschema, [t[0] for t in tables])
+    changes = pgdb.get_changes(dbschema)
+  state = sman.read_json_file(os.path.join(sman.output_dir, INCREMENTAL_STATE))
+  if state != options:
+    logger.info('  {}'.format(_('no previous results, controlling all features')))
+    control_tables(
+      fman, pgdbs, rule, dbschema, tables, admissibles, summary_data, args, cache
+    )
+  else:
+    summary_data[_('Changed features')] = sum([len(c) for c in changes.values()])
+    tables_summary = [initTableSummaryData() for table in tables]
+    def control(i):
+      with pgdbs.manager() as pgdb, pgdb.tagged(
+        schema=dbschema, table=tables[i][0], rule=rule, incremental=True
+      ):
+        logger.info('  {}'.format(tables[i][0]))
+        control_table_incremental(
+          fman, sman, pgdb, rule, dbschema, tables[i][0], tables, admissibles,
+          changes, tables_summary[i], args
+        )
+    with ThreadPoolExecutor(max_workers=pgdbs.size) as executor:
+      list(executor.map(control, range(len(tables))))
+    mergeSummaryData(tables_summary, summary_data)
+  save_incremental_state(fman, sman, tables, options, summary_data)
+  with pgdbs.manager() as pgdb:
+    pgdb.clear_changes(dbschema, changes)
+
+def get_schemas(pgdbs, args):
+  ''' Return the schemas to control, a comma separated list or a pattern. '''
+  if args.schema_pattern:
+    with pgdbs.manager() as pgdb:
+      return pgdb.get_schema_names(args.dbschema)
+  return [schema.strip() for schema in args.dbschema.split(',') if schema.strip()]
+
+def control_schema(fman, pgdbs, dbschema, admissibles, args, cache=None):
+  ''' Execute the control to all tables of a schema, and return its summary data. '''
+  with pgdbs.manager() as pgdb:
+    tables = pgdb.get_schema_table_names(dbschema)
   tman = TimeManager()
+  tman.start()
   summary_data = {}
   initSummaryData(' '.join(sys.argv), len(tables), summary_data)
-  logger.info('{}...'.format(_('Processing')))
+  if args.preflight:
+    logger.info('{} {}...'.format(_('Preflight'), dbschema))
+    with pgdbs.manager() as pgdb, pgdb.tagged(schema=dbschema, rule='preflight'):
+      preflight_tables(pgdb, dbschema, tables, args.preflight == 'fix', summary_data)
+  logger.info('{} {}...'.format(_('Processing'), dbschema))
   logger.info('{}:'.format(_('Tables')))
-  for table in tables:
-    logger.info('  {}'.format(table[0]))
-    control_table(fman, pgdb, args.rule, args.dbschema, table[0], tables, admissibles, summary_data)
+  if args.incremental:
+    control_tables_incremental(
+      fman, pgdbs, args.rule, dbschema, tables, admissibles, summary_data, args, cache
+    )
+  else:
+    control_tables(
+      fman, pgdbs, args.rule, dbschema, tables, admissibles, summary_data, args, cache
+    )
   tman.end()
   endSummaryData(tman, summary_data)
   fman.write_txt_file(args.summary, summary_data)
+  return summary_data
+
+def control_schemas(fman, pgdbs, schemas, admissibles, args, cache=None):
+  ''' Execute the control to each schema in its own folder, and return the combined summary data. '''
+  tman = TimeManager()
+  tman.start()
+  summary_data = {
+    _('Parameters'): ' '.join(sys.argv),
+    _('Number of schemas'): len(schemas)
+  }
+  def control(dbschema):
+    sfman = initFileManager(
+      os.path.join(args.output, dbschema), '.', args.rule, args.gpkg, args.gpkg_srid
+    )
+    if not sfman:
+      return '{}: {}'.format(_('ERROR'), _('Cannot create output dir'))
+    try:
+      with sfman:
+        schema_data = control_schema(sfman, pgdbs, dbschema, admissibles, args, cache)
+    except (PGDBManagerError, FileManagerError) as err:
+      # a failed schema does not stop the others
+      logger.error('{} {}: {}'.format(_('ERROR'), dbschema, str(err)), exc_info=True)
+      return '{}: {}'.format(_('ERROR'), str(err))
+    return {
+      r: schema_data[r] for r in TABLE_RULES + [Rule.intersect.value] if schema_data[r]
+    }
+  with ThreadPoolExecutor(max_workers=max(args.schema_jobs, 1)) as executor:
+    for dbschema, schema_summary in zip(schemas, executor.map(control, schemas)):
+      summary_data[dbschema] = schema_summary
+  tman.end()
+  endSummaryData(tman, summary_data)
+  return summary_data
+
+def pool_size(args, batch):
+  ''' Return the number of connections of the database managers pool. '''
+  schemas = max(args.schema_jobs, 1) if batch else 1
+  if args.asynchronous:
+    # tables run on the asynchronous pool of each schema, so the pool only
+    # serves the schema queries
+    return schemas
+  return args.jobs * schemas
+
+if __name__ == '__main__':
+  args = get_args()
+  if args.asynchronous and sys.platform == 'win32':
+    # the default proactor loop cannot watch the connection sockets
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+  batch = args.schema_pattern or ',' in args.dbschema
+  pgdbs = initPGDB(
+    args.host,
+    args.port,
+    args.dbname,
+    args.user,
+    args.password,
+    pool_size(args, batch),
+    args.batch_size,
+    args.profile,
+    args.explain,
+    args.read_only
+  )
+  if not pgdbs:
+    sys.exit()
+  if args.incremental and (args.schema_duplicates or args.schema_intersections):
+    logger.error('{}: {}'.format(
+      _('ERROR'), _('incremental runs cannot look for schema duplicates or intersections')
+    ))
+    sys.exit()
+  if args.asynchronous and (args.tiles or args.cache or args.copy):
+    logger.error('{}: {}'.format(
+      _('ERROR'), _('asynchronous runs cannot use tiles, the results cache or copy')
+    ))
+    sys.exit()
+  if args.tiles and (args.cache or args.copy):
+    logger.error('{}: {}'.format(
+      _('ERROR'), _('tiled runs cannot use the results cache or copy')
+    ))
+    sys.exit()
+  if args.gpkg and (args.incremental or args.cache):
+    logger.error('{}: {}'.format(
+      _('ERROR'), _('incremental runs and the results cache need csv files, not a GeoPackage')
+    ))
+    sys.exit()
+  if args.read_only and (
+    args.incremental or args.schema_intersections or args.preflight == 'fix'
+    ):
+    logger.error('{}: {}'.format(
+      _('ERROR'),
+      _('read only runs cannot be incremental, look for schema intersections or fix tables')
+    ))
+    sys.exit()
+  if batch:
+    fman = FileManager(args.output)
+  else:
+    fman = initFileManager(args.output, '.', args.rule, args.gpkg, args.gpkg_srid)
+  if not fman:
+    sys.exit()
+  cache = initResultCache(args.cache)
+  admissibles = fman.read_json_file(args.admissibles)
+  if batch:
+    schemas = get_schemas(pgdbs, args)
+    logger.info('{}: {}'.format(_('Schemas'), ', '.join(schemas)))
+    summary_data = control_schemas(fman, pgdbs, schemas, admissibles, args, cache)
+  else:
+    summary_data = control_schema(fman, pgdbs, args.dbschema, admissibles, args, cache)
+  pgdbs.close()
+  fman.close()
+  if batch:
+    fman.write_txt_file(args.summary, summary_data)
+  if pgdbs.profiles is not None:
+    writeProfileData(fman, args.summary, pgdbs.profiles)
   logger.info('{}.'.format(_('End')))
@@ -11,25 +11,35 @@ Attributes:
 
 pyqgis_controls.main_pyqgis_controls
 """
+import os
 import sys
 import argparse
 import json
 import gettext
 import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from qgis.core import QgsApplication, QgsDataSourceUri, QgsVectorLayer
-from qgis.core import QgsGeometry, QgsSpatialIndex, QgsWkbTypes, QgsFeature
+from qgis.core import QgsGeometry, QgsWkbTypes, QgsFeature
 from PyQt5.QtGui import *
 from src.common.time import (
     get_time
 )
 from common.file import FileManager, FileManagerError
+from common.gpkg import GeoPackageFileManager
+from common.cache import ResultCache, ResultCacheError
+from pyqgis_controls.layers import LayerRegistry
+from pyqgis_controls.store import FeatureStore
+from pyqgis_controls.index import index_layer, stable_fids, save_index, load_index
 
 _ = gettext.gettext
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+INDEX_CACHE_FILE = 'index.bin'
+
 def get_args():
     """ Get and return arguments from input. """
     parser = argparse.ArgumentParser(
@@ -54,6 +64,34 @@ def get_args():
     ))
     parser.add_argument('-tol1', '--t1', type=float, default=0.1, help=_('Z lines tolerance'))
     parser.add_argument('-tol2', '--t2', type=float, default=0.01, help=_('Z polygon tolerance'))
+    parser.add_argument('-j', '--jobs', type=int, default=4, help=_(
+        'number of layers indexed at once'
+    ))
+    parser.add_argument('--index-cache', help=_(
+        'spatial indexes cache folder, indexes of unchanged layers are not built again'
+    ))
+    parser.add_argument(
+        '--index-fingerprint', choices=['checksum', 'catalog'], default='checksum', help=_(
+            'how layer changes are detected, checksum reads all rows, '
+            'catalog relies on the statistics counters of the database, which lag behind '
+            'the last writes, so it is only a best effort'
+        ))
+    parser.add_argument(
+        '--feature-store', action='store_true', help=_(
+            'keep geometries and attributes of the indexed layers in memory, '
+            'so index hits are not requested to the database'
+        ))
+    parser.add_argument(
+        '--feature-store-cap', type=int, default=2048, help=_(
+            'memory cap of the feature store in MB, layers above it are read from the database, '
+            '0 for no cap'
+        ))
+    parser.add_argument('--gpkg', help=_(
+        'GeoPackage file in the output folder all errors are written to, instead of csv files'
+    ))
+    parser.add_argument('--flush-rows', type=int, default=1000, help=_(
+        'errors kept in memory before they are written to the output files, 0 to write them at the end'
+    ))
     args = parser.parse_args()
     return args
 
@@ -68,31 +106,98 @@ def qgs_exit(qgs):
     """ Exit PyQGIS. """
     qgs.exitQgis()
 
-def create_indexes(l, u, args):
+def init_index_cache(args):
+    """ Initialize and return the spatial indexes cache and the database manager, if a cache folder is given. """
+    if not args.index_cache:
+        return None, None
+    # psycopg2 is only needed for the cache
+    from postgis_controls.pgdb import PGDBManager, PGDBManagerError
+    try:
+        cache = ResultCache(args.index_cache)
+        pgdb = PGDBManager(
+            args.server, args.port, args.dbname, args.user, args.password, read_only=True)
+        pgdb.connect()
+    except (ResultCacheError, PGDBManagerError) as err:
+        logger.warning('{}: {}'.format(_('WARNING'), str(err)), exc_info=True)
+        return None, None
+    return cache, pgdb
+
+def create_indexes(l, layers, args, cache=None, pgdb=None):
     """ Return list and dictionary with spatial indexes. """
     logger.info('{}.'.format(_('Constructing spatial indexes...')))
 
     dic_featid = {}
     l_ind = {}
 
+    # layers are opened here, and only their feature sources, which are
+    # thread safe, are read by the workers
+    sources = {}
     for i in l:
-        u.setDataSource(args.dbschema, i, "geom")
-        vector_layer = QgsVectorLayer(u.uri(False), i, "postgres")
-        it_features = vector_layer.getFeatures()
-        index = QgsSpatialIndex(it_features)
-        l_ind[i] = index
-
-        all_features = {feature.id(): feature['id'] for feature in vector_layer.getFeatures()}
-        dic_featid[i] = all_features
-
+        sources[i] = (
+            layers.source(args.dbschema, i), layers.layer(args.dbschema, i).fields())
+
+    # indexes are cached by table fingerprint, taken before the workers start
+    keys = {}
+    if cache:
+        from postgis_controls.pgdb import PGDBManagerError
+        for i in l:
+            if not stable_fids(layers.layer(args.dbschema, i)):
+                logger.warning('{}: {}'.format(
+                    _('Spatial index not cached, no single integer primary key'), i))
+                continue
+            try:
+                fingerprint = pgdb.get_table_fingerprint(
+                    args.dbschema, i, args.index_fingerprint == 'checksum')
+            except PGDBManagerError:
+                fingerprint = None
+            if fingerprint:
+                keys[i] = cache.key('spatial-index', args.dbname, args.dbschema, i, fingerprint)
+
+    def build(i):
+        key = keys.get(i)
+        # filling the store needs the features, so cached indexes are not used
+        if key and not layers.store:
+            with tempfile.TemporaryDirectory() as tmp:
+                if cache.restore(key, tmp) is not None:
+                    try:
+                        index, feat_ids = load_index(os.path.join(tmp, INDEX_CACHE_FILE))
+                        logger.info('  {} ({})'.format(i, _('cached')))
+                        return index, feat_ids
+                    except (OSError, EOFError, ValueError):
+                        logger.warning('{} {}'.format(_('Ignoring unreadable spatial index of'), i))
+        index, feat_ids, entries = index_layer(
+            *sources[i], key is not None, layers.store, args.dbschema, i)
+        if key and entries:
+            try:
+                with tempfile.TemporaryDirectory() as tmp:
+                    save_index(os.path.join(tmp, INDEX_CACHE_FILE), entries)
+                    cache.put(key, tmp, [INDEX_CACHE_FILE], {'features': len(entries[0])})
+            except (OSError, ResultCacheError) as err:
+                logger.warning('{}: {}'.format(_('WARNING'), str(err)))
+        return index, feat_ids
+
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        results = executor.map(build, l)
+        for i, (index, feat_ids) in zip(l, results):
+            l_ind[i] = index
+            dic_featid[i] = feat_ids
+
+    if layers.store:
+        logger.info('{}: {:.1f} MB'.format(
+            _('Feature store memory'), layers.store.used() / (1024 * 1024)))
     logger.info('{}.'.format(_('Finished contruction of spatial indexes...')))
     return l_ind, dic_featid
 
-def init_file_manager(out_dir):
+def init_file_manager(out_dir, flush_rows=1000, gpkg=None):
     """ Initialize and return the file manager, and create output folders. """
     fman = None
     try:
-        fman = FileManager(out_dir, '.')
+        if gpkg:
+            fman = GeoPackageFileManager(
+                out_dir, gpkg, batch_size=flush_rows,
+                point_columns=(_('X_Coordinate'), _('Y_Coordinate')))
+        else:
+            fman = FileManager(out_dir, flush_rows=flush_rows)
     except FileManagerError as err:
         logger.error('{}: {}'.format(_('ERROR'), str(err)), exc_info=True)
         fman = None
@@ -102,10 +207,9 @@ def get_intersections_continuity(c, json_cont):
     """ Return list with the layers to intersect, given one layer. """
     return json_cont[c]
 
-def control_1(capa1, uri, args, nom_sal, fman):
+def control_1(capa1, layers, args, nom_sal, fman):
     """ Verify the correct flow of the layer. """
-    uri.setDataSource(args.dbschema, capa1, "geom")
-    capa_eje = QgsVectorLayer(uri.uri(False), capa1, "postgres")
+    capa_eje = layers.layer(args.dbschema, capa1)
     iterador_features = capa_eje.getFeatures()
     cantidad_errores = 0
     for feature in iterador_features:
@@ -173,7 +277,8 @@ def control_1(capa1, uri, args, nom_sal, fman):
                         max_altura = punto_vertice.z()
             altura_anterior = punto_vertice.z()
 
-def control(capa_verificar, c, l_capas_interectar, u, lindx, n_sal, args, df, l_continuity, fman):
+def control(
+        capa_verificar, c, l_capas_interectar, layers, lindx, n_sal, args, df, l_continuity, fman):
     """ Return two list. The first list has the features to be possible max height,
      and the second list possible endorreics. """
     posible_endorreica = []
@@ -206,7 +311,7 @@ def control(capa_verificar, c, l_capas_interectar, u, lindx, n_sal, args, df, l_
             primer_vertice = geometria.vertexAt(0)
             ultimo_vertice = geometria.vertexAt(n_vertices-1)
             (c_1, c_2) = interseccion_misma_z(
-                c, u, primer_vertice, ultimo_vertice, fman, n_sal, feature_id,
+                c, layers, primer_vertice, ultimo_vertice, fman, n_sal, feature_id,
                 indice_capa, args, df, lindx, lc_inter)
 
             contador_intersecciones = c_1 + c_2
@@ -223,7 +328,7 @@ def control(capa_verificar, c, l_capas_interectar, u, lindx, n_sal, args, df, l_
     return (posibles_cotas, posible_endorreica)
 
 def interseccion_misma_z(
-        in_capa, in_uri, v1, v2, fman, n_out, fid, indx, args, df, lindx, lc_inter
+        in_capa, layers, v1, v2, fman, n_out, fid, indx, args, df, lindx, lc_inter
     ):
     """ Return the number of intersection of the first and last vertex with the input layer."""
     altura1 = v1.z()
@@ -233,11 +338,8 @@ def interseccion_misma_z(
     contador1 = 0
     contador2 = 0
 
-    in_uri.setDataSource(args.dbschema, in_capa, "geom")
-    capa_iterar = QgsVectorLayer(in_uri.uri(False), in_capa, "postgres")
-
     lista_i1 = indx.intersects(geom_v1.boundingBox())
-    features_intersect1 = capa_iterar.getFeatures(lista_i1)
+    features_intersect1 = layers.features(args.dbschema, in_capa, lista_i1)
     lista_features_inter1 = []
 
     for feature2 in features_intersect1:
@@ -251,17 +353,17 @@ def interseccion_misma_z(
     if contador1 == 2:
         # If exists two intersection, check the continuity
         # Verify if the features have the same atributes
-        if same_feat(lista_features_inter1, capa_iterar):
+        if same_feat(lista_features_inter1, layers, args.dbschema, in_capa):
             f = QgsFeature(fid)
             f.setGeometry(geom_v1)
 
             # Chequeo si intersecta otra capa de las definidas
-            if not interseccion_todas_capas(in_capa, f, lc_inter, lindx, args):
+            if not interseccion_todas_capas(in_capa, f, lc_inter, lindx, layers, args):
                 bandera_repetido = True
                 fman.append_csv_file(n_out, [in_capa, fid, _('Error - Continuity'), '', ''])
 
     lista_i2 = indx.intersects(geom_v2.boundingBox())
-    features_intersect2 = capa_iterar.getFeatures(lista_i2)
+    features_intersect2 = layers.features(args.dbschema, in_capa, lista_i2)
     lista_features_inter2 = []
 
     for feature2 in features_intersect2:
@@ -272,20 +374,20 @@ def interseccion_misma_z(
             lista_features_inter2.append(feature2.id())
             interseccion_misma_z2(in_capa, geom_inter, altura2, fid, fman, n_out, args)
     if contador2 == 2:
-        if ((not bandera_repetido) and (same_feat(lista_features_inter2, capa_iterar))):
+        if ((not bandera_repetido) and (same_feat(lista_features_inter2, layers, args.dbschema, in_capa))):
             f = QgsFeature(fid)
             f.setGeometry(geom_v2)
 
             # Verify if intersects with the other layers
-            if not interseccion_todas_capas(in_capa, f, lc_inter, lindx, args):
+            if not interseccion_todas_capas(in_capa, f, lc_inter, lindx, layers, args):
                 fman.append_csv_file(n_out, [in_capa, fid, _('Error - Continuity'), '', ''])
 
     return (contador1, contador2)
 
-def same_feat(lf, c):
+def same_feat(lf, layers, schema, c):
     """ Return True if the two features have the same atributes. """
-    feat1 = c.getFeature(lf[0])
-    feat2 = c.getFeature(lf[1])
+    feat1 = layers.feature(schema, c, lf[0])
+    feat2 = layers.feature(schema, c, lf[1])
     return feat1.attributes()[1:] == feat2.attributes()[1:]
 
 def interseccion_misma_z2(c, g, altura, fid, fman, n_out, args):
@@ -324,7 +426,7 @@ def interseccion_misma_z2(c, g, altura, fid, fman, n_out, args):
                         abs(punto.z() - altura), punto.x(), punto.y()])
                 break
 
-def is_max_height(c, c_nom, l_fid, l_ci, l_index, args):
+def is_max_height(c, c_nom, l_fid, l_ci, l_index, layers, args):
     """ Return list of errors of nodes whos have not the max height. """
     id_itera = []
     alt_itera = []
@@ -333,7 +435,7 @@ def is_max_height(c, c_nom, l_fid, l_ci, l_index, args):
         id_itera.append(fid[0])
         alt_itera.append(fid[0])
     count = 0
-    it_feat3 = c.getFeatures(id_itera)
+    it_feat3 = layers.features(args.dbschema, c_nom, id_itera)
     for feat_id in it_feat3:
         geom_f = feat_id.geometry()
         vertices_f = geom_f.vertices()
@@ -343,32 +445,27 @@ def is_max_height(c, c_nom, l_fid, l_ci, l_index, args):
             if p_verti.z() > alt_itera[count]:
                 encontre = True
         if encontre:
-            ritc = interseccion_todas_capas(c_nom, feat_id, l_ci, l_index, args)
+            ritc = interseccion_todas_capas(c_nom, feat_id, l_ci, l_index, layers, args)
             if not ritc:
                 resultado.append([
                     c_nom, feat_id['id'], _('Error - Node with no maximum height'), '', '', '', ''])
         count = count + 1
     return resultado
 
-def is_endorreics(c, le, u, geom_remesa, l_index, l_inter, args):
+def is_endorreics(c, le, layers, geom_remesa, l_index, l_inter, args):
     """ Return list of endorheic currents."""
-    u.setDataSource(args.dbschema, c, "geom")
-    capa = QgsVectorLayer(u.uri(False), c, "postgres")
     resultado = []
     for e in le:
-        f = capa.getFeature(e)
+        f = layers.feature(args.dbschema, c, e)
         fid = f['id']
         if not f.geometry().intersects(geom_remesa):
-            existe_inter = interseccion_todas_capas(c, f, l_inter, l_index, args)
+            existe_inter = interseccion_todas_capas(c, f, l_inter, l_index, layers, args)
             if not existe_inter:
                 resultado.append([c, fid, _('Error - Endorheic'), '', '', '', ''])
     return resultado
 
-def interseccion_todas_capas(c, f, lc, l_index, args):
+def interseccion_todas_capas(c, f, lc, l_index, layers, args):
     """ Return true if exist intesection with other layers, false otherwise. """
-    uri2 = QgsDataSourceUri()
-    uri2.setConnection(args.server, str(args.port), args.dbname, args.user, args.password)
-
     geom = f.geometry()
     bbox_geom = geom.boundingBox()
 
@@ -376,20 +473,17 @@ def interseccion_todas_capas(c, f, lc, l_index, args):
         if cap != c:
             index_capa = l_index[cap]
             lfea = index_capa.intersects(bbox_geom)
-            uri2.setDataSource(args.dbschema, cap, "geom")
-            capa_inter = QgsVectorLayer(uri2.uri(False), cap, 'postgres')
             if lfea != []:
-                it_feat = capa_inter.getFeatures(lfea)
+                it_feat = layers.features(args.dbschema, cap, lfea)
                 for f_inter in it_feat:
                     geom_inter = f_inter.geometry()
                     if geom_inter.intersects(geom):
                         return True
     return False
 
-def control_4(capa_4, uri, indices, args, nam_sal, lista_intersectar, fman):
+def control_4(capa_4, layers, indices, args, nam_sal, lista_intersectar, fman):
     """ Verify that the height is constant. """
-    uri.setDataSource(args.dbschema, capa_4, "geom")
-    capa_eje = QgsVectorLayer(uri.uri(False), capa_4, "postgres")
+    capa_eje = layers.layer(args.dbschema, capa_4)
     iterador_features = capa_eje.getFeatures()
 
     hrow = [_('Input_Layer'), _('OBJECTID'), _('Description'), _('Intersection_Layer'),
@@ -423,18 +517,15 @@ def control_4(capa_4, uri, indices, args, nam_sal, lista_intersectar, fman):
             for capa in lista_intersectar:
                 intersectar_capa(
                     capa, geometria_feature, alt_total, capa_4,
-                    feature['id'], uri, indices, args, fman, nam_sal)
+                    feature['id'], layers, indices, args, fman, nam_sal)
 
 def intersectar_capa(
-        c, g_f, altura_pol, c_original, fea_original, uri, indexs, args, fman, nam_sal):
+        c, g_f, altura_pol, c_original, fea_original, layers, indexs, args, fman, nam_sal):
     """ Intersect with layer verifing that the height is the same. """
-    uri.setDataSource(args.dbschema, c, "geom")
-    capa_cargada = QgsVectorLayer(uri.uri(False), c, "postgres")
-
     index = indexs[c]
     hay_error = False
     lista_resultante = index.intersects(g_f.boundingBox())
-    features_intersect = capa_cargada.getFeatures(lista_resultante)
+    features_intersect = layers.features(args.dbschema, c, lista_resultante)
     for f in features_intersect:
         if g_f.intersects(f.geometry()):
             geom_interseccion = g_f.intersection(f.geometry())
@@ -494,9 +585,13 @@ if __name__ == '__main__':
     # start qgis
     qgs = qgs_init(args.dirqgis)
 
-    # uri conection db
+    # uri conection db, layers are opened once and shared by all controls
     uri = QgsDataSourceUri()
     uri.setConnection(args.server, str(args.port), args.dbname, args.user, args.password)
+    store = None
+    if args.feature_store:
+        store = FeatureStore(args.feature_store_cap * 1024 * 1024)
+    layers = LayerRegistry(uri, store=store)
 
     # load configuration
     f_config = load_config(args.conf)
@@ -505,39 +600,49 @@ if __name__ == '__main__':
     l_ind = {}
     d_feat = {}
     l_continuity = f_config["continuidad"]
-    fman = init_file_manager(args.output)
+    fman = init_file_manager(args.output, args.flush_rows, args.gpkg)
     consignment_geometry = get_geometry_layer(args.rem)
 
-    l_ind, d_feat = create_indexes(f_config["indices"], uri, args)
-
-    # iteration of layers to verify control 1, 2, 3
-    for name_l_flow in f_config["flujo"]:
-        date_time = get_time().strftime("%Y%m%d_%H%M%S_")
-        logger.info('{}: {}.'.format(_('Control 1,2,3: Verifing layer'), name_l_flow))
-        uri.setDataSource(args.dbschema, name_l_flow, "geom")
-        layer_check = QgsVectorLayer(uri.uri(False), name_l_flow, "postgres")
-        result_name = args.dbschema + '_' + date_time \
-            + 'Control_Vertex_Height_' + name_l_flow +'.csv'
-        cotas, endorreicas = control(
-            layer_check, name_l_flow, f_config["endorreicas"],
-            uri, l_ind, result_name, args, d_feat, l_continuity, fman)
-        r_cota = is_max_height(
-            layer_check, name_l_flow, cotas, f_config["endorreicas"], l_ind, args)
-        r_endo = is_endorreics(
-            name_l_flow, endorreicas, uri, consignment_geometry,
-            l_ind, f_config["endorreicas"], args)
-        fman.append_csv_file(result_name, r_cota)
-        fman.append_csv_file(result_name, r_endo)
-
-        control_1(name_l_flow, uri, args, result_name, fman)
-
-    # iteration of layers to verify control 4
-    for name_l_constant_height in f_config["altura_area"]:
-        date_time = get_time().strftime("%Y%m%d_%H%M%S_")
-        logger.info('{}: {}.'.format(_('Control 4: Verifing layer'), name_l_constant_height))
-        result_name = args.dbschema + '_' + date_time + 'Control_Polygon_Height_' \
-            + name_l_constant_height +'.csv'
-        control_4(name_l_constant_height, uri, l_ind, args, result_name, f_config["flujo"], fman)
+    index_cache, pgdb = init_index_cache(args)
+    l_ind, d_feat = create_indexes(f_config["indices"], layers, args, index_cache, pgdb)
+    if pgdb:
+        pgdb.close()
+    if store:
+        fman.write_json_file(args.dbschema + '_feature_store.json', store.report())
+
+    # output files stay open while their layer is controlled, and the errors
+    # already found are written even if a control fails
+    with fman, layers:
+        # iteration of layers to verify control 1, 2, 3
+        for name_l_flow in f_config["flujo"]:
+            date_time = get_time().strftime("%Y%m%d_%H%M%S_")
+            logger.info('{}: {}.'.format(_('Control 1,2,3: Verifing layer'), name_l_flow))
+            layer_check = layers.layer(args.dbschema, name_l_flow)
+            result_name = args.dbschema + '_' + date_time \
+                + 'Control_Vertex_Height_' + name_l_flow +'.csv'
+            cotas, endorreicas = control(
+                layer_check, name_l_flow, f_config["endorreicas"],
+                layers, l_ind, result_name, args, d_feat, l_continuity, fman)
+            r_cota = is_max_height(
+                layer_check, name_l_flow, cotas, f_config["endorreicas"], l_ind, layers, args)
+            r_endo = is_endorreics(
+                name_l_flow, endorreicas, layers, consignment_geometry,
+                l_ind, f_config["endorreicas"], args)
+            fman.append_csv_file(result_name, r_cota)
+            fman.append_csv_file(result_name, r_endo)
+
+            control_1(name_l_flow, layers, args, result_name, fman)
+            fman.close_csv_file(result_name)
+
+        # iteration of layers to verify control 4
+        for name_l_constant_height in f_config["altura_area"]:
+            date_time = get_time().strftime("%Y%m%d_%H%M%S_")
+            logger.info('{}: {}.'.format(_('Control 4: Verifing layer'), name_l_constant_height))
+            result_name = args.dbschema + '_' + date_time + 'Control_Polygon_Height_' \
+                + name_l_constant_height +'.csv'
+            control_4(
+                name_l_constant_height, layers, l_ind, args, result_name, f_config["flujo"], fman)
+            fman.close_csv_file(result_name)
 
     logger.info('{}.'.format(_('End')))
     # exit qgis
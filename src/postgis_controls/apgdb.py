@@ -0,0 +1,293 @@
+'''
+postgis_controls.apgdb
+'''
+
+import time
+import asyncio
+import logging
+import gettext
+import psycopg2
+import psycopg2.extensions
+from contextlib import asynccontextmanager
+
+from .pgdb import (
+  InvalidGeomResult, DuplicateGeomResult, MultipartGeomResult, NullGeomResult,
+  NotAllowedIntersectionsResult, invalid_geoms_query, duplicate_geoms_query,
+  duplicate_hash_geoms_query, multipart_geoms_query, null_geoms_query,
+  table_rules_query, table_row_results, ResultSet, TABLE_RULES_RESULTS,
+  PGDBManager, PGDBManagerError
+)
+
+# seconds between polls of a connection when the loop cannot watch its socket
+POLL_INTERVAL = 0.005
+
+class AsyncPGDBManager(PGDBManager):
+  # asynchronous connections run every statement in its own transaction and
+  # cannot use named cursors, so results are fetched whole
+
+  async def _wait(self):
+    loop = asyncio.get_running_loop()
+    fd = self._conn.fileno()
+    while True:
+      state = self._conn.poll()
+      if state == psycopg2.extensions.POLL_OK:
+        return
+      ready = loop.create_future()
+      def done():
+        if not ready.done():
+          ready.set_result(None)
+      if state == psycopg2.extensions.POLL_READ:
+        add, remove = loop.add_reader, loop.remove_reader
+      elif state == psycopg2.extensions.POLL_WRITE:
+        add, remove = loop.add_writer, loop.remove_writer
+      else:
+        raise psycopg2.OperationalError('poll() returned {}'.format(state))
+      try:
+        add(fd, done)
+      except NotImplementedError:
+        # loops without socket readers, as the proactor loop on windows,
+        # poll the connection instead
+        await self._poll_wait()
+        continue
+      try:
+        await ready
+      except asyncio.CancelledError:
+        self._conn.cancel()
+        raise
+      finally:
+        remove(fd)
+
+  async def _poll_wait(self):
+    try:
+      await asyncio.sleep(POLL_INTERVAL)
+    except asyncio.CancelledError:
+      self._conn.cancel()
+      raise
+
+  async def connect(self):
+    try:
+      self._conn = psycopg2.connect(self._connstr(), async_=1)
+      await self._wait()
+      self._cursor = self._conn.cursor()
+      if self.read_only:
+        # asynchronous connections cannot use set_session
+        await self.execute_query('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+    except Exception:
+      self._conn = None
+      self._cursor = None
+      msg = '{} {}'.format(self._('Cannot connect to database'), self.dbname)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+
+  async def execute_query(self, query):
+    self._cursor.execute(query)
+    await self._wait()
+
+  async def get_query_result(self, query):
+    start = time.perf_counter()
+    await self.execute_query(query)
+    rows = self._cursor.fetchall()
+    if self.profiles is not None:
+      elapsed = time.perf_counter() - start
+      # there are no savepoints, and queries are not explained since that
+      # would run them again
+      self.profiles.append(dict(
+        self._tags,
+        query=query,
+        rows=len(rows),
+        time=elapsed,
+        wall_time=elapsed,
+        savepoint_time=0.0
+      ))
+    return rows
+
+  async def _get_results(self, query, result, msg):
+    try:
+      rows = await self.get_query_result(query)
+    except Exception:
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+    return [result(row) for row in rows]
+
+  async def get_invalid_geoms_from_table(self, schema, table):
+    return ResultSet(InvalidGeomResult, await self._get_results(
+      invalid_geoms_query(schema, table),
+      lambda row: InvalidGeomResult(row[0], row[1], row[2]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve features with invalid geometries from table'),
+        schema,
+        table
+      )
+    ))
+
+  async def get_duplicate_geoms_from_table(self, schema, table):
+    return ResultSet(DuplicateGeomResult, await self._get_results(
+      duplicate_geoms_query(schema, table),
+      lambda row: DuplicateGeomResult(row[0], row[1]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve  features with duplicate geometries from table'),
+        schema,
+        table
+      )
+    ))
+
+  async def get_duplicate_hash_geoms_from_table(self, schema, table, normalize=False):
+    return ResultSet(DuplicateGeomResult, await self._get_results(
+      duplicate_hash_geoms_query(schema, table, normalize),
+      lambda row: DuplicateGeomResult(row[0], row[1]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve  features with duplicate geometries from table'),
+        schema,
+        table
+      )
+    ))
+
+  async def get_multipart_geoms_from_table(self, schema, table):
+    return ResultSet(MultipartGeomResult, await self._get_results(
+      multipart_geoms_query(schema, table),
+      lambda row: MultipartGeomResult(row[0], row[1]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve features with multipart geometries from table'),
+        schema,
+        table
+      )
+    ))
+
+  async def get_null_geoms_from_table(self, schema, table):
+    return ResultSet(NullGeomResult, await self._get_results(
+      null_geoms_query(schema, table),
+      lambda row: NullGeomResult(row[0]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve features with null geometries from table'),
+        schema,
+        table
+      )
+    ))
+
+  async def get_table_rules_from_table(
+    self, schema, table, rules, normalize=False, ids=None, tile=None
+    ):
+    rows = await self._get_results(
+      table_rules_query(schema, table, rules, normalize, ids, tile),
+      lambda row: row,
+      '{} {}.{}'.format(
+        self._('Cannot retrieve features that break rules from table'),
+        schema,
+        table
+      )
+    )
+    results = {rule: ResultSet(TABLE_RULES_RESULTS[rule]) for rule in rules}
+    for row in rows:
+      for rule, result in table_row_results(row):
+        results[rule].append(result)
+    return results
+
+  async def get_not_allowed_intersection(
+    self, schema, table, tables, admissibles, server_side=False, binary=False, ids=None,
+    tile=None
+    ):
+    values = NotAllowedIntersectionsResult()
+    for table2, query in self._intersection_queries(
+      schema, table, tables, admissibles, server_side, binary, ids, tile
+    ):
+      geoms = {}
+      try:
+        rows = await self.get_query_result(query)
+        for i in range(0, len(rows), self.batch_size):
+          self._add_intersection_batch(
+            values,
+            table,
+            table2,
+            rows[i:i + self.batch_size],
+            admissibles,
+            geoms,
+            server_side,
+            binary
+          )
+          # let other controls go on between batches
+          await asyncio.sleep(0)
+      except Exception:
+        msg = '{0} {1}.{2} {1}.{3}'.format(
+          self._('Cannot retrieve intersection geometries between tables'),
+          schema,
+          table,
+          table2
+        )
+        self.logger.error(msg, exc_info=True)
+        raise PGDBManagerError(msg)
+    return values
+
+class AsyncPGDBManagerPool:
+
+  def __init__(
+    self,
+    size=1,
+    host='localhost',
+    port=5432,
+    dbname=None,
+    username='postgres',
+    password=None,
+    logger=None,
+    batch_size=1000,
+    profiles=None,
+    read_only=False
+    ):
+    # parameters
+    self.size = max(size, 1)
+    self.host = host
+    self.port = port
+    self.dbname = dbname
+    self.username = username
+    self.password = password
+    self.logger = logger or logging.getLogger(__name__)
+    self.batch_size = batch_size
+    self.profiles = profiles
+    self.read_only = read_only
+    # internal
+    self._pgdbs = []
+    self._free = []
+    self._semaphore = None
+    self._ = gettext.gettext
+
+  async def connect(self):
+    pgdbs = [
+      AsyncPGDBManager(
+        self.host,
+        self.port,
+        self.dbname,
+        self.username,
+        self.password,
+        self.logger,
+        self.batch_size,
+        self.profiles,
+        read_only=self.read_only
+      )
+      for i in range(self.size)
+    ]
+    results = await asyncio.gather(
+      *[pgdb.connect() for pgdb in pgdbs], return_exceptions=True
+    )
+    self._pgdbs = pgdbs
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+      self.close()
+      raise errors[0]
+    self._free = list(pgdbs)
+    self._semaphore = asyncio.Semaphore(self.size)
+
+  def close(self):
+    for pgdb in self._pgdbs:
+      pgdb.close()
+    self._pgdbs = []
+    self._free = []
+
+  @asynccontextmanager
+  async def manager(self):
+    if not self._pgdbs:
+      raise PGDBManagerError(self._('Connection pool is not connected'))
+    async with self._semaphore:
+      pgdb = self._free.pop()
+      try:
+        yield pgdb
+      finally:
+        self._free.append(pgdb)
@@ -2,13 +2,84 @@
 vector.sources.py
 '''
 
+import sys
+import time
 import psycopg2
 import uuid
 import json
 import logging
 import gettext
+import queue
+import itertools
+from array import array
+from contextlib import contextmanager
+
+from .enums import Rule
+from .wkb import decode_wkb, decode_wkb_batch
+
+# vertex comparison precision of the binary intersection path, same as the
+# 3 decimals of the GeoJSON path
+WKB_TOLERANCE = 0.001
+
+# fraction of rows modified since the last analyze that makes statistics stale
+STALE_STATISTICS_RATIO = 0.1
+
+# schema holding the features changed since the last incremental run
+CHANGELOG_SCHEMA = 'controls_changelog'
+
+class ResultSet:
+  def __init__(self, result, results=None):
+    # parameters
+    self.result = result
+    # internal, one column per result field, numbers in typed arrays and
+    # repeated strings interned
+    self._fields = result.__slots__
+    typecodes = getattr(result, 'typecodes', {})
+    interned = getattr(result, 'interned', ())
+    self._columns = [array(typecodes[f]) if f in typecodes else [] for f in self._fields]
+    self._interned = [f in interned for f in self._fields]
+    self._size = 0
+    if results:
+      self.extend(results)
+
+  def append(self, result):
+    for i, field in enumerate(self._fields):
+      value = getattr(result, field)
+      if self._interned[i] and isinstance(value, str):
+        value = sys.intern(value)
+      try:
+        self._columns[i].append(value)
+      except (TypeError, OverflowError):
+        # not an integer, the column falls back to a list
+        self._columns[i] = list(self._columns[i])
+        self._columns[i].append(value)
+    self._size += 1
+
+  def extend(self, results):
+    for result in results:
+      self.append(result)
+
+  def column(self, field):
+    return self._columns[self._fields.index(field)]
+
+  def __len__(self):
+    return self._size
+
+  def __getitem__(self, i):
+    return self.result(*[column[i] for column in self._columns])
+
+  def __iter__(self):
+    for row in zip(*self._columns):
+      yield self.result(*row)
+
+  def to_list(self):
+    return [result.to_list() for result in self]
 
 class InvalidGeomResult:
+  __slots__ = ('id', 'reason', 'location')
+  typecodes = {'id': 'q'}
+  interned = ('reason',)
+
   def __init__(self, id=None, reason=None, location=None):
     self.id = id
     self.reason = reason
@@ -23,6 +94,9 @@ class InvalidGeomResult:
     return [self.id, self.reason, self.location]
 
 class DuplicateGeomResult:
+  __slots__ = ('id', 'number')
+  typecodes = {'id': 'q', 'number': 'q'}
+
   def __init__(self, id=None, number=None):
     self.id = id
     self.number = number
@@ -34,7 +108,32 @@ class DuplicateGeomResult:
   def to_list(self):
     return [self.id, self.number]
 
+class SchemaDuplicateGeomResult:
+  __slots__ = ('table', 'id', 'number', 'table_ref', 'id_ref')
+  typecodes = {'id': 'q', 'number': 'q', 'id_ref': 'q'}
+  interned = ('table', 'table_ref')
+
+  def __init__(self, table=None, id=None, number=None, table_ref=None, id_ref=None):
+    self.table = table
+    self.id = id
+    self.number = number
+    self.table_ref = table_ref
+    self.id_ref = id_ref
+
+  def from_list(self, arr):
+    self.table = arr[0]
+    self.id = arr[1]
+    self.number = arr[2]
+    self.table_ref = arr[3]
+    self.id_ref = arr[4]
+
+  def to_list(self):
+    return [self.table, self.id, self.number, self.table_ref, self.id_ref]
+
 class MultipartGeomResult:
+  __slots__ = ('id', 'number')
+  typecodes = {'id': 'q', 'number': 'q'}
+
   def __init__(self, id=None, number=None):
     self.id = id
     self.number = number
@@ -47,6 +146,9 @@ class MultipartGeomResult:
     return [self.id, self.number]
 
 class NullGeomResult:
+  __slots__ = ('id',)
+  typecodes = {'id': 'q'}
+
   def __init__(self, id=None):
     self.id = id
   
@@ -56,22 +158,59 @@ class NullGeomResult:
   def to_list(self):
     return [self.id]
 
+class TableStatusResult:
+  __slots__ = ('table', 'spatial_index', 'last_analyze', 'live_rows', 'modified_rows')
+
+  def __init__(
+    self, table=None, spatial_index=None, last_analyze=None, live_rows=None, modified_rows=None
+    ):
+    self.table = table
+    self.spatial_index = spatial_index
+    self.last_analyze = last_analyze
+    self.live_rows = live_rows
+    self.modified_rows = modified_rows
+
+  def from_list(self, arr):
+    self.table = arr[0]
+    self.spatial_index = arr[1]
+    self.last_analyze = arr[2]
+    self.live_rows = arr[3]
+    self.modified_rows = arr[4]
+
+  def to_list(self):
+    return [
+      self.table,
+      self.spatial_index,
+      self.last_analyze,
+      self.live_rows,
+      self.modified_rows
+    ]
+
+  def stale_statistics(self, ratio=STALE_STATISTICS_RATIO):
+    if self.last_analyze is None:
+      return True
+    return (self.modified_rows or 0) > ratio * max(self.live_rows or 0, 1)
+
 class IntersectGeomResult:
+  __slots__ = ('table1', 'id1', 'table2', 'id2', 'int_geom', 'msg')
+  typecodes = {'id1': 'q', 'id2': 'q'}
+  interned = ('table1', 'table2', 'msg')
+
   def __init__(self, table1=None, id1=None, table2=None, id2=None, int_geom=None, msg=None):
     self.table1 = table1
     self.id1 = id1
     self.table2 = table2
     self.id2 = id2
-    self.int_geom - int_geom
+    self.int_geom = int_geom
     self.msg = msg
   
   def from_list(self, arr):
     self.table1 = arr[0]
     self.id1 = arr[1]
-    self.table2 = arr[1]
-    self.id2 = arr[2]
-    self.int_geom = arr[3]
-    self.msg = arr[4]
+    self.table2 = arr[2]
+    self.id2 = arr[3]
+    self.int_geom = arr[4]
+    self.msg = arr[5]
   
   def to_list(self):
     return [
@@ -79,16 +218,64 @@ class IntersectGeomResult:
       self.id1,
       self.table2,
       self.id2,
-      self.int_geom,
+      str(self.int_geom) if self.int_geom is not None else None,
       self.msg
     ]
 
 class NotAllowedIntersectionsResult:
-  def __init_(self, point=[], line=[], polygon=[], collection=[]):
-    self.point = point
-    self.line = line
-    self.polygon = polygon
-    self.collection = collection
+  def __init__(self, point=None, line=None, polygon=None, collection=None):
+    self.point = ResultSet(IntersectGeomResult, point)
+    self.line = ResultSet(IntersectGeomResult, line)
+    self.polygon = ResultSet(IntersectGeomResult, polygon)
+    self.collection = ResultSet(IntersectGeomResult, collection)
+
+  def __bool__(self):
+    return bool(self.point or self.line or self.polygon or self.collection)
+
+class TableTile:
+  def __init__(
+    self, index=0, count=1, envelope=None, srid=0, limits=None, ids=None, nulls=False
+    ):
+    self.index = index
+    self.count = count
+    # grid tiles, a feature belongs to the tile holding its bounding box min
+    # corner, limits are (xmin, ymin, xmax, ymax) with None at the grid edges
+    self.envelope = envelope
+    self.srid = srid
+    self.limits = limits
+    # id range tiles, (first id, end id) with None at the range edges
+    self.ids = ids
+    # the tile also holding null and empty geometries
+    self.nulls = nulls
+
+  def by_grid(self):
+    return self.envelope is not None
+
+  def sql(self, prefix=''):
+    geom = '{}geom'.format(prefix)
+    conds = []
+    if self.envelope:
+      conds.append('{} && ST_MakeEnvelope({}, {}, {}, {}, {})'.format(
+        geom, *[repr(c) for c in self.envelope], self.srid
+      ))
+      for coord, op, limit in zip(
+        ['ST_XMin', 'ST_YMin', 'ST_XMin', 'ST_YMin'],
+        ['>=', '>=', '<', '<'],
+        self.limits
+      ):
+        if limit is not None:
+          conds.append('{}({}) {} {}'.format(coord, geom, op, repr(limit)))
+    if self.ids:
+      for op, limit in zip(['>=', '<'], self.ids):
+        if limit is not None:
+          conds.append('{}id {} {}'.format(prefix, op, limit))
+    sql = ' AND '.join(conds) if conds else 'true'
+    if self.nulls:
+      sql = '(({}) OR {} IS NULL OR ST_IsEmpty({}))'.format(sql, geom, geom)
+    return sql
+
+  def __str__(self):
+    return '{}/{}'.format(self.index + 1, self.count)
 
 def invalid_geoms_query(schema, table):
   return (
@@ -128,6 +315,330 @@ def null_geoms_query(schema, table):
       'ORDER BY id'
     ).format(schema, table)
 
+def catalog_params(prepared, *values):
+  # prepared statements take the values as parameters
+  if prepared:
+    return ['${}'.format(i + 1) for i in range(len(values))]
+  return ["'{}'".format(value) for value in values]
+
+def prepare_query(name, query, params):
+  return 'PREPARE {}({}) AS {}'.format(name, ', '.join(['text'] * params), query)
+
+def execute_prepared_query(name, values):
+  return 'EXECUTE {}({})'.format(name, ', '.join(catalog_params(False, *values)))
+
+def schema_tables_query(schema, prepared=False):
+  return (
+      'SELECT tablename '
+      'FROM pg_tables '
+      'WHERE schemaname = {} '
+      'ORDER BY tablename'
+    ).format(*catalog_params(prepared, schema))
+
+def schema_names_query(pattern, prepared=False):
+  return (
+      'SELECT nspname '
+      'FROM pg_namespace '
+      'WHERE nspname LIKE {} '
+      "AND nspname NOT LIKE 'pg\\_%' "
+      "AND nspname NOT IN ('information_schema', '{}') "
+      'ORDER BY nspname'
+    ).format(catalog_params(prepared, pattern)[0], CHANGELOG_SCHEMA)
+
+def table_status_query(schema, table, prepared=False):
+  return (
+      'SELECT '
+      '{1}, '
+      'EXISTS ('
+      'SELECT 1 '
+      'FROM pg_indexes '
+      'WHERE schemaname = {0} AND tablename = {1} '
+      "AND indexdef ILIKE '%USING gist (geom)%'"
+      '), '
+      'GREATEST(s.last_analyze, s.last_autoanalyze), '
+      's.n_live_tup, '
+      's.n_mod_since_analyze '
+      'FROM pg_stat_user_tables AS s '
+      'WHERE s.schemaname = {0} AND s.relname = {1}'
+    ).format(*catalog_params(prepared, schema, table))
+
+def table_count_query(schema, table):
+  return 'SELECT COUNT(*) FROM {}.{}'.format(schema, table)
+
+def table_fingerprint_query(schema, table, checksum=False, prepared=False):
+  # both fingerprints cover the child tables, as table_rules_query reads them
+  if checksum:
+    # order independent sum of row hashes, so no sort is needed
+    return (
+        'SELECT '
+        "count(*) || ':' || "
+        "COALESCE(sum(('x' || substr(md5(t::text), 1, 16))::bit(64)::bigint::numeric), 0) "
+        'FROM {0}.{1} AS t'
+      ).format(schema, table)
+  # statistics counters are sent by the server with some delay, so a write
+  # just committed may not change this fingerprint yet
+  return (
+      'WITH RECURSIVE rels AS ('
+      'SELECT c.oid '
+      'FROM pg_class AS c '
+      'JOIN pg_namespace AS n ON n.oid = c.relnamespace '
+      'WHERE n.nspname = {0} AND c.relname = {1} '
+      'UNION ALL '
+      'SELECT i.inhrelid '
+      'FROM pg_inherits AS i '
+      'JOIN rels ON i.inhparent = rels.oid'
+      ') '
+      'SELECT string_agg('
+      "c.relfilenode || ':' || "
+      "COALESCE(s.n_tup_ins, 0) || ':' || "
+      "COALESCE(s.n_tup_upd, 0) || ':' || "
+      "COALESCE(s.n_tup_del, 0), ',' ORDER BY c.oid"
+      ') '
+      'FROM rels '
+      'JOIN pg_class AS c ON c.oid = rels.oid '
+      'LEFT JOIN pg_stat_user_tables AS s ON s.relid = c.oid'
+    ).format(*catalog_params(prepared, schema, table))
+
+# tiles cover the table and its children, as table_rules_query reads them
+def table_extent_query(schema, table):
+  return (
+      'SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e), '
+      '(SELECT ST_SRID(geom) FROM {0}.{1} WHERE geom IS NOT NULL LIMIT 1) '
+      'FROM (SELECT ST_Extent(geom) AS e FROM {0}.{1}) AS x'
+    ).format(schema, table)
+
+def table_id_range_query(schema, table):
+  return 'SELECT min(id), max(id) FROM {}.{}'.format(schema, table)
+
+def grid_tiles(extent, srid, size):
+  xs = [extent[0] + (extent[2] - extent[0]) * i / size for i in range(size)] + [extent[2]]
+  ys = [extent[1] + (extent[3] - extent[1]) * j / size for j in range(size)] + [extent[3]]
+  return [
+    TableTile(
+      j * size + i,
+      size * size,
+      (xs[i], ys[j], xs[i + 1], ys[j + 1]),
+      srid,
+      (
+        xs[i] if i > 0 else None,
+        ys[j] if j > 0 else None,
+        xs[i + 1] if i < size - 1 else None,
+        ys[j + 1] if j < size - 1 else None
+      ),
+      nulls=(i == 0 and j == 0)
+    )
+    for j in range(size) for i in range(size)
+  ]
+
+def id_range_tiles(first, last, size):
+  step = max(1, -(-(last - first + 1) // size))
+  limits = list(range(first + step, last + 1, step))
+  limits = [None] + limits + [None]
+  return [
+    TableTile(i, len(limits) - 1, ids=(limits[i], limits[i + 1]))
+    for i in range(len(limits) - 1)
+  ]
+
+def normalized_geom(geom, normalize=False):
+  return 'ST_Normalize({})'.format(geom) if normalize else geom
+
+def geom_fingerprint(geom):
+  return 'md5(ST_AsEWKB({}))'.format(geom)
+
+def duplicate_hash_geoms_query(schema, table, normalize=False):
+  return (
+      'SELECT id, row '
+      'FROM ('
+      'SELECT t.id, ROW_NUMBER() OVER(PARTITION BY c.fp, ST_AsEWKB({}) ORDER BY t.id asc) AS row '
+      'FROM ('
+      'SELECT id, fp, COUNT(*) OVER(PARTITION BY fp) AS n '
+      'FROM ('
+      'SELECT id, {} AS fp '
+      'FROM ONLY {}.{} '
+      'WHERE geom IS NOT NULL'
+      ') fps'
+      ') c '
+      'JOIN ONLY {}.{} AS t ON t.id = c.id '
+      'WHERE c.n > 1'
+      ') dups '
+      'WHERE dups.row > 1 '
+      'ORDER BY id'
+    ).format(
+      normalized_geom('t.geom', normalize),
+      geom_fingerprint(normalized_geom('geom', normalize)),
+      schema,
+      table,
+      schema,
+      table
+    )
+
+def schema_duplicate_geoms_query(schema, tables, normalize=False):
+  fps = ' UNION ALL '.join([
+    (
+      "SELECT '{0}' AS tname, id, {2} AS fp "
+      'FROM ONLY {1}.{0} '
+      'WHERE geom IS NOT NULL'
+    ).format(table, schema, geom_fingerprint(normalized_geom('geom', normalize)))
+    for table in tables
+  ])
+  cands = ' UNION ALL '.join([
+    (
+      'SELECT c.tname, c.id, c.fp, ST_AsEWKB({2}) AS wkb '
+      'FROM c '
+      "JOIN ONLY {1}.{0} AS t ON c.tname = '{0}' AND t.id = c.id"
+    ).format(table, schema, normalized_geom('t.geom', normalize))
+    for table in tables
+  ])
+  return (
+      'WITH c AS ('
+      'SELECT tname, id, fp '
+      'FROM ('
+      'SELECT tname, id, fp, COUNT(*) OVER(PARTITION BY fp) AS n '
+      'FROM ({}) fps'
+      ') counts '
+      'WHERE n > 1'
+      ') '
+      'SELECT tname, id, row, ftname, fid '
+      'FROM ('
+      'SELECT tname, id, '
+      'ROW_NUMBER() OVER w AS row, '
+      'FIRST_VALUE(tname) OVER w AS ftname, '
+      'FIRST_VALUE(id) OVER w AS fid '
+      'FROM ({}) cands '
+      'WINDOW w AS (PARTITION BY fp, wkb ORDER BY tname, id)'
+      ') dups '
+      'WHERE dups.row > 1 '
+      'ORDER BY tname, id'
+    ).format(fps, cands)
+
+def ids_sql(ids):
+  return "'{{{}}}'::bigint[]".format(','.join([str(i) for i in ids]))
+
+def table_rules_filter_sql(schema, table, ids, duplicate, tile=None):
+  conds = []
+  if ids is not None and duplicate:
+    # duplicate groups must be complete, so take every feature with the same
+    # bounding box as the given ones, which duplicates always share
+    conds.append((
+        'id IN ('
+        'SELECT t.id '
+        'FROM ONLY {0}.{1} AS t '
+        'JOIN ONLY {0}.{1} AS c ON t.geom ~= c.geom '
+        'WHERE c.id = ANY({2})'
+        ')'
+      ).format(schema, table, ids_sql(ids)))
+  elif ids is not None:
+    conds.append('id = ANY({})'.format(ids_sql(ids)))
+  if tile is not None:
+    conds.append(tile.sql())
+  return ' WHERE {}'.format(' AND '.join(conds)) if conds else ''
+
+def table_rules_query(schema, table, rules, normalize=False, ids=None, tile=None):
+  invalid = Rule.invalid.value in rules
+  duplicate = Rule.duplicate.value in rules
+  multipart = Rule.multipart.value in rules
+  null = Rule.null.value in rules
+  cols = ['id']
+  conds = []
+  if invalid:
+    cols.append('ST_IsValidDetail(geom) AS vd')
+    conds.append('(vd).valid = false')
+  if multipart:
+    cols.append('ST_NumGeometries(geom) AS num')
+    conds.append('num > 1')
+  if null:
+    cols.append('geom IS NULL AS nul')
+    conds.append('nul')
+  # child tables are read as by the per rule queries, and OFFSET 0 keeps the
+  # planner from flattening the scan, which would call ST_IsValidDetail once
+  # for each of its fields
+  scan = 'SELECT {} FROM {}.{}{} OFFSET 0'.format(
+    ', '.join(cols), schema, table, table_rules_filter_sql(schema, table, ids, duplicate, tile)
+  )
+  if duplicate:
+    # duplicates only compare the features of the table itself, as
+    # duplicate_geoms_query, and their exact geometries are only compared
+    # when their fingerprint is repeated, as duplicate_hash_geoms_query
+    cols.extend([
+      'geom',
+      "CASE WHEN tableoid = '{}.{}'::regclass THEN {} END AS fp".format(
+        schema, table, geom_fingerprint(normalized_geom('geom', normalize))
+      )
+    ])
+    scan = (
+      'SELECT *, '
+      'CASE WHEN n > 1 THEN ROW_NUMBER() OVER('
+      'PARTITION BY fp, CASE WHEN n > 1 THEN ST_AsEWKB({}) END ORDER BY id asc'
+      ') ELSE 0 END AS dup '
+      'FROM ('
+      'SELECT *, CASE WHEN fp IS NULL THEN 0 ELSE COUNT(*) OVER(PARTITION BY fp) END AS n '
+      'FROM (SELECT {} FROM {}.{}{} OFFSET 0) scan'
+      ') counts'
+    ).format(
+      normalized_geom('geom', normalize),
+      ', '.join(cols),
+      schema,
+      table,
+      table_rules_filter_sql(schema, table, ids, duplicate, tile)
+    )
+    conds.insert(1 if invalid else 0, 'dup > 1')
+  return (
+      'SELECT id, '
+      '{}, {}, {}, '
+      '{}, '
+      '{}, '
+      '{} '
+      'FROM ({}) rules '
+      'WHERE {} '
+      'ORDER BY id'
+    ).format(
+      '(vd).valid = false' if invalid else 'false',
+      '(vd).reason' if invalid else 'NULL',
+      'ST_AsText((vd).location)' if invalid else 'NULL',
+      'dup' if duplicate else '0',
+      'num' if multipart else '0',
+      'nul' if null else 'false',
+      scan,
+      ' OR '.join(conds) if conds else 'false'
+    )
+
+# detail file columns of each rule, from the columns of table_rules_query
+TABLE_RULES_COLUMNS = {
+  Rule.invalid.value: 'id, reason, location',
+  Rule.duplicate.value: 'id, dup',
+  Rule.multipart.value: 'id, num',
+  Rule.null.value: 'id'
+}
+
+def table_rule_copy_query(schema, table, rule, normalize=False, ids=None, tile=None):
+  return (
+      'COPY ('
+      'SELECT {} '
+      'FROM ({}) AS r(id, invalid, reason, location, dup, num, nul) '
+      'ORDER BY id'
+      ') TO STDOUT WITH CSV'
+    ).format(
+      TABLE_RULES_COLUMNS[rule],
+      table_rules_query(schema, table, [rule], normalize, ids, tile)
+    )
+
+TABLE_RULES_RESULTS = {
+  Rule.invalid.value: InvalidGeomResult,
+  Rule.duplicate.value: DuplicateGeomResult,
+  Rule.multipart.value: MultipartGeomResult,
+  Rule.null.value: NullGeomResult
+}
+
+def table_row_results(row):
+  if row[1]:
+    yield Rule.invalid.value, InvalidGeomResult(row[0], row[2], row[3])
+  if row[4] and row[4] > 1:
+    yield Rule.duplicate.value, DuplicateGeomResult(row[0], row[4])
+  if row[5] and row[5] > 1:
+    yield Rule.multipart.value, MultipartGeomResult(row[0], row[5])
+  if row[6]:
+    yield Rule.null.value, NullGeomResult(row[0])
+
 def point_in_geojson_geom(point, geom):
   if geom['type'] == 'LineString':
     return point in geom['coordinates']
@@ -142,30 +653,284 @@ def point_in_geojson_geom(point, geom):
           return True
   return False
 
-def intersection_query(schema, table1, table2):
+def geojson_vertices(geom):
+  if geom['type'] == 'LineString':
+    return geom['coordinates']
+  elif geom['type'] == 'Polygon' or geom['type'] == 'MultiLineString':
+    return [point for coords in geom['coordinates'] for point in coords]
+  elif geom['type'] == 'MultiPolygon':
+    return [point for pols in geom['coordinates'] for coords in pols for point in coords]
+  return []
+
+class VertexIndex:
+  def __init__(self, vertices, tolerance=None):
+    self.tolerance = tolerance
+    self._vertices = set([self._key(v) for v in vertices])
+
+  def _key(self, point):
+    if self.tolerance:
+      return tuple([round(c / self.tolerance) for c in point])
+    return tuple(point)
+
+  def __contains__(self, point):
+    return self._key(point) in self._vertices
+
+  def __len__(self):
+    return len(self._vertices)
+
+def point_in_vertex_index(point, index):
+  return point in index
+
+def intersection_pairs_query(schema, table1, table2, ids=None, tile=None):
+  pairs = (
+    'SELECT '
+    't1.id AS t1id, '
+    't2.id AS t2id, '
+    't1.geom AS g1, '
+    't2.geom AS g2, '
+    'ST_Intersection(t1.geom, t2.geom) AS gi, '
+    'ST_Crosses(t1.geom, t2.geom) AS t1_crosses_t2 '
+    'FROM {0}.{1} AS t1, {0}.{2} AS t2 '
+    'WHERE ST_Intersects(t1.geom, t2.geom) AND NOT ST_Touches(t1.geom, t2.geom)'
+  ).format(schema, table1, table2)
+  if tile is not None:
+    pairs = '{} AND {}'.format(pairs, tile.sql('t1.'))
+  if ids is None:
+    return '{} ORDER BY t1.id'.format(pairs)
+  # only the pairs with a given feature of either table, as two indexed joins
+  return (
+    '({0} AND t1.id = ANY({1})) '
+    'UNION ALL '
+    '({0} AND t2.id = ANY({2}) AND NOT t1.id = ANY({1})) '
+    'ORDER BY t1id'
+  ).format(pairs, ids_sql(ids[0]), ids_sql(ids[1]))
+
+def intersection_query(schema, table1, table2, ids=None, tile=None):
+  return (
+    'SELECT '
+    't1id, '
+    't2id, '
+    'ST_AsGeoJSON(gi, 3), '
+    'ST_AsGeoJSON(g1, 3), '
+    'ST_AsGeoJSON(g2, 3), '
+    'ST_AsText(ST_Multi(gi)), '
+    't1_crosses_t2, '
+    'ST_Dimension(gi) '
+    'FROM ({}) AS foo'
+  ).format(intersection_pairs_query(schema, table1, table2, ids, tile))
+
+def binary_geoms_sql(admissible):
+  if admissible == 'false':
+    return 'NULL, NULL'
+  cond = (
+    "{} AND t1_crosses_t2 AND ST_GeometryType(gi) IN ('ST_Point', 'ST_LineString')"
+  ).format(admissible)
+  return (
+    'CASE WHEN {0} THEN ST_AsBinary(g1) END, '
+    'CASE WHEN {0} THEN ST_AsBinary(g2) END'
+  ).format(cond)
+
+def intersection_wkb_query(schema, table1, table2, admissible='true', ids=None, tile=None):
+  return (
+    'SELECT '
+    't1id, '
+    't2id, '
+    'ST_AsBinary(gi), '
+    '{}, '
+    't1_crosses_t2, '
+    'ST_Dimension(gi) '
+    'FROM ({}) AS foo'
+  ).format(
+    binary_geoms_sql(admissible),
+    intersection_pairs_query(schema, table1, table2, ids, tile)
+  )
+
+def schema_layers_query(schema, tables, layers):
+  return (
+    'CREATE TEMP TABLE {} AS {}'
+  ).format(
+    layers,
+    ' UNION ALL '.join([
+      (
+        "SELECT {0} AS ord, '{1}'::text AS layer, id, geom::geometry AS geom "
+        'FROM {2}.{1} '
+        'WHERE geom IS NOT NULL'
+      ).format(i, table, schema)
+      for i, table in enumerate(tables)
+    ])
+  )
+
+def schema_intersection_pairs_query(layers):
+  return (
+    'SELECT '
+    't1.layer AS layer1, '
+    't2.layer AS layer2, '
+    't1.id AS t1id, '
+    't2.id AS t2id, '
+    't1.geom AS g1, '
+    't2.geom AS g2, '
+    'ST_Intersection(t1.geom, t2.geom) AS gi, '
+    'ST_Crosses(t1.geom, t2.geom) AS t1_crosses_t2 '
+    'FROM {0} AS t1 JOIN {0} AS t2 '
+    'ON t1.ord < t2.ord '
+    'WHERE ST_Intersects(t1.geom, t2.geom) AND NOT ST_Touches(t1.geom, t2.geom) '
+    'ORDER BY t1.ord, t2.ord, t1.id'
+  ).format(layers)
+
+def schema_intersection_query(layers):
   return (
     'SELECT '
-    't1id,'
-    't2id,'
-    'ST_AsGeoJSON(gi, 3),'
-    'ST_AsGeoJSON(g1, 3),'
-    'ST_AsGeoJSON(g2, 3),'
-    'ST_AsText(ST_Multi(gi)),'
-    't1_crosses_t2,'
-    'ST_Dimension(gi)'
+    't1id, '
+    't2id, '
+    'ST_AsGeoJSON(gi, 3), '
+    'ST_AsGeoJSON(g1, 3), '
+    'ST_AsGeoJSON(g2, 3), '
+    'ST_AsText(ST_Multi(gi)), '
+    't1_crosses_t2, '
+    'ST_Dimension(gi), '
+    'layer1, '
+    'layer2 '
+    'FROM ({}) AS foo'
+  ).format(schema_intersection_pairs_query(layers))
+
+def schema_intersection_wkb_query(layers, admissibles):
+  return (
+    'SELECT '
+    't1id, '
+    't2id, '
+    'ST_AsBinary(gi), '
+    '{}, '
+    't1_crosses_t2, '
+    'ST_Dimension(gi), '
+    'layer1, '
+    'layer2 '
+    'FROM ({}) AS foo'
+  ).format(
+    binary_geoms_sql(admissible_sql(admissibles, 'layer2')),
+    schema_intersection_pairs_query(layers)
+  )
+
+def vertex_match_sql(vertex, point, digits=3):
+  return ' AND '.join([
+    'round({0}({1})::numeric, {3}) IS NOT DISTINCT FROM round({0}({2})::numeric, {3})'.format(
+      f, vertex, point, digits
+    )
+    for f in ['ST_X', 'ST_Y', 'ST_Z']
+  ])
+
+def admissible_sql(admissibles, column):
+  if not admissibles:
+    return 'false'
+  return '{} IN ({})'.format(
+    column,
+    ', '.join(["'{}'".format(a) for a in admissibles])
+  )
+
+def admissibility_query(pairs, admissible, layers=False):
+  return (
+    'SELECT '
+    't1id, '
+    't2id, '
+    'msg, '
+    'ST_AsText(ST_Multi(gi)), '
+    'ST_Dimension(gi), '
+    "ST_GeometryType(gi) = 'ST_GeometryCollection'{} "
     'FROM ('
-      'SELECT '
-      't1.id AS t1id,'
-      't2.id AS t2id,'
-      't1.geom AS g1,'
-      't2.geom AS g2,'
-      'ST_Intersection(t1.geom, t2.geom) AS gi,'
-      'ST_Crosses(t1.geom, t2.geom) AS t1_crosses_t2'
-      'FROM {0}.{1} AS t1, {0}.{2} AS t2'
-      'WHERE ST_Intersects(t1.geom, t2.geom) AND NOT ST_Touches(t1.geom, t2.geom)'
-      'ORDER BY t1.id'
-    ') AS foo'
-  ).format(schema, table1, table2)
+      'SELECT *, CASE '
+      'WHEN NOT ({}) '
+      "THEN 'not addmissible intersection' "
+      'WHEN NOT t1_crosses_t2 '
+      "THEN 'invalid addmissible intersection' "
+      "WHEN ST_GeometryType(gi) NOT IN ('ST_Point', 'ST_LineString') "
+      "THEN 'result intersection is not point or line' "
+      'WHEN NOT ('
+        "(ST_GeometryType(g1) IN ('ST_LineString', 'ST_MultiLineString') "
+        "AND ST_GeometryType(g2) IN ("
+        "'ST_LineString', 'ST_MultiLineString', 'ST_Polygon', 'ST_MultiPolygon'"
+        ')) '
+        'OR '
+        "(ST_GeometryType(g1) IN ('ST_Polygon', 'ST_MultiPolygon') "
+        "AND ST_GeometryType(g2) IN ('ST_LineString', 'ST_MultiLineString'))"
+      ') '
+      "THEN 'not a line-line or line-polygon intersection' "
+      'WHEN NOT EXISTS ('
+        'SELECT 1 '
+        'FROM unnest('
+        "CASE WHEN ST_GeometryType(gi) = 'ST_Point' THEN ARRAY[gi] "
+        'ELSE ARRAY[ST_StartPoint(gi), ST_EndPoint(gi)] END'
+        ') AS p '
+        'WHERE NOT EXISTS (SELECT 1 FROM ST_DumpPoints(g1) AS v WHERE {}) '
+        'AND NOT EXISTS (SELECT 1 FROM ST_DumpPoints(g2) AS v WHERE {})'
+      ') '
+      "THEN 'crosses' "
+      'END AS msg '
+      'FROM ({}) AS pairs'
+    ') AS verdicts '
+    'WHERE msg IS NOT NULL'
+  ).format(
+    ', layer1, layer2' if layers else '',
+    admissible,
+    vertex_match_sql('v.geom', 'p'),
+    vertex_match_sql('v.geom', 'p'),
+    pairs
+  )
+
+def changelog_setup_query():
+  return (
+      'CREATE SCHEMA IF NOT EXISTS {0}; '
+      'CREATE TABLE IF NOT EXISTS {0}.changes ('
+      'seq bigserial, '
+      'schema_name text NOT NULL, '
+      'table_name text NOT NULL, '
+      'id bigint NOT NULL, '
+      'PRIMARY KEY (schema_name, table_name, id)'
+      '); '
+      'CREATE OR REPLACE FUNCTION {0}.log_change() RETURNS trigger AS $$ '
+      'BEGIN '
+      "IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.id IS DISTINCT FROM NEW.id) THEN "
+      'INSERT INTO {0}.changes (schema_name, table_name, id) '
+      'VALUES (TG_TABLE_SCHEMA, TG_TABLE_NAME, OLD.id) '
+      'ON CONFLICT (schema_name, table_name, id) DO UPDATE SET seq = DEFAULT; '
+      'END IF; '
+      "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+      'INSERT INTO {0}.changes (schema_name, table_name, id) '
+      'VALUES (TG_TABLE_SCHEMA, TG_TABLE_NAME, NEW.id) '
+      'ON CONFLICT (schema_name, table_name, id) DO UPDATE SET seq = DEFAULT; '
+      'END IF; '
+      'RETURN NULL; '
+      'END; '
+      '$$ LANGUAGE plpgsql'
+    ).format(CHANGELOG_SCHEMA)
+
+def changelog_trigger_query(schema, table):
+  return (
+      'DO $$ BEGIN '
+      'IF NOT EXISTS ('
+      'SELECT 1 FROM pg_trigger '
+      "WHERE tgrelid = '{1}.{2}'::regclass AND tgname = '{0}'"
+      ') THEN '
+      'CREATE TRIGGER {0} AFTER INSERT OR UPDATE OR DELETE ON {1}.{2} '
+      'FOR EACH ROW EXECUTE PROCEDURE {0}.log_change(); '
+      'END IF; '
+      'END $$'
+    ).format(CHANGELOG_SCHEMA, schema, table)
+
+def changes_query(schema):
+  return (
+      'SELECT table_name, array_agg(id ORDER BY id), array_agg(seq ORDER BY id) '
+      'FROM {0}.changes '
+      "WHERE schema_name = '{1}' "
+      'GROUP BY table_name'
+    ).format(CHANGELOG_SCHEMA, schema)
+
+def clear_changes_query(schema, table, ids, seqs):
+  # a feature changed again meanwhile has a new seq, and is kept
+  return (
+      'DELETE FROM {0}.changes AS c '
+      'USING unnest({3}, {4}) AS d(id, seq) '
+      "WHERE c.schema_name = '{1}' AND c.table_name = '{2}' "
+      'AND c.id = d.id AND c.seq = d.seq'
+    ).format(CHANGELOG_SCHEMA, schema, table, ids_sql(ids), ids_sql(seqs))
 
 class PGDBManagerError(Exception):
   pass
@@ -179,7 +944,11 @@ class PGDBManager:
     dbname=None,
     username='postgres',
     password=None,
-    logger=None
+    logger=None,
+    batch_size=1000,
+    profiles=None,
+    explain=False,
+    read_only=False
     ):
     # parameters
     self.host = host
@@ -188,17 +957,31 @@ class PGDBManager:
     self.username = username
     self.password = password
     self.logger = logger or logging.getLogger(__name__)
+    self.batch_size = batch_size
+    # list the profile of each query is added to, None to not profile
+    self.profiles = profiles
+    self.explain = explain
+    # autocommit without savepoints, for runs that do not write to the database
+    self.read_only = read_only
     # internal
     self._conn = None
     self._cursor = None
+    self._tags = {}
+    self._prepared = set()
+    self._cursor_ids = itertools.count()
     self._ = gettext.gettext
 
-  def connect(self):
-    connstr = "host='{}' port='{}' dbname='{}' user='{}' password='{}'"\
+  def _connstr(self):
+    return "host='{}' port='{}' dbname='{}' user='{}' password='{}'"\
     .format(self.host, self.port, self.dbname, self.username, self.password)
+
+  def connect(self):
     try:
-      self._conn = psycopg2.connect(connstr)
+      self._conn = psycopg2.connect(self._connstr())
+      if self.read_only:
+        self._conn.set_session(readonly=True, autocommit=True)
       self._cursor = self._conn.cursor()
+      self._prepared = set()
     except:
       self._conn = None
       self._cursor = None
@@ -206,99 +989,579 @@ class PGDBManager:
       self.logger.error(msg, exc_info=True)
       raise PGDBManagerError(msg)
 
-  def get_query_result(self, query):
+  def close(self):
+    if self._conn:
+      self._conn.close()
+    self._conn = None
+    self._cursor = None
+
+  @contextmanager
+  def tagged(self, **tags):
+    previous = self._tags
+    self._tags = dict(previous, **tags)
+    try:
+      yield self
+    finally:
+      self._tags = previous
+
+  def _timed(self, timing, key, call, *args):
+    start = time.perf_counter()
+    try:
+      return call(*args)
+    finally:
+      timing[key] += time.perf_counter() - start
+
+  @contextmanager
+  def _savepoint(self, timing):
+    if self.read_only:
+      # every statement is its own transaction, failures do not affect others
+      yield None
+      return
     sp = uuid.uuid1().hex
-    self._cursor.execute('SAVEPOINT "{}"'.format(sp))
+    self._timed(timing, 'savepoint_time', self._cursor.execute, 'SAVEPOINT "{}"'.format(sp))
     try:
-      self._cursor.execute(query)
-      rows = self._cursor.fetchall()
+      yield sp
+    except GeneratorExit:
+      self._timed(
+        timing, 'savepoint_time', self._cursor.execute, 'RELEASE SAVEPOINT "{}"'.format(sp)
+      )
+      raise
     except Exception:
-      self._cursor.execute('ROLLBACK TO SAVEPOINT "{}"'.format(sp))
+      self._timed(
+        timing, 'savepoint_time', self._cursor.execute, 'ROLLBACK TO SAVEPOINT "{}"'.format(sp)
+      )
       raise
     else:
-      self._cursor.execute('RELEASE SAVEPOINT "{}"'.format(sp))
+      self._timed(
+        timing, 'savepoint_time', self._cursor.execute, 'RELEASE SAVEPOINT "{}"'.format(sp)
+      )
+
+  @contextmanager
+  def _read_only_transaction(self, timing):
+    # named cursors only live inside a transaction
+    self._conn.autocommit = False
+    try:
+      yield
+    except BaseException:
+      self._timed(timing, 'savepoint_time', self._conn.rollback)
+      raise
+    else:
+      self._timed(timing, 'savepoint_time', self._conn.commit)
+    finally:
+      self._conn.autocommit = True
+
+  def _start_profile(self):
+    return {'start': time.perf_counter(), 'time': 0.0, 'savepoint_time': 0.0}
+
+  def _explain_query(self, query):
+    try:
+      with self._savepoint(self._start_profile()):
+        self._cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {}'.format(query))
+        return self._cursor.fetchone()[0]
+    except Exception:
+      self.logger.warning(
+        '{}: {}'.format(self._('Cannot explain query'), query), exc_info=True
+      )
+      return None
+
+  def _add_profile(self, query, timing, rows):
+    if self.profiles is None:
+      return
+    profile = dict(self._tags)
+    profile.update({
+      'query': query,
+      'rows': rows,
+      # time spent in the database, and since the query was sent
+      'time': timing['time'],
+      'wall_time': time.perf_counter() - timing['start'],
+      'savepoint_time': timing['savepoint_time']
+    })
+    if self.explain and query.lstrip().upper().startswith(('SELECT', 'WITH')):
+      # runs the query again
+      profile['explain'] = self._explain_query(query)
+    self.profiles.append(profile)
+
+  def get_query_result(self, query):
+    timing = self._start_profile()
+    with self._savepoint(timing):
+      self._timed(timing, 'time', self._cursor.execute, query)
+      rows = self._timed(timing, 'time', self._cursor.fetchall)
+    self._add_profile(query, timing, len(rows))
     return rows
 
+  def execute_query(self, query):
+    timing = self._start_profile()
+    with self._savepoint(timing):
+      self._timed(timing, 'time', self._cursor.execute, query)
+    self._add_profile(query, timing, self._cursor.rowcount)
+
+  def copy_query_result(self, query, file):
+    timing = self._start_profile()
+    with self._savepoint(timing):
+      self._timed(timing, 'time', self._cursor.copy_expert, query, file)
+      rows = self._cursor.rowcount
+    self._add_profile(query, timing, rows)
+    return rows
+
+  def get_catalog_query_result(self, name, query, values):
+    if not self.read_only:
+      return self.get_query_result(query(*values))
+    # prepared once per connection, then run in a single round trip
+    if name not in self._prepared:
+      self.execute_query(
+        prepare_query(name, query(*values, prepared=True), len(values))
+      )
+      self._prepared.add(name)
+    return self.get_query_result(execute_prepared_query(name, values))
+
   def get_schema_table_names(self, schema):
-    query = (
-      'SELECT tablename '
-      'FROM pg_tables '
-      "WHERE schemaname='{}' "
-      'ORDER BY tablename'
-    ).format(schema)
     try:
-      rows = self.get_query_result(query)
+      rows = self.get_catalog_query_result('schema_tables', schema_tables_query, [schema])
     except:
       msg = '{} {}'.format(self._('Cannot retrieve table names from schema'), schema)
       self.logger.error(msg, exc_info=True)
       raise PGDBManagerError(msg)
     return rows
 
-  def get_invalid_geoms_from_table(self, schema, table):
-    query = invalid_geoms_query(schema, table)
+  def commit(self):
+    self._conn.commit()
+
+  def get_schema_names(self, pattern):
     try:
-      rows = self.get_query_result(query)
+      rows = self.get_catalog_query_result('schema_names', schema_names_query, [pattern])
     except:
-      msg = '{} {}.{}'.format(
-        self._('Cannot retrieve features with invalid geometries from table'),
-        schema,
-        table
+      msg = '{} {}'.format(self._('Cannot retrieve schemas like'), pattern)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+    return [row[0] for row in rows]
+
+  def get_table_status(self, schema, table):
+    try:
+      rows = self.get_catalog_query_result(
+        'table_status', table_status_query, [schema, table]
       )
+    except:
+      msg = '{} {}.{}'.format(self._('Cannot retrieve status of table'), schema, table)
       self.logger.error(msg, exc_info=True)
       raise PGDBManagerError(msg)
-    return [InvalidGeomResult(row[0], row[1], row[2]) for row in rows]
+    if not rows:
+      return None
+    return TableStatusResult(rows[0][0], rows[0][1], rows[0][2], rows[0][3], rows[0][4])
 
-  def get_duplicate_geoms_from_table(self, schema, table):
-    query = duplicate_geoms_query(schema, table)
+  def get_table_count(self, schema, table):
+    query = table_count_query(schema, table)
     try:
       rows = self.get_query_result(query)
     except:
-      msg = '{} {}.{}'.format(
-        self._('Cannot retrieve  features with duplicate geometries from table'),
-        schema,
-        table
-      )
+      msg = '{} {}.{}'.format(self._('Cannot count features of table'), schema, table)
       self.logger.error(msg, exc_info=True)
       raise PGDBManagerError(msg)
-    return [DuplicateGeomResult(row[0], row[1]) for row in rows]
+    return rows[0][0]
 
-  def get_multipart_geoms_from_table(self, schema, table):
-    query = multipart_geoms_query(schema, table)
+  def get_table_fingerprint(self, schema, table, checksum=False):
+    try:
+      if checksum:
+        rows = self.get_query_result(table_fingerprint_query(schema, table, True))
+      else:
+        rows = self.get_catalog_query_result(
+          'table_fingerprint', table_fingerprint_query, [schema, table]
+        )
+    except:
+      msg = '{} {}.{}'.format(self._('Cannot retrieve fingerprint of table'), schema, table)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+    if not rows:
+      return None
+    return rows[0][0]
+
+  def create_spatial_index(self, schema, table):
+    try:
+      self.execute_query('CREATE INDEX ON {}.{} USING gist (geom)'.format(schema, table))
+    except:
+      msg = '{} {}.{}'.format(self._('Cannot create spatial index on table'), schema, table)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+
+  def analyze_table(self, schema, table):
+    try:
+      self.execute_query('ANALYZE {}.{}'.format(schema, table))
+    except:
+      msg = '{} {}.{}'.format(self._('Cannot analyze table'), schema, table)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+
+  def get_table_tiles(self, schema, table, size, by_grid=True):
+    query = table_extent_query(schema, table) if by_grid else table_id_range_query(schema, table)
     try:
       rows = self.get_query_result(query)
     except:
-      msg = '{} {}.{}'.format(
+      msg = '{} {}.{}'.format(self._('Cannot retrieve tiles of table'), schema, table)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+    if not rows or rows[0][0] is None:
+      return [TableTile()]
+    if by_grid:
+      return grid_tiles(rows[0][:4], rows[0][4], size)
+    return id_range_tiles(rows[0][0], rows[0][1], size)
+
+  def setup_changelog(self, schema, tables):
+    try:
+      self.execute_query(changelog_setup_query())
+      for table in tables:
+        self.execute_query(changelog_trigger_query(schema, table))
+      self.commit()
+    except:
+      msg = '{} {}'.format(self._('Cannot set up change log of schema'), schema)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+
+  def get_changes(self, schema):
+    try:
+      rows = self.get_query_result(changes_query(schema))
+    except:
+      msg = '{} {}'.format(self._('Cannot retrieve changed features of schema'), schema)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+    return {row[0]: list(zip(row[1], row[2])) for row in rows}
+
+  def clear_changes(self, schema, changes):
+    try:
+      for table, table_changes in changes.items():
+        self.execute_query(clear_changes_query(
+          schema,
+          table,
+          [change[0] for change in table_changes],
+          [change[1] for change in table_changes]
+        ))
+      self.commit()
+    except:
+      msg = '{} {}'.format(self._('Cannot clear change log of schema'), schema)
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+
+  def iter_query_batches(self, query, batch_size=None):
+    timing = self._start_profile()
+    count = 0
+    if self.read_only:
+      isolation = self._read_only_transaction(timing)
+    else:
+      isolation = self._savepoint(timing)
+    with isolation:
+      cursor = self._conn.cursor('c{}'.format(next(self._cursor_ids)))
+      try:
+        self._timed(timing, 'time', cursor.execute, query)
+        rows = self._timed(timing, 'time', cursor.fetchmany, batch_size or self.batch_size)
+        while rows:
+          count += len(rows)
+          yield rows
+          rows = self._timed(timing, 'time', cursor.fetchmany, batch_size or self.batch_size)
+      finally:
+        cursor.close()
+    self._add_profile(query, timing, count)
+
+  def iter_query_result(self, query, batch_size=None):
+    for rows in self.iter_query_batches(query, batch_size):
+      for row in rows:
+        yield row
+
+  def _iter_results(self, query, result, msg):
+    try:
+      for row in self.iter_query_result(query):
+        yield result(row)
+    except Exception:
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+
+  def get_invalid_geoms_from_table(self, schema, table, stream=False):
+    results = self._iter_results(
+      invalid_geoms_query(schema, table),
+      lambda row: InvalidGeomResult(row[0], row[1], row[2]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve features with invalid geometries from table'),
+        schema,
+        table
+      )
+    )
+    return results if stream else ResultSet(InvalidGeomResult, results)
+
+  def get_duplicate_geoms_from_table(self, schema, table, stream=False):
+    results = self._iter_results(
+      duplicate_geoms_query(schema, table),
+      lambda row: DuplicateGeomResult(row[0], row[1]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve  features with duplicate geometries from table'),
+        schema,
+        table
+      )
+    )
+    return results if stream else ResultSet(DuplicateGeomResult, results)
+
+  def get_duplicate_hash_geoms_from_table(self, schema, table, normalize=False, stream=False):
+    results = self._iter_results(
+      duplicate_hash_geoms_query(schema, table, normalize),
+      lambda row: DuplicateGeomResult(row[0], row[1]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve  features with duplicate geometries from table'),
+        schema,
+        table
+      )
+    )
+    return results if stream else ResultSet(DuplicateGeomResult, results)
+
+  def get_duplicate_geoms_from_schema(self, schema, tables, normalize=False, stream=False):
+    results = self._iter_results(
+      schema_duplicate_geoms_query(schema, tables, normalize),
+      lambda row: SchemaDuplicateGeomResult(row[0], row[1], row[2], row[3], row[4]),
+      '{} {}'.format(
+        self._('Cannot retrieve features with duplicate geometries from schema'),
+        schema
+      )
+    )
+    return results if stream else ResultSet(SchemaDuplicateGeomResult, results)
+
+  def get_multipart_geoms_from_table(self, schema, table, stream=False):
+    results = self._iter_results(
+      multipart_geoms_query(schema, table),
+      lambda row: MultipartGeomResult(row[0], row[1]),
+      '{} {}.{}'.format(
         self._('Cannot retrieve features with multipart geometries from table'),
         schema,
         table
       )
+    )
+    return results if stream else ResultSet(MultipartGeomResult, results)
+
+  def get_null_geoms_from_table(self, schema, table, stream=False):
+    results = self._iter_results(
+      null_geoms_query(schema, table),
+      lambda row: NullGeomResult(row[0]),
+      '{} {}.{}'.format(
+        self._('Cannot retrieve features with null geometries from table'),
+        schema,
+        table
+      )
+    )
+    return results if stream else ResultSet(NullGeomResult, results)
+
+  def iter_table_rules_from_table(
+    self, schema, table, rules, normalize=False, ids=None, tile=None
+    ):
+    msg = '{} {}.{}'.format(
+      self._('Cannot retrieve features that break rules from table'),
+      schema,
+      table
+    )
+    try:
+      query = table_rules_query(schema, table, rules, normalize, ids, tile)
+      for row in self.iter_query_result(query):
+        for value in table_row_results(row):
+          yield value
+    except Exception:
       self.logger.error(msg, exc_info=True)
       raise PGDBManagerError(msg)
-    return [MultipartGeomResult(row[0], row[1]) for row in rows]
 
-  def get_null_geoms_from_table(self, schema, table):
-    query = null_geoms_query(schema, table)
+  def get_table_rules_from_table(
+    self, schema, table, rules, normalize=False, ids=None, tile=None
+    ):
+    results = {rule: ResultSet(TABLE_RULES_RESULTS[rule]) for rule in rules}
+    for rule, result in self.iter_table_rules_from_table(
+      schema, table, rules, normalize, ids, tile
+    ):
+      results[rule].append(result)
+    return results
+
+  def copy_table_rule_from_table(self, schema, table, rule, file, normalize=False):
     try:
-      rows = self.get_query_result(query)
+      return self.copy_query_result(
+        table_rule_copy_query(schema, table, rule, normalize), file
+      )
     except:
       msg = '{} {}.{}'.format(
-        self._('Cannot retrieve features with null geometries from table'),
+        self._('Cannot copy features that break rules from table'),
         schema,
         table
       )
       self.logger.error(msg, exc_info=True)
       raise PGDBManagerError(msg)
-    return [NullGeomResult(row[0]) for row in rows]
 
-  def get_not_allowed_intersection(self, schema, table, tables, admissibles):
-    values = NotAllowedIntersectionsResult()
+  def _geojson_geom(self, geoms, key, geojson):
+    if geoms is None:
+      return json.loads(geojson)
+    if ('geom', key) not in geoms:
+      geoms[('geom', key)] = json.loads(geojson)
+    return geoms[('geom', key)]
+
+  def _vertex_index(self, geoms, key, geom):
+    if geoms is None:
+      return VertexIndex(geojson_vertices(geom))
+    if ('index', key) not in geoms:
+      geoms[('index', key)] = VertexIndex(geojson_vertices(geom))
+    return geoms[('index', key)]
+
+  def _intersection_msg(self, table2, crosses, typei, points, geom1, geom2, admissibles):
+    msg = ''
+    # check if intersection is admissible
+    if admissibles and table2 in admissibles:
+      # check if intersection is a cross
+      if crosses:
+        # check if intersection is point or line
+        if typei == 'Point' or typei == 'LineString':
+          type1, index1 = geom1()
+          type2, index2 = geom2()
+          # check if is line-line or line-polygon intersection
+          if (
+            type1 in ['LineString', 'MultiLineString']
+            and
+            type2 in ['LineString', 'MultiLineString']
+          ) or\
+          (
+            type1 in ['LineString', 'MultiLineString']
+            and
+            type2 in ['Polygon', 'MultiPolygon']
+          ) or\
+          (
+            type1 in ['Polygon', 'MultiPolygon']
+            and
+            type2 in ['LineString', 'MultiLineString']
+          ):
+            ptoi = 0
+            while ptoi < len(points) and\
+              (
+                point_in_vertex_index(points[ptoi], index1)
+                or
+                point_in_vertex_index(points[ptoi], index2)
+              ):
+              ptoi += 1
+            if ptoi == len(points):
+              msg = self._('crosses')
+          else:
+            msg = self._('not a line-line or line-polygon intersection')
+        else:
+          msg = self._('result intersection is not point or line')
+      else:
+        msg = self._('invalid addmissible intersection')
+    else:
+      msg = self._('not addmissible intersection')
+    return msg
+
+  def _add_intersection_value(self, values, value, typei, dimension):
+    if typei == 'GeometryCollection':
+      values.collection.append(value)
+    elif dimension == 0:
+      values.point.append(value)
+    elif dimension == 1:
+      values.line.append(value)
+    else:
+      values.polygon.append(value)
+
+  def _add_intersection(self, values, table, table2, row, admissibles, geoms=None):
+    geomi = json.loads(row[2])
+    points = []
+    if geomi['type'] == 'Point':
+      points = [geomi['coordinates']]
+    elif geomi['type'] == 'LineString':
+      points = [geomi['coordinates'][0], geomi['coordinates'][len(geomi['coordinates'])-1]]
+    def geojson_geom(key, geojson):
+      geom = self._geojson_geom(geoms, key, geojson)
+      return geom['type'], self._vertex_index(geoms, key, geom)
+    msg = self._intersection_msg(
+      table2,
+      row[6],
+      geomi['type'],
+      points,
+      lambda: geojson_geom((1, row[0]), row[3]),
+      lambda: geojson_geom((2, row[1]), row[4]),
+      admissibles
+    )
+    if msg:
+      value = IntersectGeomResult(table, row[0], table2, row[1], row[5], msg)
+      self._add_intersection_value(values, value, geomi['type'], row[7])
+
+  def _wkb_geom(self, geoms, key, blob):
+    if ('wkb', key) not in geoms:
+      geom = decode_wkb(blob)
+      geoms[('wkb', key)] = (
+        geom.type,
+        VertexIndex(geom.vertices(), WKB_TOLERANCE)
+      )
+    return geoms[('wkb', key)]
+
+  def _add_wkb_intersections(self, values, table, table2, rows, admissibles, geoms):
+    for row, geomi in zip(rows, decode_wkb_batch([row[2] for row in rows])):
+      msg = self._intersection_msg(
+        table2,
+        row[5],
+        geomi.type,
+        geomi.endpoints(),
+        lambda: self._wkb_geom(geoms, (1, row[0]), row[3]),
+        lambda: self._wkb_geom(geoms, (2, row[1]), row[4]),
+        admissibles
+      )
+      if msg:
+        value = IntersectGeomResult(table, row[0], table2, row[1], geomi.multi(), msg)
+        self._add_intersection_value(values, value, geomi.type, row[6])
+
+  def _add_verdict(self, values, table, table2, row):
+    value = IntersectGeomResult(table, row[0], table2, row[1], row[3], self._(row[2]))
+    if row[5]:
+      values.collection.append(value)
+    elif row[4] == 0:
+      values.point.append(value)
+    elif row[4] == 1:
+      values.line.append(value)
+    else:
+      values.polygon.append(value)
+
+  def _add_intersection_batch(
+    self, values, table, table2, rows, admissibles, geoms, server_side, binary
+    ):
+    if server_side:
+      for row in rows:
+        self._add_verdict(values, table, table2, row)
+    elif binary:
+      self._add_wkb_intersections(values, table, table2, rows, admissibles, geoms)
+    else:
+      for row in rows:
+        self._add_intersection(values, table, table2, row, admissibles, geoms)
+
+  def _intersection_queries(
+    self, schema, table, tables, admissibles, server_side, binary, ids, tile
+    ):
     for table2 in tables:
-      query = intersection_query(schema, table, table2)
+      pair_ids = None
+      if ids is not None:
+        pair_ids = (ids.get(table) or [], ids.get(table2) or [])
+        if not pair_ids[0] and not pair_ids[1]:
+          continue
+      admissible = 'true' if admissibles and table2 in admissibles else 'false'
+      if server_side:
+        query = admissibility_query(
+          intersection_pairs_query(schema, table, table2, pair_ids, tile),
+          admissible
+        )
+      elif binary:
+        query = intersection_wkb_query(schema, table, table2, admissible, pair_ids, tile)
+      else:
+        query = intersection_query(schema, table, table2, pair_ids, tile)
       self.logger.debug(
         '{}: {} - {}'.format(self._('Intersection'), table, table2)
       )
+      yield table2, query
+
+  def get_not_allowed_intersection(
+    self, schema, table, tables, admissibles, server_side=False, binary=False, ids=None,
+    tile=None
+    ):
+    values = NotAllowedIntersectionsResult()
+    for table2, query in self._intersection_queries(
+      schema, table, tables, admissibles, server_side, binary, ids, tile
+    ):
+      geoms = {}
       try:
-        rows = self.get_query_result(query)
+        for rows in self.iter_query_batches(query):
+          self._add_intersection_batch(
+            values, table, table2, rows, admissibles, geoms, server_side, binary
+          )
       except:
         msg = '{0} {1}.{2} {1}.{3}'.format(
           self._('Cannot retrieve intersection geometries between tables'),
@@ -307,65 +1570,141 @@ class PGDBManager:
           table2
         )
         self.logger.error(msg, exc_info=True)
-      for row in rows:
-        msg = ''
-        geomi = json.loads(row[2])
-        # check if intersection is admissible
-        if admissibles and table2 in admissibles:
-          # check if intersection is a cross
-          if row[6]:
-            # check if intersection is point or line
-            if geomi['type'] == 'Point' or geomi['type'] == 'LineString':
-              points = []
-              if geomi['type'] == 'Point':
-                points = [geomi['coordinates']]
-              else:
-                points = [geomi['coordinates'][0], geomi['coordinates'][len(geomi['coordinates'])-1]]
-              geom1 = json.loads(row[3])
-              geom2 = json.loads(row[4])
-              # check if is line-line or line-polygon intersection
-              if (
-                geom1['type'] in ['LineString', 'MultiLineString']
-                and
-                geom2['type'] in ['LineString', 'MultiLineString']
-              ) or\
-              (
-                geom1['type'] in ['LineString', 'MultiLineString']
-                and
-                geom2['type'] in ['Polygon', 'MultiPolygon']
-              ) or\
-              (
-                geom1['type'] in ['Polygon', 'MultiPolygon']
-                and
-                geom2['type'] in ['LineString', 'MultiLineString']
-              ):
-                ptoi = 0
-                while ptoi < len(points) and\
-                  (
-                    point_in_geojson_geom(points[ptoi], geom1)
-                    or
-                    point_in_geojson_geom(points[ptoi], geom2)
-                  ):
-                  ptoi += 1
-                if ptoi == len(points):
-                  msg = self._('crosses')
-              else:
-                msg = self._('not a line-line or line-polygon intersection')
-            else:
-              msg = self._('result intersection is not point or line')
-          else:
-            msg = self._('invalid addmissible intersection')
-        else:
-          msg = self._('not addmissible intersection')
-        value = IntersectGeomResult(table, row[0], table2, row[1], row[5], msg)
-        if msg:
-          if geomi['type'] == 'GeometryCollection':
-            values.collection.append(value)
-          else:
-            if row[7] == 0:
-              values.point.append(value)
-            elif row[7] == 1:
-              values.line.append(value)
-            else:
-              values.polygon.append(value)
+        raise PGDBManagerError(msg)
+    return values
+
+  def get_not_allowed_intersections_from_schema(
+    self, schema, tables, admissibles, server_side=False, binary=False
+    ):
+    values = {table: NotAllowedIntersectionsResult() for table in tables}
+    layers = 'layers_{}'.format(uuid.uuid1().hex)
+    self.logger.debug(
+      '{}: {}'.format(self._('Intersection'), schema)
+    )
+    if server_side:
+      query = admissibility_query(
+        schema_intersection_pairs_query(layers),
+        admissible_sql(admissibles, 'layer2'),
+        True
+      )
+    elif binary:
+      query = schema_intersection_wkb_query(layers, admissibles)
+    else:
+      query = schema_intersection_query(layers)
+    # the geometries of every table are copied once to a temporary table, and
+    # any error stops the whole schema
+    try:
+      self.execute_query(schema_layers_query(schema, tables, layers))
+      self.execute_query('CREATE INDEX ON {} USING gist(geom)'.format(layers))
+      self.execute_query('ANALYZE {}'.format(layers))
+      last_pair = None
+      for rows in self.iter_query_batches(query):
+        # layer names are the last two columns
+        for pair, pair_rows in itertools.groupby(rows, lambda row: (row[-2], row[-1])):
+          if pair != last_pair:
+            last_pair = pair
+            geoms = {}
+          self._add_intersection_batch(
+            values[pair[0]],
+            pair[0],
+            pair[1],
+            list(pair_rows),
+            admissibles,
+            geoms,
+            server_side,
+            binary
+          )
+    except:
+      msg = '{} {}'.format(
+        self._('Cannot retrieve intersection geometries between tables of schema'),
+        schema
+      )
+      self.logger.error(msg, exc_info=True)
+      raise PGDBManagerError(msg)
+    finally:
+      # a failed cleanup must not hide the error of the control
+      try:
+        self.execute_query('DROP TABLE IF EXISTS {}'.format(layers))
+      except:
+        self.logger.error(
+          '{} {}'.format(self._('Cannot drop temporary table'), layers), exc_info=True
+        )
     return values
+
+class PGDBManagerPool:
+
+  def __init__(
+    self,
+    size=1,
+    host='localhost',
+    port=5432,
+    dbname=None,
+    username='postgres',
+    password=None,
+    logger=None,
+    batch_size=1000,
+    profile=False,
+    explain=False,
+    read_only=False
+    ):
+    # parameters
+    self.size = max(size, 1)
+    self.host = host
+    self.port = port
+    self.dbname = dbname
+    self.username = username
+    self.password = password
+    self.logger = logger or logging.getLogger(__name__)
+    self.batch_size = batch_size
+    self.explain = explain
+    self.read_only = read_only
+    # profiles of the queries of all managers, None to not profile
+    self.profiles = [] if profile or explain else None
+    # internal
+    self._pgdbs = []
+    self._free = queue.Queue()
+    self._ = gettext.gettext
+
+  def connect(self):
+    try:
+      for i in range(self.size):
+        pgdb = PGDBManager(
+          self.host,
+          self.port,
+          self.dbname,
+          self.username,
+          self.password,
+          self.logger,
+          self.batch_size,
+          self.profiles,
+          self.explain,
+          self.read_only
+        )
+        pgdb.connect()
+        self._pgdbs.append(pgdb)
+        self._free.put(pgdb)
+    except PGDBManagerError:
+      self.close()
+      raise
+
+  def close(self):
+    for pgdb in self._pgdbs:
+      pgdb.close()
+    self._pgdbs = []
+    self._free = queue.Queue()
+
+  def acquire(self):
+    if not self._pgdbs:
+      raise PGDBManagerError(self._('Connection pool is not connected'))
+    return self._free.get()
+
+  def release(self, pgdb):
+    self._free.put(pgdb)
+
+  @contextmanager
+  def manager(self):
+    pgdb = self.acquire()
+    try:
+      yield pgdb
+    finally:
+      self.release(pgdb)
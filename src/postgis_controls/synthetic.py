@@ -0,0 +1,167 @@
+'''
+postgis_controls.synthetic
+'''
+
+# comment that marks the schemas created by the generator, the only ones it drops
+SYNTHETIC_SCHEMA_COMMENT = 'synthetic benchmark schema'
+
+GEOMETRY_TYPES = ['point', 'linestring', 'polygon']
+
+# features of each kind are spread over blocks of this many rows
+RATIO_BLOCK = 10000
+
+# multiplier coprime with the block size, to shuffle kinds inside each block
+RATIO_SHUFFLE = 7919
+
+DEFAULT_RATIOS = {
+  'null': 0.01,
+  'invalid': 0.01,
+  'multipart': 0.01,
+  'duplicate': 0.01,
+  'intersect': 0.01
+}
+
+def synthetic_table_names(tables):
+  return [
+    't{:03d}_{}'.format(i, GEOMETRY_TYPES[i % len(GEOMETRY_TYPES)])
+    for i in range(tables)
+  ]
+
+def synthetic_geom_type(table):
+  return table.rsplit('_', 1)[1]
+
+def synthetic_base_sql(geom_type, vertices):
+  # valid, invalid and multipart geometries in the unit square, moved to each
+  # feature cell afterwards
+  if geom_type == 'point':
+    valid = "ST_GeomFromText('POINT(0.5 0.5)', 4326)"
+    # points cannot be invalid
+    invalid = valid
+  elif geom_type == 'linestring':
+    n = max(vertices, 2) - 1
+    valid = (
+      'ST_SetSRID(ST_MakeLine(ARRAY('
+      'SELECT ST_MakePoint(v::float8 / {0}, v % 2) '
+      'FROM generate_series(0, {0}) AS v'
+      ')), 4326)'
+    ).format(n)
+    invalid = "ST_GeomFromText('LINESTRING(0 0,0 0)', 4326)"
+  elif geom_type == 'polygon':
+    n = max(vertices, 3)
+    valid = (
+      'ST_SetSRID(ST_MakePolygon(ST_MakeLine(ARRAY('
+      'SELECT ST_MakePoint('
+      '0.5 + 0.5 * cos(2 * pi() * (v % {0}) / {0}), '
+      '0.5 + 0.5 * sin(2 * pi() * (v % {0}) / {0})'
+      ') '
+      'FROM generate_series(0, {0}) AS v'
+      '))), 4326)'
+    ).format(n)
+    invalid = "ST_GeomFromText('POLYGON((0 0,1 1,1 0,0 1,0 0))', 4326)"
+  else:
+    raise ValueError('Unknown geometry type: {}'.format(geom_type))
+  multi = (
+    'ST_Collect('
+    'ST_Scale({0}, 0.4, 0.4), '
+    'ST_Translate(ST_Scale({0}, 0.4, 0.4), 0.5, 0.5)'
+    ')'
+  ).format(valid)
+  return valid, invalid, multi
+
+def synthetic_kind_limits(ratios):
+  # each kind gets its share of every block of rows, the rest are valid
+  limits = []
+  limit = 0
+  for kind in ['null', 'invalid', 'multipart', 'duplicate', 'intersect']:
+    n = int(round(ratios.get(kind, 0) * RATIO_BLOCK))
+    if n > 0:
+      limit += n
+      limits.append((limit, kind))
+  return limits
+
+def synthetic_kind_sql(ratios):
+  bucket = '((i * {}) % {})'.format(RATIO_SHUFFLE, RATIO_BLOCK)
+  cases = [
+    "WHEN {} < {} THEN '{}'".format(bucket, limit, kind)
+    for limit, kind in synthetic_kind_limits(ratios)
+  ]
+  if not cases:
+    return "'valid'"
+  return "CASE {} ELSE 'valid' END".format(' '.join(cases))
+
+def synthetic_table_query(schema, table, index, tables, features, vertices, ratios):
+  # features are laid out on a grid of cells, each cell holds a band per
+  # table so only intersecting features overlap those of another table
+  valid, invalid, multi = synthetic_base_sql(synthetic_geom_type(table), vertices)
+  side = max(int(features ** 0.5), 1)
+  # intersecting features move to the band of the next table, or the previous
+  # one for the last table, with a single table they stay in place
+  band = 0 if tables == 1 else 2 if index < tables - 1 else -2
+  return (
+    'DROP TABLE IF EXISTS {0}.{1}; '
+    'CREATE TABLE {0}.{1} ('
+    'id serial PRIMARY KEY, '
+    'geom geometry(Geometry, 4326)'
+    '); '
+    'WITH base AS ('
+    'SELECT {2} AS valid, {3} AS invalid, {4} AS multi'
+    '), '
+    'cells AS ('
+    'SELECT '
+    'i, '
+    '{5} AS kind, '
+    '(i % {6}) * {7} + {8} AS x, '
+    '(i / {6}) * 2 AS y '
+    'FROM generate_series(1, {9}) AS i'
+    ') '
+    'INSERT INTO {0}.{1} (geom) '
+    'SELECT CASE kind '
+    "WHEN 'null' THEN NULL "
+    "WHEN 'invalid' THEN ST_Translate(invalid, x, y) "
+    "WHEN 'multipart' THEN ST_Translate(multi, x, y) "
+    "WHEN 'duplicate' THEN ST_Translate(valid, ((i - 1) % {6}) * {7} + {8}, ((i - 1) / {6}) * 2) "
+    "WHEN 'intersect' THEN ST_Translate(valid, x + {10}, y) "
+    'ELSE ST_Translate(valid, x, y) '
+    'END '
+    'FROM cells, base '
+    'ORDER BY i'
+  ).format(
+    schema,
+    table,
+    valid,
+    invalid,
+    multi,
+    synthetic_kind_sql(ratios),
+    side,
+    2 * tables,
+    2 * index,
+    features,
+    band
+  )
+
+def synthetic_schema_query(schema):
+  return (
+    'DROP SCHEMA IF EXISTS {0} CASCADE; '
+    'CREATE SCHEMA {0}; '
+    "COMMENT ON SCHEMA {0} IS '{1}'"
+  ).format(schema, SYNTHETIC_SCHEMA_COMMENT)
+
+def schema_comment_query(schema):
+  return (
+    "SELECT obj_description(oid, 'pg_namespace') "
+    'FROM pg_namespace '
+    "WHERE nspname = '{}'"
+  ).format(schema)
+
+def synthetic_counts(features, ratios, geom_type=None):
+  # features of each kind written to a table, duplicates and intersections
+  # are only reported when their neighbour feature is valid
+  limits = synthetic_kind_limits(ratios)
+  counts = {}
+  for i in range(1, features + 1):
+    bucket = (i * RATIO_SHUFFLE) % RATIO_BLOCK
+    kind = next((k for limit, k in limits if bucket < limit), 'valid')
+    if kind == 'invalid' and geom_type == 'point':
+      kind = 'valid'
+    counts[kind] = counts.get(kind, 0) + 1
+  return counts
@@ -0,0 +1,59 @@
+import unittest
+import asyncio
+
+from src.postgis_controls.apgdb import AsyncPGDBManager, AsyncPGDBManagerPool
+from src.postgis_controls.pgdb import PGDBManagerError, ResultSet
+
+class TestAsyncPGDBManager(unittest.TestCase):
+  def setUp(self):
+    self.pgdb = AsyncPGDBManager(
+      'local-data-server', 5432, 'test_vector_db', 'postgres', 'diablo2'
+    )
+
+  def test_get_table_rules_from_table(self):
+    async def control():
+      await self.pgdb.connect()
+      try:
+        return await self.pgdb.get_table_rules_from_table(
+          'multi_geoms', 'points', ['multipart', 'null']
+        )
+      finally:
+        self.pgdb.close()
+    res = asyncio.run(control())
+    self.assertEqual(
+      [[mul.id, mul.number] for mul in res['multipart']],
+      [[2, 3], [4, 3]]
+    )
+    self.assertEqual(len(res['null']), 0)
+
+  def test_get_query_result_error(self):
+    async def control():
+      await self.pgdb.connect()
+      try:
+        with self.assertRaises(PGDBManagerError):
+          await self.pgdb.get_null_geoms_from_table('null_geoms', 'xxxx')
+        # the connection is still usable after a failed query
+        return await self.pgdb.get_null_geoms_from_table('null_geoms', 'points')
+      finally:
+        self.pgdb.close()
+    self.assertIsInstance(asyncio.run(control()), ResultSet)
+
+  def test_pool(self):
+    async def control():
+      pgdbs = AsyncPGDBManagerPool(
+        2, 'local-data-server', 5432, 'test_vector_db', 'postgres', 'diablo2'
+      )
+      await pgdbs.connect()
+      async def multipart(table):
+        async with pgdbs.manager() as pgdb:
+          return await pgdb.get_multipart_geoms_from_table('multi_geoms', table)
+      try:
+        return await asyncio.gather(*[multipart('points') for i in range(4)])
+      finally:
+        pgdbs.close()
+    results = asyncio.run(control())
+    self.assertEqual(len(results), 4)
+    self.assertEqual(
+      [[mul.id, mul.number] for mul in results[3]],
+      [[2, 3], [4, 3]]
+    )
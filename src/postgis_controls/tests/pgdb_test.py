@@ -1,10 +1,21 @@
+import io
 import unittest
 
 from src.postgis_controls.pgdb import (
-  InvalidGeomResult, DuplicateGeomResult, MultipartGeomResult, NullGeomResult,
+  InvalidGeomResult, NullGeomResult,
   invalid_geoms_query, duplicate_geoms_query, multipart_geoms_query, null_geoms_query,
-  point_in_geojson_geom, intersection_query,
-  PGDBManager, PGDBManagerError
+  table_rules_query, table_row_results, point_in_geojson_geom,
+  duplicate_hash_geoms_query, schema_duplicate_geoms_query,
+  schema_layers_query, schema_intersection_query,
+  vertex_match_sql, admissible_sql, admissibility_query,
+  geojson_vertices, VertexIndex, point_in_vertex_index,
+  binary_geoms_sql, intersection_wkb_query,
+  table_status_query, TableStatusResult, table_fingerprint_query,
+  schema_tables_query, schema_names_query, prepare_query, execute_prepared_query,
+  ids_sql, intersection_pairs_query, changes_query, clear_changes_query,
+  TableTile, grid_tiles, id_range_tiles, table_rule_copy_query, ResultSet,
+  IntersectGeomResult, NotAllowedIntersectionsResult, intersection_query,
+  PGDBManager, PGDBManagerPool, PGDBManagerError
 )
 
 class TestPGDBManager(unittest.TestCase):
@@ -41,6 +52,34 @@ class TestPGDBManager(unittest.TestCase):
     actual = self.pgdb.get_schema_table_names('public')
     self.assertEqual(actual, [])
 
+  def test_read_only(self):
+    self.pgdb.read_only = True
+    self.pgdb.connect()
+    for i in range(2):
+      actual = self.pgdb.get_schema_table_names('invalid_geoms')
+      self.assertEqual(actual, [('linestrings',), ('polygons',)])
+    self.assertEqual(self.pgdb._prepared, {'schema_tables'})
+    with self.assertRaises(PGDBManagerError):
+      self.pgdb.analyze_table('xxxx', 'yyyy')
+    # a failed query does not abort the next ones
+    rows = list(self.pgdb.iter_query_result('SELECT id FROM null_geoms.points ORDER BY id'))
+    self.assertEqual(len(rows), 5)
+    with self.assertRaises(Exception):
+      self.pgdb.execute_query('CREATE TABLE null_geoms.xxxx (id int)')
+    self.assertEqual(self.pgdb.get_table_count('invalid_geoms', 'linestrings'), 5)
+
+  def test_get_schema_names(self):
+    self.pgdb.connect()
+    self.assertEqual(
+      self.pgdb.get_schema_names('%_geoms'),
+      ['duplicate_geoms', 'invalid_geoms', 'multi_geoms', 'null_geoms']
+    )
+    self.assertEqual(self.pgdb.get_schema_names('xxxx%'), [])
+
+  def test_get_table_count(self):
+    self.pgdb.connect()
+    self.assertEqual(self.pgdb.get_table_count('invalid_geoms', 'linestrings'), 5)
+
   def test_get_invalid_geoms_from_table(self):
     self.pgdb.connect()
     invs = self.pgdb.get_invalid_geoms_from_table('invalid_geoms', 'linestrings')
@@ -77,6 +116,139 @@ class TestPGDBManager(unittest.TestCase):
       [[2], [4], [5]]
     )
 
+  def test_get_table_rules_from_table(self):
+    self.pgdb.connect()
+    res = self.pgdb.get_table_rules_from_table(
+      'multi_geoms', 'points', ['multipart', 'null']
+    )
+    actual = [[mul.id, mul.number] for mul in res['multipart']]
+    self.assertEqual(
+      actual,
+      [[2, 3], [4, 3]]
+    )
+    self.assertEqual(len(res['null']), 0)
+    res = self.pgdb.get_table_rules_from_table(
+      'duplicate_geoms', 'points', ['duplicate']
+    )
+    actual = [[dup.id, dup.number] for dup in res['duplicate']]
+    self.assertEqual(
+      actual,
+      [[2, 2], [4, 2], [5, 3]]
+    )
+
+  def test_get_duplicate_hash_geoms_from_table(self):
+    self.pgdb.connect()
+    dups = self.pgdb.get_duplicate_hash_geoms_from_table('duplicate_geoms', 'points')
+    actual = [[dup.id, dup.number] for dup in dups]
+    self.assertEqual(
+      actual,
+      [[2, 2], [4, 2], [5, 3]]
+    )
+
+  def test_get_duplicate_geoms_from_schema(self):
+    self.pgdb.connect()
+    dups = self.pgdb.get_duplicate_geoms_from_schema(
+      'duplicate_geoms', ['linestrings', 'points', 'polygons']
+    )
+    actual = [dup.to_list() for dup in dups]
+    self.assertEqual(
+      actual,
+      [
+        ['linestrings', 2, 2, 'linestrings', 1],
+        ['linestrings', 4, 2, 'linestrings', 3],
+        ['linestrings', 5, 3, 'linestrings', 1],
+        ['points', 2, 2, 'points', 1],
+        ['points', 4, 2, 'points', 3],
+        ['points', 5, 3, 'points', 1],
+        ['polygons', 3, 2, 'polygons', 1],
+        ['polygons', 4, 2, 'polygons', 2],
+        ['polygons', 5, 3, 'polygons', 2]
+      ]
+    )
+
+  def test_get_table_status(self):
+    self.pgdb.connect()
+    status = self.pgdb.get_table_status('null_geoms', 'points')
+    self.assertEqual(status.table, 'points')
+    self.assertFalse(status.spatial_index)
+    self.assertIsNone(self.pgdb.get_table_status('null_geoms', 'xxxx'))
+
+  def test_get_table_fingerprint(self):
+    self.pgdb.connect()
+    self.assertEqual(
+      self.pgdb.get_table_fingerprint('null_geoms', 'points', True),
+      self.pgdb.get_table_fingerprint('null_geoms', 'points', True)
+    )
+    self.assertIsNone(self.pgdb.get_table_fingerprint('null_geoms', 'xxxx'))
+
+  def test_copy_table_rule_from_table(self):
+    self.pgdb.connect()
+    out = io.StringIO()
+    self.pgdb.copy_table_rule_from_table('multi_geoms', 'points', 'multipart', out)
+    self.assertEqual(out.getvalue(), '2,3\n4,3\n')
+
+  def test_profiles(self):
+    self.pgdb.profiles = []
+    self.pgdb.explain = True
+    self.pgdb.connect()
+    with self.pgdb.tagged(schema='multi_geoms', table='points', rule='multipart'):
+      self.pgdb.get_multipart_geoms_from_table('multi_geoms', 'points')
+    self.assertEqual(len(self.pgdb.profiles), 1)
+    profile = self.pgdb.profiles[0]
+    self.assertEqual(
+      [profile['schema'], profile['table'], profile['rule'], profile['rows']],
+      ['multi_geoms', 'points', 'multipart', 3]
+    )
+    self.assertGreaterEqual(profile['wall_time'], profile['time'])
+    self.assertIn('Plan', profile['explain'][0])
+
+  def test_iter_query_result(self):
+    self.pgdb.connect()
+    rows = self.pgdb.iter_query_result(
+      'SELECT id FROM invalid_geoms.linestrings ORDER BY id;', 2
+    )
+    self.assertEqual([row[0] for row in rows], [1, 2, 3, 4, 5])
+    with self.assertRaises(Exception):
+      list(self.pgdb.iter_query_result('SELECT COUNT(*) FROM xxxx.yyyy;'))
+    rows = self.pgdb.get_query_result(
+      'SELECT COUNT(*) FROM invalid_geoms.linestrings;'
+    )
+    self.assertEqual(rows[0][0], 5)
+
+  def test_get_null_geoms_from_table_stream(self):
+    self.pgdb.connect()
+    nuls = self.pgdb.get_null_geoms_from_table('null_geoms', 'points', True)
+    self.assertFalse(isinstance(nuls, list))
+    self.assertEqual([nul.id for nul in nuls], [2, 4, 5])
+
+class TestPGDBManagerPool(unittest.TestCase):
+  def setUp(self):
+    self.pgdbs = PGDBManagerPool(
+      2, 'local-data-server', 5432, 'test_vector_db', 'postgres', 'diablo2'
+    )
+
+  def tearDown(self):
+    self.pgdbs.close()
+
+  def test_acquire(self):
+    with self.assertRaises(PGDBManagerError):
+      self.pgdbs.acquire()
+    self.pgdbs.connect()
+    pgdb1 = self.pgdbs.acquire()
+    pgdb2 = self.pgdbs.acquire()
+    self.assertIsNot(pgdb1, pgdb2)
+    self.assertIsNot(pgdb1._conn, pgdb2._conn)
+    self.pgdbs.release(pgdb1)
+    self.pgdbs.release(pgdb2)
+
+  def test_manager(self):
+    self.pgdbs.connect()
+    with self.pgdbs.manager() as pgdb:
+      rows = pgdb.get_query_result(
+        'SELECT COUNT(*) FROM invalid_geoms.linestrings;'
+      )
+    self.assertEqual(rows[0][0], 5)
+
 class TestPGDBFunctions(unittest.TestCase):
   def test_invalid_geoms_query(self):
     schema = 'invalid_geoms'
@@ -144,6 +316,139 @@ class TestPGDBFunctions(unittest.TestCase):
       expected
     )
   
+  def test_table_rules_query(self):
+    schema = 'multi_geoms'
+    table = 'points'
+    expected = (
+      'SELECT id, '
+      'false, NULL, NULL, '
+      '0, '
+      'num, '
+      'nul '
+      'FROM ('
+      'SELECT id, ST_NumGeometries(geom) AS num, geom IS NULL AS nul '
+      'FROM {}.{} OFFSET 0'
+      ') rules '
+      'WHERE num > 1 OR nul '
+      'ORDER BY id'
+    ).format(schema, table)
+    actual = table_rules_query(schema, table, ['multipart', 'null'])
+    self.assertEqual(
+      actual,
+      expected
+    )
+
+  def test_table_rules_query_ids(self):
+    actual = table_rules_query('multi_geoms', 'points', ['null'], ids=[3, 1])
+    self.assertIn(
+      "FROM multi_geoms.points WHERE id = ANY('{3,1}'::bigint[]) OFFSET 0) rules ",
+      actual
+    )
+    actual = table_rules_query('multi_geoms', 'points', ['duplicate'], ids=[3])
+    self.assertIn(
+      'FROM multi_geoms.points WHERE id IN ('
+      'SELECT t.id FROM ONLY multi_geoms.points AS t '
+      'JOIN ONLY multi_geoms.points AS c ON t.geom ~= c.geom '
+      "WHERE c.id = ANY('{3}'::bigint[])) OFFSET 0) scan) counts) rules ",
+      actual
+    )
+
+  def test_table_rules_query_children(self):
+    # child tables are controlled as by the per rule queries, but duplicates
+    # are only looked for in the table itself
+    actual = table_rules_query('multi_geoms', 'points', ['invalid', 'duplicate'])
+    self.assertIn(' FROM multi_geoms.points OFFSET 0)', actual)
+    self.assertNotIn('FROM ONLY', actual)
+    self.assertIn("CASE WHEN tableoid = 'multi_geoms.points'::regclass", actual)
+
+  def test_table_rules_query_duplicate(self):
+    # rows are grouped by fingerprint, and the exact geometry is only compared
+    # within repeated fingerprints
+    actual = table_rules_query('multi_geoms', 'points', ['duplicate'])
+    self.assertIn('COUNT(*) OVER(PARTITION BY fp) END AS n', actual)
+    self.assertIn('PARTITION BY fp, CASE WHEN n > 1 THEN ST_AsEWKB(geom) END ORDER BY id', actual)
+    self.assertNotIn('PARTITION BY md5', actual)
+
+  def test_table_rule_copy_query(self):
+    expected = (
+      'COPY ('
+      'SELECT id, num '
+      'FROM ({}) AS r(id, invalid, reason, location, dup, num, nul) '
+      'ORDER BY id'
+      ') TO STDOUT WITH CSV'
+    ).format(table_rules_query('multi_geoms', 'points', ['multipart']))
+    self.assertEqual(table_rule_copy_query('multi_geoms', 'points', 'multipart'), expected)
+
+  def test_duplicate_hash_geoms_query(self):
+    schema = 'duplicate_geoms'
+    table = 'points'
+    expected = (
+      'SELECT id, row '
+      'FROM ('
+      'SELECT t.id, ROW_NUMBER() OVER(PARTITION BY c.fp, ST_AsEWKB(ST_Normalize(t.geom)) '
+      'ORDER BY t.id asc) AS row '
+      'FROM ('
+      'SELECT id, fp, COUNT(*) OVER(PARTITION BY fp) AS n '
+      'FROM ('
+      'SELECT id, md5(ST_AsEWKB(ST_Normalize(geom))) AS fp '
+      'FROM ONLY {0}.{1} '
+      'WHERE geom IS NOT NULL'
+      ') fps'
+      ') c '
+      'JOIN ONLY {0}.{1} AS t ON t.id = c.id '
+      'WHERE c.n > 1'
+      ') dups '
+      'WHERE dups.row > 1 '
+      'ORDER BY id'
+    ).format(schema, table)
+    actual = duplicate_hash_geoms_query(schema, table, True)
+    self.assertEqual(
+      actual,
+      expected
+    )
+
+  def test_schema_duplicate_geoms_query(self):
+    actual = schema_duplicate_geoms_query('duplicate_geoms', ['points', 'polygons'])
+    self.assertIn(
+      "SELECT 'points' AS tname, id, md5(ST_AsEWKB(geom)) AS fp "
+      'FROM ONLY duplicate_geoms.points WHERE geom IS NOT NULL UNION ALL ',
+      actual
+    )
+    self.assertIn(
+      "JOIN ONLY duplicate_geoms.polygons AS t ON c.tname = 'polygons' AND t.id = c.id",
+      actual
+    )
+    self.assertTrue(actual.endswith('ORDER BY tname, id'))
+
+  def test_table_row_results(self):
+    actual = [
+      (rule, res.to_list()) for rule, res in table_row_results(
+        (1, True, 'Self-intersection', 'POINT(1 1)', 0, 1, False)
+      )
+    ]
+    self.assertEqual(
+      actual,
+      [('invalid', [1, 'Self-intersection', 'POINT(1 1)'])]
+    )
+    actual = [
+      (rule, res.to_list()) for rule, res in table_row_results(
+        (2, False, None, None, 2, 3, False)
+      )
+    ]
+    self.assertEqual(
+      actual,
+      [('duplicate', [2, 2]), ('multipart', [2, 3])]
+    )
+    actual = [
+      (rule, res.to_list()) for rule, res in table_row_results(
+        (3, None, None, None, 0, None, True)
+      )
+    ]
+    self.assertEqual(
+      actual,
+      [('null', [3])]
+    )
+
   def test_point_in_geojson_geom(self):
     self.assertTrue(
       point_in_geojson_geom(
@@ -179,5 +484,243 @@ class TestPGDBFunctions(unittest.TestCase):
       )
     )
   
+  def test_table_status_query(self):
+    expected = (
+      "SELECT 'points', "
+      'EXISTS (SELECT 1 FROM pg_indexes '
+      "WHERE schemaname = 'null_geoms' AND tablename = 'points' "
+      "AND indexdef ILIKE '%USING gist (geom)%'), "
+      'GREATEST(s.last_analyze, s.last_autoanalyze), s.n_live_tup, s.n_mod_since_analyze '
+      'FROM pg_stat_user_tables AS s '
+      "WHERE s.schemaname = 'null_geoms' AND s.relname = 'points'"
+    )
+    self.assertEqual(table_status_query('null_geoms', 'points'), expected)
+
+  def test_table_fingerprint_query(self):
+    expected = (
+      "SELECT count(*) || ':' || "
+      "COALESCE(sum(('x' || substr(md5(t::text), 1, 16))::bit(64)::bigint::numeric), 0) "
+      'FROM null_geoms.points AS t'
+    )
+    self.assertEqual(table_fingerprint_query('null_geoms', 'points', True), expected)
+    actual = table_fingerprint_query('null_geoms', 'points')
+    self.assertIn("WHERE n.nspname = 'null_geoms' AND c.relname = 'points'", actual)
+    # child tables change the fingerprint too
+    self.assertIn('JOIN rels ON i.inhparent = rels.oid', actual)
+
+  def test_schema_names_query(self):
+    expected = (
+      'SELECT nspname FROM pg_namespace '
+      "WHERE nspname LIKE '%_geoms' "
+      "AND nspname NOT LIKE 'pg\\_%' "
+      "AND nspname NOT IN ('information_schema', 'controls_changelog') "
+      'ORDER BY nspname'
+    )
+    self.assertEqual(schema_names_query('%_geoms'), expected)
+
+  def test_prepared_queries(self):
+    self.assertEqual(
+      schema_tables_query('null_geoms', True),
+      'SELECT tablename FROM pg_tables WHERE schemaname = $1 ORDER BY tablename'
+    )
+    self.assertIn(
+      'WHERE s.schemaname = $1 AND s.relname = $2',
+      table_status_query('null_geoms', 'points', True)
+    )
+    self.assertEqual(
+      prepare_query('schema_tables', 'SELECT 1', 2),
+      'PREPARE schema_tables(text, text) AS SELECT 1'
+    )
+    self.assertEqual(
+      execute_prepared_query('table_status', ['null_geoms', 'points']),
+      "EXECUTE table_status('null_geoms', 'points')"
+    )
+
+  def test_table_status_result(self):
+    self.assertTrue(TableStatusResult('points', True, None, 5, 0).stale_statistics())
+    self.assertFalse(TableStatusResult('points', True, 1, 100, 10).stale_statistics())
+    self.assertTrue(TableStatusResult('points', True, 1, 100, 11).stale_statistics())
+
+  def test_geojson_vertices(self):
+    self.assertEqual(
+      geojson_vertices({
+        'type': 'MultiLineString',
+        'coordinates': [[[1, 1], [0, 0]], [[3, 3], [4, 4]]]
+      }),
+      [[1, 1], [0, 0], [3, 3], [4, 4]]
+    )
+    self.assertEqual(
+      geojson_vertices({'type': 'Point', 'coordinates': [0, 0]}),
+      []
+    )
+
+  def test_point_in_vertex_index(self):
+    geom = {
+      'type': 'Polygon',
+      'coordinates': [
+        [[3, 3], [0, 3], [0, 0], [3, 0], [3, 3]],
+        [[2, 2], [1, 2], [1, 1], [2, 1], [2, 2]]
+      ]
+    }
+    index = VertexIndex(geojson_vertices(geom))
+    self.assertEqual(len(index), 8)
+    self.assertTrue(point_in_vertex_index([0, 0], index))
+    self.assertTrue(point_in_vertex_index([1, 2], index))
+    self.assertFalse(point_in_vertex_index([1, 3], index))
+    self.assertFalse(point_in_vertex_index([0.0001, 0], index))
+    index = VertexIndex(geojson_vertices(geom), 0.001)
+    self.assertTrue(point_in_vertex_index([0.0001, 0], index))
+    self.assertFalse(point_in_vertex_index([0.01, 0], index))
+
   def test_intersection_query(self):
-    pass
\ No newline at end of file
+    actual = intersection_query('hidro', 'canal_l', 'agua_a')
+    self.assertTrue(actual.startswith('SELECT t1id, t2id, ST_AsGeoJSON(gi, 3), '))
+    self.assertIn('FROM hidro.canal_l AS t1, hidro.agua_a AS t2 WHERE ', actual)
+
+  def test_intersection_pairs_query_ids(self):
+    actual = intersection_pairs_query('hidro', 'canal_l', 'agua_a', ([1], []))
+    self.assertIn("AND t1.id = ANY('{1}'::bigint[])) UNION ALL (", actual)
+    self.assertTrue(actual.endswith(
+      "AND t2.id = ANY('{}'::bigint[]) AND NOT t1.id = ANY('{1}'::bigint[])) ORDER BY t1id"
+    ))
+
+  def test_grid_tiles(self):
+    tiles = grid_tiles((0.0, 0.0, 10.0, 10.0), 4326, 2)
+    self.assertEqual([str(tile) for tile in tiles], ['1/4', '2/4', '3/4', '4/4'])
+    self.assertEqual(
+      tiles[0].sql(),
+      '((geom && ST_MakeEnvelope(0.0, 0.0, 5.0, 5.0, 4326) '
+      'AND ST_XMin(geom) < 5.0 AND ST_YMin(geom) < 5.0) '
+      'OR geom IS NULL OR ST_IsEmpty(geom))'
+    )
+    self.assertEqual(
+      tiles[3].sql('t1.'),
+      't1.geom && ST_MakeEnvelope(5.0, 5.0, 10.0, 10.0, 4326) '
+      'AND ST_XMin(t1.geom) >= 5.0 AND ST_YMin(t1.geom) >= 5.0'
+    )
+
+  def test_id_range_tiles(self):
+    tiles = id_range_tiles(1, 10, 3)
+    self.assertEqual(
+      [tile.sql() for tile in tiles],
+      ['id < 5', 'id >= 5 AND id < 9', 'id >= 9']
+    )
+    self.assertEqual([tile.sql() for tile in id_range_tiles(5, 5, 4)], ['true'])
+    self.assertEqual(TableTile().sql(), 'true')
+
+  def test_table_rules_query_tile(self):
+    actual = table_rules_query('multi_geoms', 'points', ['null'], tile=id_range_tiles(1, 10, 3)[1])
+    self.assertIn('FROM multi_geoms.points WHERE id >= 5 AND id < 9 OFFSET 0) rules ', actual)
+
+  def test_changes_query(self):
+    self.assertEqual(
+      changes_query('hidro'),
+      'SELECT table_name, array_agg(id ORDER BY id), array_agg(seq ORDER BY id) '
+      'FROM controls_changelog.changes '
+      "WHERE schema_name = 'hidro' "
+      'GROUP BY table_name'
+    )
+    self.assertEqual(
+      clear_changes_query('hidro', 'agua_a', [1, 2], [10, 12]),
+      'DELETE FROM controls_changelog.changes AS c '
+      "USING unnest('{1,2}'::bigint[], '{10,12}'::bigint[]) AS d(id, seq) "
+      "WHERE c.schema_name = 'hidro' AND c.table_name = 'agua_a' "
+      'AND c.id = d.id AND c.seq = d.seq'
+    )
+    self.assertEqual(ids_sql([]), "'{}'::bigint[]")
+
+  def test_binary_geoms_sql(self):
+    self.assertEqual(binary_geoms_sql('false'), 'NULL, NULL')
+    self.assertEqual(
+      binary_geoms_sql('true'),
+      "CASE WHEN true AND t1_crosses_t2 AND ST_GeometryType(gi) IN ('ST_Point', 'ST_LineString') "
+      'THEN ST_AsBinary(g1) END, '
+      "CASE WHEN true AND t1_crosses_t2 AND ST_GeometryType(gi) IN ('ST_Point', 'ST_LineString') "
+      'THEN ST_AsBinary(g2) END'
+    )
+
+  def test_intersection_wkb_query(self):
+    actual = intersection_wkb_query('hidro', 'canal_l', 'agua_a', 'false')
+    self.assertTrue(actual.startswith(
+      'SELECT t1id, t2id, ST_AsBinary(gi), NULL, NULL, t1_crosses_t2, ST_Dimension(gi) FROM ('
+    ))
+
+  def test_schema_layers_query(self):
+    expected = (
+      'CREATE TEMP TABLE layers AS '
+      "SELECT 0 AS ord, 'agua_a'::text AS layer, id, geom::geometry AS geom "
+      'FROM hidro.agua_a '
+      'WHERE geom IS NOT NULL '
+      'UNION ALL '
+      "SELECT 1 AS ord, 'canal_l'::text AS layer, id, geom::geometry AS geom "
+      'FROM hidro.canal_l '
+      'WHERE geom IS NOT NULL'
+    )
+    actual = schema_layers_query('hidro', ['agua_a', 'canal_l'], 'layers')
+    self.assertEqual(
+      actual,
+      expected
+    )
+
+  def test_schema_intersection_query(self):
+    actual = schema_intersection_query('layers')
+    self.assertIn('ST_Dimension(gi), layer1, layer2 FROM (', actual)
+    self.assertIn('FROM layers AS t1 JOIN layers AS t2 ON t1.ord < t2.ord ', actual)
+    self.assertIn('ORDER BY t1.ord, t2.ord, t1.id', actual)
+
+  def test_vertex_match_sql(self):
+    expected = (
+      'round(ST_X(v)::numeric, 3) IS NOT DISTINCT FROM round(ST_X(p)::numeric, 3) AND '
+      'round(ST_Y(v)::numeric, 3) IS NOT DISTINCT FROM round(ST_Y(p)::numeric, 3) AND '
+      'round(ST_Z(v)::numeric, 3) IS NOT DISTINCT FROM round(ST_Z(p)::numeric, 3)'
+    )
+    self.assertEqual(vertex_match_sql('v', 'p'), expected)
+
+  def test_admissible_sql(self):
+    self.assertEqual(admissible_sql(None, 'layer2'), 'false')
+    self.assertEqual(
+      admissible_sql(['agua_a', 'canal_l'], 'layer2'),
+      "layer2 IN ('agua_a', 'canal_l')"
+    )
+
+  def test_admissibility_query(self):
+    actual = admissibility_query('SELECT 1', 'true', True)
+    self.assertTrue(actual.startswith(
+      'SELECT t1id, t2id, msg, ST_AsText(ST_Multi(gi)), ST_Dimension(gi), '
+      "ST_GeometryType(gi) = 'ST_GeometryCollection', layer1, layer2 FROM ("
+    ))
+    self.assertIn("WHEN NOT (true) THEN 'not addmissible intersection' ", actual)
+    self.assertTrue(actual.endswith(
+      "THEN 'crosses' END AS msg FROM (SELECT 1) AS pairs) AS verdicts WHERE msg IS NOT NULL"
+    ))
+
+  def test_result_set(self):
+    results = ResultSet(InvalidGeomResult, [
+      InvalidGeomResult(2, ''.join(['Self-', 'intersection']), 'POINT(0 0)'),
+      InvalidGeomResult(4, ''.join(['Self-', 'intersection']), None)
+    ])
+    self.assertEqual(len(results), 2)
+    self.assertEqual(
+      results.to_list(),
+      [[2, 'Self-intersection', 'POINT(0 0)'], [4, 'Self-intersection', None]]
+    )
+    self.assertEqual(results[1].id, 4)
+    self.assertEqual(results.column('id').typecode, 'q')
+    self.assertIs(results.column('reason')[0], results.column('reason')[1])
+    # ids that are not integers are kept in a list
+    results.append(InvalidGeomResult('a', None, None))
+    self.assertEqual(list(results.column('id')), [2, 4, 'a'])
+    self.assertFalse(ResultSet(NullGeomResult))
+    with self.assertRaises(AttributeError):
+      NullGeomResult().other = 1
+
+  def test_intersect_geom_result(self):
+    row = ['canal_l', 1, 'agua_a', 2, 'MULTIPOINT(0 0)', 'crosses']
+    res = IntersectGeomResult()
+    res.from_list(row)
+    self.assertEqual(res.to_list(), row)
+    values = NotAllowedIntersectionsResult()
+    self.assertFalse(values)
+    values.point.append(res)
+    self.assertTrue(values)
+    self.assertEqual(len(NotAllowedIntersectionsResult().point), 0)
\ No newline at end of file
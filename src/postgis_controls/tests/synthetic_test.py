@@ -0,0 +1,87 @@
+import unittest
+
+from src.postgis_controls.synthetic import (
+  DEFAULT_RATIOS, RATIO_BLOCK, synthetic_table_names, synthetic_geom_type,
+  synthetic_base_sql, synthetic_kind_limits, synthetic_kind_sql, synthetic_table_query,
+  synthetic_schema_query, synthetic_counts
+)
+from src.postgis_controls.pgdb import PGDBManager
+
+class TestSyntheticSchema(unittest.TestCase):
+  def setUp(self):
+    self.pgdb = PGDBManager(
+      'local-data-server', 5432, 'test_vector_db', 'postgres', 'diablo2'
+    )
+
+  def test_synthetic_table_query(self):
+    self.pgdb.connect()
+    tables = synthetic_table_names(3)
+    self.pgdb.execute_query(synthetic_schema_query('synthetic_benchmark'))
+    for i, table in enumerate(tables):
+      self.pgdb.execute_query(
+        synthetic_table_query('synthetic_benchmark', table, i, 3, 1000, 8, DEFAULT_RATIOS)
+      )
+    counts = synthetic_counts(1000, DEFAULT_RATIOS, 'polygon')
+    self.assertEqual(self.pgdb.get_table_count('synthetic_benchmark', 't002_polygon'), 1000)
+    self.assertEqual(
+      len(self.pgdb.get_null_geoms_from_table('synthetic_benchmark', 't002_polygon')),
+      counts['null']
+    )
+    self.assertEqual(
+      len(self.pgdb.get_invalid_geoms_from_table('synthetic_benchmark', 't002_polygon')),
+      counts['invalid']
+    )
+    self.assertEqual(
+      len(self.pgdb.get_multipart_geoms_from_table('synthetic_benchmark', 't002_polygon')),
+      counts['multipart']
+    )
+    self.assertEqual(
+      len(self.pgdb.get_invalid_geoms_from_table('synthetic_benchmark', 't000_point')),
+      0
+    )
+
+class TestSyntheticFunctions(unittest.TestCase):
+
+  def test_synthetic_table_names(self):
+    self.assertEqual(
+      synthetic_table_names(4),
+      ['t000_point', 't001_linestring', 't002_polygon', 't003_point']
+    )
+    self.assertEqual(synthetic_geom_type('t001_linestring'), 'linestring')
+
+  def test_synthetic_base_sql(self):
+    valid, invalid, multi = synthetic_base_sql('polygon', 8)
+    self.assertIn('generate_series(0, 8)', valid)
+    self.assertIn('ST_Collect', multi)
+    valid, invalid, multi = synthetic_base_sql('point', 8)
+    self.assertEqual(valid, invalid)
+    with self.assertRaises(ValueError):
+      synthetic_base_sql('curve', 8)
+
+  def test_synthetic_kind_sql(self):
+    self.assertEqual(
+      synthetic_kind_limits({'null': 0.01, 'invalid': 0, 'duplicate': 0.02}),
+      [(100, 'null'), (300, 'duplicate')]
+    )
+    self.assertEqual(synthetic_kind_sql({}), "'valid'")
+    self.assertEqual(
+      synthetic_kind_sql({'null': 0.5}),
+      "CASE WHEN ((i * 7919) % 10000) < 5000 THEN 'null' ELSE 'valid' END"
+    )
+
+  def test_synthetic_counts(self):
+    counts = synthetic_counts(RATIO_BLOCK, DEFAULT_RATIOS)
+    for kind, ratio in DEFAULT_RATIOS.items():
+      self.assertEqual(counts[kind], ratio * RATIO_BLOCK)
+    counts = synthetic_counts(RATIO_BLOCK, DEFAULT_RATIOS, 'point')
+    self.assertNotIn('invalid', counts)
+    self.assertEqual(sum(counts.values()), RATIO_BLOCK)
+
+  def test_synthetic_table_query(self):
+    query = synthetic_table_query('s', 't000_point', 0, 1, 100, 8, DEFAULT_RATIOS)
+    self.assertIn('CREATE TABLE s.t000_point', query)
+    self.assertIn('generate_series(1, 100)', query)
+    # a single table has no other table to intersect
+    self.assertIn('ST_Translate(valid, x + 0, y)', query)
+    query = synthetic_table_query('s', 't001_linestring', 1, 2, 100, 8, DEFAULT_RATIOS)
+    self.assertIn('ST_Translate(valid, x + -2, y)', query)
@@ -0,0 +1,80 @@
+import unittest
+import struct
+
+from src.postgis_controls.wkb import (
+  WKBGeometry, WKBError, decode_wkb, decode_wkb_batch
+)
+
+def point_wkb(x, y):
+  return struct.pack('<BIdd', 1, 1, x, y)
+
+def linestring_z_wkb(coords):
+  return struct.pack('<BII', 1, 1002, len(coords))\
+    + struct.pack('<{}d'.format(3 * len(coords)), *[c for p in coords for c in p])
+
+def polygon_wkb(rings):
+  data = struct.pack('>BII', 0, 3, len(rings))
+  for ring in rings:
+    data += struct.pack('>I', len(ring))
+    data += struct.pack('>{}d'.format(2 * len(ring)), *[c for p in ring for c in p])
+  return data
+
+class TestWKBFunctions(unittest.TestCase):
+  def test_decode_wkb_measured(self):
+    # iso and extended codes of a point with a measure
+    for code in [2001, 1 | 0x40000000]:
+      geom = decode_wkb(struct.pack('<BIddd', 1, code, 1, 2, 3))
+      self.assertEqual(geom.dims, 3)
+      self.assertEqual(geom.to_wkt(), 'POINT M (1 2 3)')
+      self.assertEqual(geom.multi().to_wkt(), 'MULTIPOINT M (1 2 3)')
+    geom = decode_wkb(struct.pack('<BIdddd', 1, 3001, 1, 2, 3, 4))
+    self.assertEqual(geom.to_wkt(), 'POINT ZM (1 2 3 4)')
+    self.assertEqual(
+      decode_wkb(linestring_z_wkb([(0, 0, 1), (1, 1, 2)])).to_wkt(),
+      'LINESTRING Z (0 0 1,1 1 2)'
+    )
+
+  def test_decode_wkb(self):
+    geom = decode_wkb(point_wkb(1.5, 2))
+    self.assertEqual(geom.type, 'Point')
+    self.assertEqual(geom.dims, 2)
+    self.assertEqual(geom.endpoints(), [(1.5, 2.0)])
+    self.assertIsNone(decode_wkb(None))
+    with self.assertRaises(WKBError):
+      decode_wkb(struct.pack('<BI', 1, 99))
+
+  def test_decode_ewkb(self):
+    data = struct.pack('<BIIddd', 1, 1 | 0x80000000 | 0x20000000, 4326, 1, 2, 3)
+    geom = decode_wkb(data)
+    self.assertEqual(geom.type, 'Point')
+    self.assertEqual(geom.dims, 3)
+    self.assertEqual(geom.to_wkt(), 'POINT Z (1 2 3)')
+
+  def test_decode_wkb_batch(self):
+    geoms = decode_wkb_batch([
+      point_wkb(0, 0),
+      linestring_z_wkb([(0, 0, 1), (1, 1, 2), (3, 3, 4)]),
+      polygon_wkb([[(0, 0), (0, 1), (1, 1), (0, 0)]]),
+      None
+    ])
+    self.assertIs(geoms[0].buffer, geoms[2].buffer)
+    self.assertEqual(
+      geoms[1].endpoints(),
+      [(0.0, 0.0, 1.0), (3.0, 3.0, 4.0)]
+    )
+    self.assertEqual(
+      list(geoms[2].vertices()),
+      [(0.0, 0.0), (0.0, 1.0), (1.0, 1.0), (0.0, 0.0)]
+    )
+    self.assertIsNone(geoms[3])
+
+  def test_to_wkt(self):
+    geom = decode_wkb(linestring_z_wkb([(0, 0, 1), (1.25, 1, 2)]))
+    self.assertEqual(geom.to_wkt(), 'LINESTRING Z (0 0 1,1.25 1 2)')
+    self.assertEqual(str(geom.multi()), 'MULTILINESTRING Z ((0 0 1,1.25 1 2))')
+    geom = decode_wkb(polygon_wkb([[(0, 0), (0, 1), (1, 1), (0, 0)]]))
+    self.assertEqual(str(geom.multi()), 'MULTIPOLYGON(((0 0,0 1,1 1,0 0)))')
+    geom = decode_wkb(point_wkb(float('nan'), float('nan')))
+    self.assertTrue(geom.is_empty())
+    self.assertEqual(str(geom.multi()), 'MULTIPOINT EMPTY')
+    self.assertEqual(str(WKBGeometry('GeometryCollection')), 'GEOMETRYCOLLECTION EMPTY')
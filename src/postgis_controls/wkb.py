@@ -0,0 +1,194 @@
+'''
+postgis_controls.wkb
+'''
+
+import sys
+import struct
+from array import array
+
+WKB_TYPES = {
+  1: 'Point',
+  2: 'LineString',
+  3: 'Polygon',
+  4: 'MultiPoint',
+  5: 'MultiLineString',
+  6: 'MultiPolygon',
+  7: 'GeometryCollection'
+}
+
+MULTI_TYPES = {
+  'Point': 'MultiPoint',
+  'LineString': 'MultiLineString',
+  'Polygon': 'MultiPolygon'
+}
+
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+NATIVE_ORDER = 1 if sys.byteorder == 'little' else 0
+
+class WKBError(Exception):
+  pass
+
+class WKBGeometry:
+  def __init__(self, type=None, dims=2, buffer=None, seqs=None, geoms=None, measured=False):
+    self.type = type
+    self.dims = dims
+    # the last coordinate is a measure, for 3 dimensional geometries without z
+    self.measured = measured
+    self.buffer = buffer
+    # (offset, count) coordinate ranges in buffer, for points, lines and rings
+    self.seqs = seqs or []
+    # member geometries, for multi geometries and collections
+    self.geoms = geoms or []
+
+  def coords(self, seq):
+    offset, count = seq
+    return [
+      tuple(self.buffer[offset + i * self.dims:offset + (i + 1) * self.dims])
+      for i in range(count)
+    ]
+
+  def vertices(self):
+    if self.type in ['LineString', 'Polygon']:
+      for seq in self.seqs:
+        for v in self.coords(seq):
+          yield v
+    elif self.type in ['MultiLineString', 'MultiPolygon']:
+      for geom in self.geoms:
+        for v in geom.vertices():
+          yield v
+
+  def endpoints(self):
+    if self.type == 'Point' and self.seqs and self.seqs[0][1]:
+      return self.coords(self.seqs[0])
+    elif self.type == 'LineString' and self.seqs and self.seqs[0][1]:
+      offset, count = self.seqs[0]
+      return [
+        self.coords((offset, 1))[0],
+        self.coords((offset + (count - 1) * self.dims, 1))[0]
+      ]
+    return []
+
+  def is_empty(self):
+    if self.type in ['Point', 'LineString']:
+      return not self.seqs or not self.seqs[0][1]
+    elif self.type == 'Polygon':
+      return not self.seqs
+    return not self.geoms
+
+  def multi(self):
+    if self.type in MULTI_TYPES:
+      return WKBGeometry(
+        MULTI_TYPES[self.type],
+        self.dims,
+        self.buffer,
+        geoms=[] if self.is_empty() else [self],
+        measured=self.measured
+      )
+    return self
+
+  def _wkt_seq(self, seq):
+    return ','.join([
+      ' '.join(['{:.15g}'.format(c) for c in coord]) for coord in self.coords(seq)
+    ])
+
+  def _wkt_body(self):
+    if self.is_empty():
+      return None
+    elif self.type in ['Point', 'LineString']:
+      return '({})'.format(self._wkt_seq(self.seqs[0]))
+    elif self.type == 'Polygon':
+      return '({})'.format(','.join(['({})'.format(self._wkt_seq(seq)) for seq in self.seqs]))
+    elif self.type == 'MultiPoint':
+      return '({})'.format(','.join([
+        g._wkt_seq(g.seqs[0]) if not g.is_empty() else 'EMPTY' for g in self.geoms
+      ]))
+    elif self.type == 'GeometryCollection':
+      return '({})'.format(','.join([g.to_wkt() for g in self.geoms]))
+    return '({})'.format(','.join([g._wkt_body() or 'EMPTY' for g in self.geoms]))
+
+  def to_wkt(self):
+    name = self.type.upper()
+    if self.dims == 3:
+      name = '{} {} '.format(name, 'M' if self.measured else 'Z')
+    elif self.dims == 4:
+      name = '{} ZM '.format(name)
+    body = self._wkt_body()
+    if body is None:
+      return '{} EMPTY'.format(name.strip())
+    return '{}{}'.format(name, body)
+
+  def __str__(self):
+    return self.to_wkt()
+
+class _WKBReader:
+  def __init__(self, buffer):
+    self.buffer = buffer
+
+  def read(self, data):
+    self.data = bytes(data)
+    self.offset = 0
+    return self._geometry()
+
+  def _uint32(self, order):
+    fmt = '<I' if order == 1 else '>I'
+    value = struct.unpack_from(fmt, self.data, self.offset)[0]
+    self.offset += 4
+    return value
+
+  def _seq(self, order, dims, count):
+    offset = len(self.buffer)
+    size = 8 * dims * count
+    coords = array('d')
+    coords.frombytes(self.data[self.offset:self.offset + size])
+    if order != NATIVE_ORDER:
+      coords.byteswap()
+    self.buffer.extend(coords)
+    self.offset += size
+    return (offset, count)
+
+  def _geometry(self):
+    order = self.data[self.offset]
+    self.offset += 1
+    code = self._uint32(order)
+    dims = 2
+    if code & (EWKB_Z | EWKB_M | EWKB_SRID):
+      dims += (1 if code & EWKB_Z else 0) + (1 if code & EWKB_M else 0)
+      measured = bool(code & EWKB_M) and not code & EWKB_Z
+      if code & EWKB_SRID:
+        self.offset += 4
+      code &= 0x0fffffff
+    else:
+      dims += [0, 1, 1, 2][code // 1000]
+      measured = code // 1000 == 2
+      code %= 1000
+    if code not in WKB_TYPES:
+      raise WKBError('Unknown WKB geometry type {}'.format(code))
+    geom = WKBGeometry(WKB_TYPES[code], dims, self.buffer, measured=measured)
+    if code == 1:
+      seq = self._seq(order, dims, 1)
+      # empty points are written as NaN coordinates
+      if self.buffer[seq[0]] != self.buffer[seq[0]]:
+        seq = (seq[0], 0)
+      geom.seqs = [seq]
+    elif code == 2:
+      geom.seqs = [self._seq(order, dims, self._uint32(order))]
+    elif code == 3:
+      geom.seqs = [
+        self._seq(order, dims, self._uint32(order))
+        for i in range(self._uint32(order))
+      ]
+    else:
+      geom.geoms = [self._geometry() for i in range(self._uint32(order))]
+    return geom
+
+def decode_wkb(data):
+  if data is None:
+    return None
+  return _WKBReader(array('d')).read(data)
+
+def decode_wkb_batch(blobs):
+  reader = _WKBReader(array('d'))
+  return [reader.read(blob) if blob is not None else None for blob in blobs]
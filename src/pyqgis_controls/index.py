@@ -0,0 +1,71 @@
+""" Spatial indexes of the layers controlled by the pyqgis controls.
+
+pyqgis_controls.index
+"""
+import math
+from array import array
+
+from PyQt5.QtCore import QVariant
+from qgis.core import QgsFeatureRequest, QgsSpatialIndex, QgsRectangle
+
+def index_layer(source, fields, keep=False, store=None, schema=None, table=None):
+    """ Return the spatial index and the ids of the features of a layer, in a single pass.
+
+    Features are also copied to the store, if one is given.
+    """
+    request = QgsFeatureRequest()
+    if not store:
+        request.setSubsetOfAttributes(['id'], fields)
+    index = QgsSpatialIndex()
+    feat_ids = {}
+    # feature ids, ids and bounding boxes to cache, nan for no geometry
+    entries = (array('q'), array('q'), array('d')) if keep else None
+    for feature in source.getFeatures(request):
+        index.addFeature(feature)
+        feat_ids[feature.id()] = feature['id']
+        if store and not store.add(schema, table, feature):
+            store = None
+        if entries:
+            try:
+                entries[1].append(feature['id'])
+            except TypeError:
+                # ids that are not integers are not cached
+                entries = None
+                continue
+            entries[0].append(feature.id())
+            if feature.hasGeometry():
+                box = feature.geometry().boundingBox()
+                entries[2].extend([box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()])
+            else:
+                entries[2].extend([math.nan] * 4)
+    if store:
+        store.complete(schema, table)
+    return index, feat_ids, entries
+
+def stable_fids(layer):
+    """ Return True if the feature ids of a layer are its integer primary key, so they can be cached. """
+    pks = layer.dataProvider().pkAttributeIndexes()
+    return len(pks) == 1 and layer.fields().at(pks[0]).type() in (QVariant.Int, QVariant.LongLong)
+
+def save_index(file_path, entries):
+    """ Write the cached entries of a spatial index. """
+    with open(file_path, 'wb') as f:
+        array('q', [len(entries[0])]).tofile(f)
+        for a in entries:
+            a.tofile(f)
+
+def load_index(file_path):
+    """ Return the spatial index and the ids of the features of a layer, from cached entries. """
+    with open(file_path, 'rb') as f:
+        count = array('q')
+        count.fromfile(f, 1)
+        fids, ids, boxes = array('q'), array('q'), array('d')
+        fids.fromfile(f, count[0])
+        ids.fromfile(f, count[0])
+        boxes.fromfile(f, 4 * count[0])
+    index = QgsSpatialIndex()
+    for i, fid in enumerate(fids):
+        box = boxes[4 * i:4 * i + 4]
+        if not math.isnan(box[0]):
+            index.addFeature(fid, QgsRectangle(box[0], box[1], box[2], box[3]))
+    return index, dict(zip(fids, ids))
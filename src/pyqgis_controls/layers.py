@@ -0,0 +1,74 @@
+""" Registry of the PostGIS layers opened by the pyqgis controls.
+
+pyqgis_controls.layers
+"""
+import threading
+import gettext
+import logging
+
+from qgis.core import QgsDataSourceUri, QgsVectorLayer, QgsVectorLayerFeatureSource
+
+_ = gettext.gettext
+
+class LayerRegistry:
+    """ Open layers shared by the whole run, keyed by (schema, table).
+
+    Every layer is opened once, with its provider connection and metadata, and handed out
+    again on the next requests. Layers must be used from the thread that creates the
+    registry, workers read the feature sources instead. Features of the layers held by the
+    feature store, if any, are returned without a request to the database.
+    """
+
+    def __init__(self, uri, geom='geom', store=None, logger=None):
+        # parameters
+        self.uri = uri
+        self.geom = geom
+        self.store = store
+        self.logger = logger or logging.getLogger(__name__)
+        # internal
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def layer(self, schema, table):
+        """ Return the open layer of a table. """
+        key = (schema, table)
+        with self._lock:
+            if key not in self._layers:
+                uri = QgsDataSourceUri(self.uri.uri(False))
+                uri.setDataSource(schema, table, self.geom)
+                layer = QgsVectorLayer(uri.uri(False), table, 'postgres')
+                if not layer.isValid():
+                    self.logger.warning('{}: {}.{}'.format(_('Invalid layer'), schema, table))
+                self._layers[key] = layer
+            return self._layers[key]
+
+    def provider(self, schema, table):
+        """ Return the data provider of the open layer of a table. """
+        return self.layer(schema, table).dataProvider()
+
+    def source(self, schema, table):
+        """ Return a feature source of a table, that can be read from other threads. """
+        return QgsVectorLayerFeatureSource(self.layer(schema, table))
+
+    def features(self, schema, table, fids):
+        """ Return an iterable over the features of a list of feature ids. """
+        if self.store and self.store.has(schema, table):
+            return self.store.features(schema, table, fids)
+        return self.layer(schema, table).getFeatures(fids)
+
+    def feature(self, schema, table, fid):
+        """ Return the feature of a feature id. """
+        if self.store and self.store.has(schema, table):
+            return self.store.feature(schema, table, fid)
+        return self.layer(schema, table).getFeature(fid)
+
+    def clear(self):
+        """ Release the open layers. """
+        with self._lock:
+            self._layers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clear()
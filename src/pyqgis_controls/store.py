@@ -0,0 +1,106 @@
+""" In-memory store of the features of the indexed layers.
+
+pyqgis_controls.store
+"""
+import sys
+import threading
+import gettext
+import logging
+
+from qgis.core import QgsFeature
+
+_ = gettext.gettext
+
+# estimated bytes of a stored feature besides its coordinates and attributes
+FEATURE_OVERHEAD = 200
+
+def feature_size(feature):
+    """ Return the estimated memory, in bytes, of a copy of a feature. """
+    size = FEATURE_OVERHEAD + sum([sys.getsizeof(a) for a in feature.attributes()])
+    if feature.hasGeometry():
+        geometry = feature.geometry().constGet()
+        size += geometry.nCoordinates() * 8 * (3 if geometry.is3D() else 2)
+    return size
+
+class FeatureStore:
+    """ Geometries and attributes of the indexed layers, keyed by (schema, table) and feature id.
+
+    Layers are filled while their spatial index is built, and only complete layers are read
+    back. A layer that does not fit under the memory cap is dropped, and read from the
+    database instead.
+    """
+
+    def __init__(self, max_bytes=0, logger=None):
+        # parameters
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger(__name__)
+        # internal
+        self._layers = {}
+        self._sizes = {}
+        self._complete = set()
+        self._dropped = set()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def add(self, schema, table, feature):
+        """ Store a copy of a feature, return False once the layer does not fit under the cap. """
+        key = (schema, table)
+        size = feature_size(feature)
+        with self._lock:
+            if key in self._dropped:
+                return False
+            if self.max_bytes and self._used + size > self.max_bytes:
+                self._drop(key)
+                return False
+            self._layers.setdefault(key, {})[feature.id()] = QgsFeature(feature)
+            self._sizes[key] = self._sizes.get(key, 0) + size
+            self._used += size
+        return True
+
+    def _drop(self, key):
+        self._layers.pop(key, None)
+        self._used -= self._sizes.pop(key, 0)
+        self._complete.discard(key)
+        self._dropped.add(key)
+        self.logger.warning('{}: {}.{}'.format(
+            _('Feature store memory cap reached, layer read from the database'), key[0], key[1]))
+
+    def complete(self, schema, table):
+        """ Mark a layer as completely stored. """
+        key = (schema, table)
+        with self._lock:
+            if key not in self._dropped:
+                self._layers.setdefault(key, {})
+                self._complete.add(key)
+
+    def has(self, schema, table):
+        """ Return True if all the features of a layer are stored. """
+        return (schema, table) in self._complete
+
+    def feature(self, schema, table, fid):
+        """ Return a stored feature, or an invalid feature if there is none, as QgsVectorLayer.getFeature. """
+        feature = self._layers[(schema, table)].get(fid)
+        return feature if feature is not None else QgsFeature()
+
+    def features(self, schema, table, fids):
+        """ Return the stored features of a list of feature ids. """
+        layer = self._layers[(schema, table)]
+        return [layer[fid] for fid in fids if fid in layer]
+
+    def used(self):
+        """ Return the estimated memory used by the stored features, in bytes. """
+        return self._used
+
+    def report(self):
+        """ Return the stored features and estimated memory, in bytes, of each layer. """
+        with self._lock:
+            return {
+                'max_bytes': self.max_bytes,
+                'bytes': self._used,
+                'layers': {
+                    '{}.{}'.format(*key): {
+                        'features': len(self._layers[key]), 'bytes': self._sizes.get(key, 0)
+                    } for key in self._complete
+                },
+                'dropped': ['{}.{}'.format(*key) for key in self._dropped]
+            }
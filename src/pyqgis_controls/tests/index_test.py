@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyQt5.QtCore import QVariant
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry, QgsRectangle
+from qgis.testing import start_app
+
+from src.common.cache import ResultCache
+from src.pyqgis_controls.index import index_layer, stable_fids, save_index, load_index
+
+start_app()
+
+def features(rows):
+  fields = QgsFields()
+  fields.append(QgsField('id', QVariant.LongLong))
+  result = []
+  for fid, id, wkt in rows:
+    feature = QgsFeature(fields, fid)
+    feature.setAttributes([id])
+    if wkt:
+      feature.setGeometry(QgsGeometry.fromWkt(wkt))
+    result.append(feature)
+  return fields, result
+
+class FakeProvider:
+  def __init__(self, pks):
+    self.pks = pks
+
+  def pkAttributeIndexes(self):
+    return self.pks
+
+class FakeLayer:
+  def __init__(self, fields, pks):
+    self._fields = fields
+    self._provider = FakeProvider(pks)
+
+  def fields(self):
+    return self._fields
+
+  def dataProvider(self):
+    return self._provider
+
+class FakeSource:
+  def __init__(self, features):
+    self.features = features
+    self.requests = 0
+
+  def getFeatures(self, request):
+    self.requests += 1
+    return iter(self.features)
+
+class TestIndexLayer(unittest.TestCase):
+  def setUp(self):
+    self.fields, self.features = features([
+      (1, 10, 'POINT(0 0)'),
+      (2, 20, 'LINESTRING(5 5, 6 6)'),
+      (3, 30, None)
+    ])
+
+  def test_index_layer(self):
+    source = FakeSource(self.features)
+    index, feat_ids, entries = index_layer(source, self.fields)
+    # a single pass over the features
+    self.assertEqual(source.requests, 1)
+    self.assertEqual(feat_ids, {1: 10, 2: 20, 3: 30})
+    self.assertEqual(index.intersects(QgsRectangle(4, 4, 7, 7)), [2])
+    self.assertEqual(index.intersects(QgsRectangle(-1, -1, 1, 1)), [1])
+    self.assertIsNone(entries)
+
+class TestIndexCache(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.file_path = os.path.join(self.dir, 'index.bin')
+    self.fields, self.features = features([
+      (1, 10, 'POINT(0 0)'),
+      (2, 20, 'LINESTRING(5 5, 6 6)'),
+      (3, 30, None)
+    ])
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_save_load_index(self):
+    index, feat_ids, entries = index_layer(FakeSource(self.features), self.fields, True)
+    save_index(self.file_path, entries)
+    cached, cached_ids = load_index(self.file_path)
+    self.assertEqual(cached_ids, feat_ids)
+    for rect in [QgsRectangle(4, 4, 7, 7), QgsRectangle(-1, -1, 1, 1), QgsRectangle(-9, -9, 9, 9)]:
+      self.assertEqual(sorted(cached.intersects(rect)), sorted(index.intersects(rect)))
+
+  def test_index_layer_not_integer_ids(self):
+    fields, feats = features([(1, 10, 'POINT(0 0)'), (2, None, 'POINT(1 1)')])
+    index, feat_ids, entries = index_layer(FakeSource(feats), fields, True)
+    # the index is built, but not cached
+    self.assertEqual(sorted(feat_ids), [1, 2])
+    self.assertIsNone(entries)
+
+  def test_load_index_truncated(self):
+    index, feat_ids, entries = index_layer(FakeSource(self.features), self.fields, True)
+    save_index(self.file_path, entries)
+    with open(self.file_path, 'r+b') as f:
+      f.truncate(os.path.getsize(self.file_path) - 8)
+    with self.assertRaises(EOFError):
+      load_index(self.file_path)
+
+  def test_index_cache_invalidation(self):
+    cache = ResultCache(os.path.join(self.dir, 'cache'))
+    index, feat_ids, entries = index_layer(FakeSource(self.features), self.fields, True)
+    save_index(self.file_path, entries)
+    key = cache.key('spatial-index', 'db', 'schema', 'table', '3:1')
+    cache.put(key, self.dir, ['index.bin'])
+    restored = os.path.join(self.dir, 'restored')
+    self.assertIsNotNone(cache.restore(key, restored))
+    # a changed table has another fingerprint, so its index is built again
+    changed = cache.key('spatial-index', 'db', 'schema', 'table', '4:2')
+    self.assertIsNone(cache.restore(changed, restored))
+
+  def test_stable_fids(self):
+    fields = QgsFields()
+    fields.append(QgsField('id', QVariant.LongLong))
+    fields.append(QgsField('name', QVariant.String))
+    self.assertTrue(stable_fids(FakeLayer(fields, [0])))
+    self.assertFalse(stable_fids(FakeLayer(fields, [1])))
+    self.assertFalse(stable_fids(FakeLayer(fields, [0, 1])))
+    self.assertFalse(stable_fids(FakeLayer(fields, [])))
@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+from qgis.core import QgsDataSourceUri
+from qgis.testing import start_app
+
+from src.pyqgis_controls.layers import LayerRegistry
+
+start_app()
+
+class TestLayerRegistry(unittest.TestCase):
+  def setUp(self):
+    uri = QgsDataSourceUri()
+    uri.setConnection('local-data-server', '5432', 'test_vector_db', 'postgres', 'diablo2')
+    self.layers = LayerRegistry(uri)
+    patcher = mock.patch('src.pyqgis_controls.layers.QgsVectorLayer')
+    self.QgsVectorLayer = patcher.start()
+    self.QgsVectorLayer.side_effect = lambda uri, name, provider: mock.Mock(name=name)
+    self.addCleanup(patcher.stop)
+
+  def test_layer(self):
+    layer = self.layers.layer('multi_geoms', 'points')
+    # the same layer is handed out again
+    self.assertIs(self.layers.layer('multi_geoms', 'points'), layer)
+    self.assertIs(self.layers.provider('multi_geoms', 'points'), layer.dataProvider())
+    self.assertEqual(self.QgsVectorLayer.call_count, 1)
+    # tables are keyed by schema too
+    self.assertIsNot(self.layers.layer('null_geoms', 'points'), layer)
+    self.assertEqual(self.QgsVectorLayer.call_count, 2)
+    uri = QgsDataSourceUri(self.QgsVectorLayer.call_args_list[1][0][0])
+    self.assertEqual((uri.schema(), uri.table(), uri.geometryColumn()), ('null_geoms', 'points', 'geom'))
+
+  def test_features(self):
+    layer = self.layers.layer('multi_geoms', 'points')
+    self.layers.features('multi_geoms', 'points', [1, 2])
+    self.layers.feature('multi_geoms', 'points', 3)
+    layer.getFeatures.assert_called_once_with([1, 2])
+    layer.getFeature.assert_called_once_with(3)
+
+  def test_clear(self):
+    with self.layers as layers:
+      layer = layers.layer('multi_geoms', 'points')
+    self.assertIsNot(self.layers.layer('multi_geoms', 'points'), layer)
@@ -0,0 +1,64 @@
+import unittest
+
+from PyQt5.QtCore import QVariant
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry
+from qgis.testing import start_app
+
+from src.pyqgis_controls.store import FeatureStore, feature_size
+
+start_app()
+
+def feature(fid, wkt='LINESTRING Z(0 0 1, 1 1 2)'):
+  fields = QgsFields()
+  fields.append(QgsField('id', QVariant.LongLong))
+  f = QgsFeature(fields, fid)
+  f.setAttributes([fid * 10])
+  f.setGeometry(QgsGeometry.fromWkt(wkt))
+  return f
+
+class TestFeatureStore(unittest.TestCase):
+  def test_feature_size(self):
+    # two 3d vertices and one attribute over the feature overhead
+    self.assertGreater(feature_size(feature(1)), 2 * 3 * 8)
+    self.assertGreater(
+      feature_size(feature(1, 'LINESTRING Z(0 0 1, 1 1 2, 2 2 3)')), feature_size(feature(1))
+    )
+
+  def test_store(self):
+    store = FeatureStore()
+    for fid in [1, 2, 3]:
+      self.assertTrue(store.add('s', 't', feature(fid)))
+    # layers are only read once complete
+    self.assertFalse(store.has('s', 't'))
+    store.complete('s', 't')
+    self.assertTrue(store.has('s', 't'))
+    self.assertEqual([f['id'] for f in store.features('s', 't', [3, 1, 9])], [30, 10])
+    self.assertEqual(store.feature('s', 't', 2)['id'], 20)
+    self.assertEqual(store.used(), 3 * feature_size(feature(1)))
+
+  def test_missing_feature(self):
+    store = FeatureStore()
+    store.add('s', 't', feature(1))
+    store.complete('s', 't')
+    # as QgsVectorLayer.getFeature, an invalid feature
+    self.assertFalse(store.feature('s', 't', 9).isValid())
+
+  def test_cap(self):
+    size = feature_size(feature(1))
+    store = FeatureStore(3 * size)
+    self.assertTrue(store.add('s', 'small', feature(1)))
+    store.complete('s', 'small')
+    self.assertTrue(store.add('s', 'big', feature(1)))
+    self.assertTrue(store.add('s', 'big', feature(2)))
+    # the layer that does not fit is dropped whole, and its memory released
+    self.assertFalse(store.add('s', 'big', feature(3)))
+    self.assertFalse(store.add('s', 'big', feature(4)))
+    store.complete('s', 'big')
+    self.assertFalse(store.has('s', 'big'))
+    self.assertTrue(store.has('s', 'small'))
+    self.assertEqual(store.used(), size)
+    report = store.report()
+    self.assertEqual(report['bytes'], size)
+    self.assertEqual(report['max_bytes'], 3 * size)
+    self.assertEqual(report['layers'], {'s.small': {'features': 1, 'bytes': size}})
+    self.assertEqual(report['dropped'], ['s.big'])